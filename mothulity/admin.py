@@ -23,6 +23,26 @@ class JobStatusAdmin(admin.ModelAdmin):
                     "submission_time")
 
 
+class SchedulerLeaseAdmin(admin.ModelAdmin):
+    list_display = ("name",
+                    "holder",
+                    "expires")
+
+
+class IntakeStatusAdmin(admin.ModelAdmin):
+    list_display = ("job_id",
+                    "intake_status",
+                    "error",
+                    "updated")
+
+
+class UploadSessionAdmin(admin.ModelAdmin):
+    list_display = ("job_id",
+                    "client_ip",
+                    "started",
+                    "updated")
+
+
 class ArticleAdmin(admin.ModelAdmin):
     list_display = ("title",)
 
@@ -43,6 +63,9 @@ admin.site.register(JobID)
 admin.site.register(SeqsStats, SeqsStatsAdmin)
 admin.site.register(SubmissionData, SubmissionDataAdmin)
 admin.site.register(JobStatus, JobStatusAdmin)
+admin.site.register(SchedulerLease, SchedulerLeaseAdmin)
+admin.site.register(IntakeStatus, IntakeStatusAdmin)
+admin.site.register(UploadSession, UploadSessionAdmin)
 admin.site.register(Article, ArticleAdmin)
 admin.site.register(PathSettings, PathSettingsAdmin)
 admin.site.register(WebServerSettings, WebServerSettingsAdmin)
@@ -0,0 +1,287 @@
+import bz2
+import contextlib
+import copy
+import gzip
+import io
+import os
+import random
+import shutil
+import subprocess as sp
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime
+import pytz
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from mothulity import fastq, models, simulator, utils
+
+
+CODECS = (("plain", open, ""),
+          ("gzip", gzip.open, ".gz"),
+          ("bz2", bz2.open, ".bz2"))
+
+DEFAULT_MIX = (("pending", 0.05),
+               ("submitted", 0.10),
+               ("done", 0.05),
+               ("closed", 0.70),
+               ("dead", 0.10))
+
+
+class Rollback(Exception):
+    pass
+
+
+@contextlib.contextmanager
+def count_subprocesses():
+    """
+    Count the processes started with subprocess within the block, from any
+    thread.
+
+    Yields
+    -------
+    dict
+        The <calls> key holds the number of processes started so far.
+    """
+    counter = {"calls": 0}
+    lock = threading.Lock()
+    popen = sp.Popen
+
+    class CountingPopen(popen):
+        def __init__(self, *args, **kwargs):
+            with lock:
+                counter["calls"] += 1
+            super().__init__(*args, **kwargs)
+
+    sp.Popen = CountingPopen
+    try:
+        yield counter
+    finally:
+        sp.Popen = popen
+
+
+def populate(jobs,
+             upload_path,
+             cluster,
+             mix=DEFAULT_MIX,
+             seed=0,
+             batch_size=500):
+    """
+    Fill the models with synthetic jobs in mixed states, with their
+    directories in the upload path. The submitted jobs are submitted to the
+    simulated cluster, so some of them are still queued or running and some
+    have finished.
+
+    Parameters
+    -------
+    jobs: int
+        Number of jobs.
+    upload_path: str
+        Upload path, with trailing slash.
+    cluster: simulator.SimulatedCluster
+        Cluster the submitted jobs are submitted to.
+    mix: tuple of tuple, default DEFAULT_MIX
+        (status, fraction of the jobs).
+    seed: int, default <0>
+        Seed of the number of reads and submission times.
+    batch_size: int, default <500>
+        Number of rows inserted at once.
+
+    Returns
+    -------
+    dict
+        Number of jobs per status.
+    """
+    rand = random.Random(seed)
+    first_id = (models.JobID.objects.order_by("-id").values_list("id", flat=True).first() or 0) + 1
+    statuses = []
+    for status, fraction in mix:
+        statuses.extend([status] * int(round(jobs * fraction)))
+    statuses = (statuses + ["closed"] * jobs)[:jobs]
+    rand.shuffle(statuses)
+    now = time.time()
+    job_ids = [models.JobID(id=first_id + i, job_id=str(uuid.UUID(int=rand.getrandbits(128))))
+               for i in range(jobs)]
+    models.JobID.objects.bulk_create(job_ids, batch_size=batch_size)
+    models.SeqsStats.objects.bulk_create(
+        [models.SeqsStats(job_id=i, seqs_count=int(rand.lognormvariate(12, 1)))
+         for i in job_ids],
+        batch_size=batch_size,
+    )
+    models.SubmissionData.objects.bulk_create(
+        [models.SubmissionData(job_id=i,
+                               job_name="benchmark",
+                               notify_email="benchmark@localhost",
+                               max_ambig=0,
+                               max_homop=8,
+                               min_overlap=10,
+                               screen_criteria=95,
+                               chop_length=250,
+                               precluster_diffs=2,
+                               classify_seqs_cutoff=80,
+                               amplicon_type="16S")
+         for i in job_ids],
+        batch_size=batch_size,
+    )
+    job_statuses = []
+    for job, status in zip(job_ids, statuses):
+        job_dir = "{}{}/".format(upload_path, job.job_id.replace("-", "_"))
+        os.mkdir(job_dir)
+        slurm_id = None
+        if status in ("done", "closed"):
+            utils.write_text("{}analysis_mothur.job.zip".format(job_dir), "benchmark\n")
+        if status == "submitted":
+            slurm_id = utils.parse_sbatch(cluster.sbatch("accel", [job_dir]))
+        job_statuses.append(models.JobStatus(
+            job_id=job,
+            job_status=status,
+            slurm_id=slurm_id,
+            submission_time=datetime.fromtimestamp(now - rand.uniform(0, 7 * 24 * 3600),
+                                                   tz=pytz.utc),
+        ))
+    models.JobStatus.objects.bulk_create(job_statuses, batch_size=batch_size)
+    cluster.advance(3600)
+    return {i: statuses.count(i) for i, _ in mix}
+
+
+def benchmark(site_settings,
+              jobs,
+              sinfo_str,
+              squeue_str="",
+              ticks=3,
+              seed=0):
+    """
+    Time full scheduler ticks, against the simulated cluster, with the
+    database filled with synthetic jobs. Everything is done in a database
+    transaction which is rolled back at the end, and in a temporary upload
+    path.
+
+    Parameters
+    -------
+    site_settings: utils.SiteSettings
+        Settings of the site. Copies are used, with the upload path changed.
+    jobs: int
+        Number of synthetic jobs.
+    sinfo_str: str
+        sinfo output with the starting nodes.
+    squeue_str: str, default <"">
+        squeue output with the starting jobs.
+    ticks: int, default <3>
+        Number of ticks timed one after another.
+    seed: int, default <0>
+        Seed of the synthetic jobs.
+
+    Returns
+    -------
+    dict
+        Number of jobs per status and, for every tick, its wall-time, phases
+        wall-time and number of queries, subprocesses and cluster commands.
+    """
+    path_settings = copy.copy(site_settings.path_settings)
+    upload_path = "{}/".format(tempfile.mkdtemp(prefix="mothulity_benchmark_"))
+    path_settings.upload_path = path_settings.hpc_path = upload_path
+    cluster = simulator.SimulatedCluster(
+        sinfo_str,
+        squeue_str,
+        duration=lambda job_dir: random.Random(job_dir).uniform(600, 7200),
+    )
+    result = {"jobs": jobs, "ticks": []}
+    try:
+        with transaction.atomic():
+            models.JobStatus.objects.update(job_status="hidden")
+            start = time.monotonic()
+            result["statuses"] = populate(jobs, upload_path, cluster, seed=seed)
+            result["populate_seconds"] = round(time.monotonic() - start, 3)
+            for i in range(ticks):
+                sched = simulator.SimulatedScheduler(
+                    hpc_settings=site_settings.hpc_settings,
+                    path_settings=path_settings,
+                    web_server_settings=site_settings.web_server_settings,
+                    worker="benchmark",
+                    cluster=cluster,
+                )
+                commands = cluster.commands
+                with CaptureQueriesContext(connection) as queries, \
+                        count_subprocesses() as subprocesses, \
+                        contextlib.redirect_stdout(io.StringIO()):
+                    start = time.monotonic()
+                    sched.run()
+                    tick_seconds = time.monotonic() - start
+                result["ticks"].append({
+                    "tick_seconds": round(tick_seconds, 4),
+                    "phase_seconds": {k: round(v, 4) for k, v in sorted(sched.phase_seconds.items())},
+                    "queries": len(queries),
+                    "subprocess_calls": subprocesses["calls"],
+                    "cluster_commands": cluster.commands - commands,
+                })
+                cluster.advance(site_settings.hpc_settings.scheduler_interval)
+            raise Rollback()
+    except Rollback:
+        pass
+    finally:
+        shutil.rmtree(upload_path, ignore_errors=True)
+    return result
+
+
+def codec_benchmark(path,
+                    copies=1,
+                    chunk_size=64 * 1024,
+                    repeat=3):
+    """
+    Time validation of the FASTQ streamed in upload-sized chunks and read
+    counting of the file, plain and compressed with every codec, in a
+    temporary directory.
+
+    Parameters
+    -------
+    path: str
+        Path to the plain FASTQ file.
+    copies: int, default <1>
+        Number of times the file is concatenated, to get a bigger sample.
+    chunk_size: int, default <65536>
+        Size of the chunks fed to the validator, as Django's upload handlers
+        receive them.
+    repeat: int, default <3>
+        Number of timed runs. The best one is reported.
+
+    Returns
+    -------
+    dict
+        For every codec its file size, compression ratio, reads and
+        throughput of the validation and counting in MB of the plain FASTQ
+        per second.
+    """
+    tmp_dir = tempfile.mkdtemp(prefix="mothulity_codecs_")
+    with open(path, "rb") as fin:
+        data = fin.read() * copies
+    result = {}
+    try:
+        for codec, opener, suffix in CODECS:
+            codec_path = os.path.join(tmp_dir, "sample.fastq{}".format(suffix))
+            with opener(codec_path, "wb") as fout:
+                fout.write(data)
+            with open(codec_path, "rb") as fin:
+                compressed = fin.read()
+            validate_seconds = count_seconds = float("inf")
+            for _ in range(repeat):
+                start = time.monotonic()
+                validator = fastq.FastqValidator()
+                for i in range(0, len(compressed), chunk_size):
+                    validator.feed(compressed[i:i + chunk_size])
+                reads = validator.close()
+                validate_seconds = min(validate_seconds, time.monotonic() - start)
+                start = time.monotonic()
+                fastq.count_reads(codec_path)
+                count_seconds = min(count_seconds, time.monotonic() - start)
+            megabytes = len(data) / 1e6
+            result[codec] = {
+                "bytes": len(compressed),
+                "ratio": round(len(data) / len(compressed), 2),
+                "reads": reads,
+                "validate_mb_per_second": round(megabytes / validate_seconds, 1),
+                "count_mb_per_second": round(megabytes / count_seconds, 1),
+            }
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return result
@@ -0,0 +1,420 @@
+import bz2
+import gzip
+import re
+import zlib
+
+
+SEQUENCE_RE = re.compile(rb"^[A-Za-z.\-*]+$")
+QUALITY_RE = re.compile(rb"^[!-~]+$")
+
+MAGIC = ((b"\x1f\x8b", "gzip"),
+         (b"BZh", "bz2"))
+MAGIC_LENGTH = max(len(i) for i, _ in MAGIC)
+
+PATTERNS = ("*fastq", "*fastq.gz", "*fastq.bz2")
+
+MAX_LINE_LENGTH = 1 << 20
+DECOMPRESS_CHUNK = 1 << 20
+MAX_COMPRESSION_RATIO = 10
+
+
+class FastqError(ValueError):
+    """
+    Data is not a valid FASTQ.
+    """
+    pass
+
+
+def detect_codec(head):
+    """
+    Return compression of the data by its magic bytes.
+
+    Parameters
+    -------
+    head: bytes
+        First bytes of the data.
+
+    Returns
+    -------
+    str or None
+        <gzip>, <bz2> or None for the plain data.
+    """
+    for magic, codec in MAGIC:
+        if head.startswith(magic):
+            return codec
+    return None
+
+
+def open_fastq(path):
+    """
+    Open the FASTQ file for binary reading, decompressing it on the fly if
+    its magic bytes say it is compressed.
+    """
+    with open(path, "rb") as fin:
+        codec = detect_codec(fin.read(MAGIC_LENGTH))
+    if codec == "gzip":
+        return gzip.open(path, "rb")
+    if codec == "bz2":
+        return bz2.open(path, "rb")
+    return open(path, "rb", buffering=0)
+
+
+class LineBuffer:
+    """
+    Splits the data fed in chunks into lines. Only the unfinished last line
+    is kept between the chunks and it may not grow beyond max_line_length,
+    so the data without newlines cannot exhaust the memory.
+
+    Parameters
+    -------
+    max_line_length: int, default <1048576>
+        Maximum length of a line.
+
+    Attributes
+    -------
+    tail: bytearray
+        Unfinished last line.
+    """
+    def __init__(self,
+                 max_line_length=MAX_LINE_LENGTH):
+        self.max_line_length = max_line_length
+        self.tail = bytearray()
+
+    def feed(self,
+             data):
+        """
+        Return the lines completed by the next chunk of the data.
+
+        Parameters
+        -------
+        data: bytes
+            Next chunk of the data.
+
+        Returns
+        -------
+        list of bytes
+            Complete lines without the newlines.
+
+        Raises
+        -------
+        FastqError
+            If a line is longer than max_line_length.
+        """
+        end = data.rfind(b"\n")
+        if end < 0:
+            lines = []
+            self.tail += data
+        else:
+            self.tail += data[:end]
+            lines = bytes(self.tail).split(b"\n")
+            self.tail = bytearray(data[end + 1:])
+        if (len(self.tail) > self.max_line_length or
+                lines and max(map(len, lines)) > self.max_line_length):
+            raise FastqError("Line longer than {} bytes".format(self.max_line_length))
+        return lines
+
+
+class Decompressor:
+    """
+    Decompresses the data fed in chunks. Concatenated gzip members and bz2
+    streams, as written by pigz or pbzip2, are decompressed one after
+    another. The output is produced in pieces of at most DECOMPRESS_CHUNK
+    bytes, so a small, highly compressed chunk never inflates at once.
+
+    Parameters
+    -------
+    codec: str or None
+        <gzip>, <bz2> or None for the plain data, which is passed through.
+    max_size: int, default <None>
+        Maximum size of the decompressed data. Unlimited if None.
+
+    Attributes
+    -------
+    size: int
+        Size of the decompressed data so far.
+    """
+    def __init__(self,
+                 codec,
+                 max_size=None):
+        self.codec = codec
+        self.max_size = max_size
+        self.size = 0
+        self.stream = self.new_stream()
+
+    def new_stream(self):
+        if self.codec == "gzip":
+            return zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+        if self.codec == "bz2":
+            return bz2.BZ2Decompressor()
+        return None
+
+    def count(self,
+              data):
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            raise FastqError("Decompressed data exceeds {} bytes".format(self.max_size))
+        return data
+
+    def decompress(self,
+                   data):
+        """
+        Yield the decompressed pieces of the next chunk of the data.
+
+        Parameters
+        -------
+        data: bytes
+            Next chunk of the compressed data.
+
+        Raises
+        -------
+        FastqError
+            If the data is corrupted or its decompressed size exceeds
+            max_size.
+        """
+        if self.stream is None:
+            if data:
+                yield self.count(data)
+            return
+        while True:
+            try:
+                out = self.stream.decompress(data, DECOMPRESS_CHUNK)
+            except (zlib.error, OSError, EOFError) as e:
+                raise FastqError("Corrupted {} data: {}".format(self.codec, e))
+            if self.codec == "gzip":
+                data = self.stream.unconsumed_tail
+                more = bool(data) or len(out) == DECOMPRESS_CHUNK
+            else:
+                data = b""
+                more = not self.stream.needs_input
+            if out:
+                yield self.count(out)
+            if self.stream.eof:
+                data = self.stream.unused_data
+                if not data:
+                    return
+                self.stream = self.new_stream()
+            elif not more:
+                return
+
+    def close(self):
+        """
+        Raise FastqError if the compressed data ended in the middle of a
+        stream.
+        """
+        if self.stream is not None and not self.stream.eof:
+            raise FastqError("Truncated {} data".format(self.codec))
+
+
+class FastqValidator:
+    """
+    Validates FASTQ fed in chunks of bytes, record by record, and counts the
+    reads. Records are expected in the four-line layout written by the
+    sequencers - header starting with <@>, sequence, separator starting with
+    <+> and quality of the sequence length. The first invalid line raises
+    FastqError, so the rest of the data does not have to be read. Gzip and
+    bz2 compressed data is detected by its magic bytes and decompressed on
+    the fly.
+
+    Parameters
+    -------
+    max_size: int, default <None>
+        Maximum size of the decompressed data. Unlimited if None.
+
+    Attributes
+    -------
+    reads: int
+        Number of complete records validated so far.
+    codec: str or None
+        Compression of the data, known once its first bytes are fed.
+    """
+    def __init__(self,
+                 max_size=None):
+        self.max_size = max_size
+        self.reads = 0
+        self.line_no = 0
+        self.lines = LineBuffer()
+        self.seq_len = None
+        self.head = b""
+        self.decompressor = None
+
+    @property
+    def codec(self):
+        return self.decompressor.codec if self.decompressor else None
+
+    def error(self,
+              msg):
+        raise FastqError("Line {}: {}".format(self.line_no + 1, msg))
+
+    def check_line(self,
+                   line):
+        line = line.rstrip(b"\r")
+        pos = self.line_no % 4
+        if pos == 0:
+            if not line.startswith(b"@") or len(line) < 2:
+                self.error("record header does not start with @")
+        elif pos == 1:
+            if not SEQUENCE_RE.match(line):
+                self.error("invalid sequence")
+            self.seq_len = len(line)
+        elif pos == 2:
+            if not line.startswith(b"+"):
+                self.error("separator does not start with +")
+        else:
+            if len(line) != self.seq_len or not QUALITY_RE.match(line):
+                self.error("quality does not match the sequence")
+            self.reads += 1
+        self.line_no += 1
+
+    def feed(self,
+             data):
+        """
+        Validate the next chunk of the data.
+
+        Parameters
+        -------
+        data: bytes
+            Next chunk of the FASTQ.
+
+        Raises
+        -------
+        FastqError
+            On the first invalid line.
+        """
+        if self.decompressor is None:
+            self.head += data
+            if len(self.head) < MAGIC_LENGTH:
+                return
+            data, self.head = self.head, b""
+            self.decompressor = Decompressor(detect_codec(data), self.max_size)
+        for piece in self.decompressor.decompress(data):
+            self.feed_lines(piece)
+
+    def feed_lines(self,
+                   data):
+        for line in self.lines.feed(data):
+            self.check_line(line)
+        marker = self.lines.tail[:1]
+        if marker:
+            pos = self.line_no % 4
+            if pos == 0 and marker != b"@":
+                self.error("record header does not start with @")
+            if pos == 2 and marker != b"+":
+                self.error("separator does not start with +")
+
+    def close(self):
+        """
+        Validate the end of the data and return the number of reads.
+
+        Returns
+        -------
+        int
+            Number of reads.
+
+        Raises
+        -------
+        FastqError
+            If the last record is incomplete or there are no reads.
+        """
+        if self.decompressor is None:
+            self.decompressor = Decompressor(detect_codec(self.head), self.max_size)
+            for piece in self.decompressor.decompress(self.head):
+                self.feed_lines(piece)
+        self.decompressor.close()
+        tail = bytes(self.lines.tail)
+        if tail.rstrip(b"\r"):
+            self.check_line(tail)
+            self.lines.tail = bytearray()
+        if self.line_no % 4 != 0:
+            self.error("incomplete record")
+        if self.reads == 0:
+            raise FastqError("No reads")
+        return self.reads
+
+
+def validate_file(path,
+                  buffer_size=1 << 20,
+                  max_size=None):
+    """
+    Validate the FASTQ file, plain or compressed, record by record with
+    FastqValidator and return the number of reads.
+
+    Parameters
+    -------
+    path: str
+        Path to the FASTQ file.
+    buffer_size: int, default <1048576>
+        Size of the chunks read.
+    max_size: int, default <None>
+        Maximum size of the decompressed data. Unlimited if None.
+
+    Returns
+    -------
+    int
+        Number of reads.
+
+    Raises
+    -------
+    FastqError
+        On the first invalid line.
+    """
+    validator = FastqValidator(max_size)
+    with open(path, "rb") as fin:
+        for chunk in iter(lambda: fin.read(buffer_size), b""):
+            validator.feed(chunk)
+    return validator.close()
+
+
+def count_reads(path,
+                buffer_size=1 << 20):
+    """
+    Return number of reads in the FASTQ file. The file is read in large
+    chunks and only the record markers - <@> of the headers and <+> of the
+    separators - are checked. Lines are split with LineBuffer, so the memory
+    use does not depend on the file size, even without newlines. Gzip and
+    bz2 compressed files are decompressed on the fly.
+
+    Parameters
+    -------
+    path: str
+        Path to the FASTQ file.
+    buffer_size: int, default <1048576>
+        Size of the chunks read.
+
+    Returns
+    -------
+    int
+        Number of reads.
+
+    Raises
+    -------
+    FastqError
+        If a record marker is missing, the last record is incomplete or the
+        compressed data is broken.
+    """
+    reads = 0
+    buffer = LineBuffer()
+    pending = []
+    with open_fastq(path) as fin:
+        while True:
+            try:
+                chunk = fin.read(buffer_size)
+            except (EOFError, zlib.error) as e:
+                raise FastqError("{}: corrupted or truncated data: {}".format(path, e))
+            if not chunk:
+                break
+            try:
+                lines = pending + buffer.feed(chunk)
+            except FastqError as e:
+                raise FastqError("{}: {} after read {}".format(path, e, reads))
+            complete = len(lines) - len(lines) % 4
+            if ({i[:1] for i in lines[0:complete:4]} - {b"@"} or
+                    {i[:1] for i in lines[2:complete:4]} - {b"+"}):
+                raise FastqError("{}: missing record marker after read {}".format(path, reads))
+            reads += complete // 4
+            pending = lines[complete:]
+    lines = pending + [bytes(buffer.tail)]
+    while lines and not lines[-1].strip():
+        lines.pop()
+    if lines:
+        raise FastqError("{}: incomplete record after read {}".format(path, reads))
+    return reads
@@ -0,0 +1,182 @@
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from mothulity import fastq, models, storage, uploadhandlers, utils
+
+
+_executor = None
+
+
+def get_executor():
+    """
+    Return the process-wide pool of the intake workers, sized with
+    settings.MOTHULITY_INTAKE_WORKERS (default 4).
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, "MOTHULITY_INTAKE_WORKERS", 4),
+            thread_name_prefix="mothulity-intake",
+        )
+    return _executor
+
+
+def create_job(job_id,
+               reads,
+               path_settings,
+               hpc_settings):
+    """
+    Finish the upload of the files to the job directory - check they are
+    paired, check their names with mothulity_fc on the HPC and create the
+    Job ID with the total number of reads.
+
+    Parameters
+    -------
+    job_id: uuid.UUID or str
+        Job ID of the directory the files were uploaded to.
+    reads: list of int
+        Number of reads of every uploaded file.
+    path_settings: models.PathSettings
+    hpc_settings: models.HPCSettings
+
+    Returns
+    -------
+    str or None
+        Key of views.upload_errors, None if the Job ID was created.
+    """
+    if len(reads) % 2 != 0:
+        return 'uneven'
+    hpc_dir = "{}{}/".format(
+        path_settings.hpc_path,
+        str(job_id).replace("-", "_"),
+    )
+    try:
+        utils.ssh_cmd(cmd='srun mothulity_fc {}'.format(hpc_dir), machine=hpc_settings.hpc_name)
+    except:
+        return 'mothulity_fc'
+    job = models.JobID(job_id=job_id)
+    job.save()
+    seqsstats = models.SeqsStats(job_id=job, seqs_count=sum(reads))
+    seqsstats.save()
+    return None
+
+
+def validate_dir(storage,
+                 job_dir):
+    """
+    Validate the FASTQ files written to the job directory and commit them
+    if they are valid and paired. A file which is not FASTQ is removed, so it
+    can be uploaded again.
+
+    Parameters
+    -------
+    storage: storage.LocalStorage
+        Storage backend the files were written with.
+    job_dir: str
+        Name of the job directory.
+
+    Returns
+    -------
+    list of int or str
+        Number of reads of every file or key of views.upload_errors.
+    """
+    filenames = [i for i in storage.partial_files(job_dir)
+                 if any(fnmatch(i, j) for j in fastq.PATTERNS)]
+    reads = []
+    for filename in filenames:
+        try:
+            reads.append(fastq.validate_file(storage.current_path(job_dir, filename),
+                                             max_size=uploadhandlers.fastq_max_bytes()))
+        except fastq.FastqError as e:
+            print("Upload {} rejected: {}: {}".format(job_dir, filename, e))
+            storage.discard(job_dir, filename)
+            return 'format'
+    if not reads or len(reads) % 2 != 0:
+        return 'uneven'
+    for filename in filenames:
+        storage.commit(job_dir, filename)
+    storage.close_dir(job_dir)
+    return reads
+
+
+def set_status(job_id,
+               intake_status,
+               **kwargs):
+    models.IntakeStatus.objects.filter(job_id=job_id).update(
+        intake_status=intake_status,
+        updated=timezone.now(),
+        **kwargs
+    )
+
+
+def run(job_id,
+        reads=None,
+        remove_rejected=False):
+    """
+    Check the upload and create its Job ID, recording the progress in
+    IntakeStatus.
+
+    Parameters
+    -------
+    job_id: str
+        Job ID of the upload.
+    reads: list of int, default <None>
+        Number of reads of every file, if they were already validated and
+        committed while uploaded. Otherwise the files are validated, counted
+        and committed first.
+    remove_rejected: bool, default <False>
+        Remove the job directory if the upload is rejected.
+    """
+    site, path_settings, web_server_settings, hpc_settings = utils.get_site_settings()
+    job_storage = storage.get_storage(path_settings)
+    job_dir = storage.job_dir(job_id)
+    try:
+        set_status(job_id, "checking")
+        if reads is None:
+            reads = validate_dir(job_storage, job_dir)
+        error = reads if isinstance(reads, str) else create_job(job_id, reads, path_settings, hpc_settings)
+        if error is None:
+            set_status(job_id, "ready", seqs_count=sum(reads))
+            return
+    except Exception as e:
+        print("Upload {} check failed: {!r}".format(job_id, e))
+        error = 'intake'
+    set_status(job_id, "rejected", error=error)
+    if remove_rejected:
+        job_storage.remove_dir(job_dir)
+
+
+def work(*args,
+         **kwargs):
+    """
+    Run in the intake worker thread, closing its database connection after.
+    """
+    try:
+        run(*args, **kwargs)
+    finally:
+        connection.close()
+
+
+def submit(job_id,
+           reads=None,
+           remove_rejected=False):
+    """
+    Queue the upload to be checked by run in the intake workers, once the
+    current transaction is committed. With
+    settings.MOTHULITY_INTAKE_WORKERS set to 0 it is checked right away.
+
+    Returns
+    -------
+    models.IntakeStatus
+        Status of the queued upload.
+    """
+    intake_status = models.IntakeStatus.objects.create(job_id=str(job_id))
+    if getattr(settings, "MOTHULITY_INTAKE_WORKERS", 4) == 0:
+        run(str(job_id), reads=reads, remove_rejected=remove_rejected)
+        intake_status.refresh_from_db()
+    else:
+        transaction.on_commit(lambda: get_executor().submit(
+            work, str(job_id), reads=reads, remove_rejected=remove_rejected))
+    return intake_status
@@ -0,0 +1,35 @@
+import json
+import os
+import platform
+from django.core.management.base import BaseCommand
+from mothulity import benchmark
+
+
+class Command(BaseCommand):
+    help = ("Time streaming validation and read counting of a FASTQ file, "
+            "plain and compressed with every supported codec, and write the "
+            "results as JSON.")
+
+    def add_arguments(self, parser):
+        base_dir = os.path.dirname(os.path.abspath(benchmark.__file__))
+        parser.add_argument("--input",
+                            default="{}/tests/Mock_S280_L001_R1_001.fastq".format(base_dir),
+                            help="Plain FASTQ file. Default the test file.")
+        parser.add_argument("--copies",
+                            type=int,
+                            default=20,
+                            help="Times the file is concatenated. Default 20.")
+        parser.add_argument("--output",
+                            default="mothulity_fastq_benchmark.json",
+                            help="JSON file the results are written to.")
+
+    def handle(self, *args, **options):
+        results = benchmark.codec_benchmark(options["input"], copies=options["copies"])
+        for codec, result in results.items():
+            self.stdout.write("{}: {}".format(codec, json.dumps(result, sort_keys=True)))
+        with open(options["output"], "w") as fout:
+            json.dump({"input": options["input"],
+                       "copies": options["copies"],
+                       "python": platform.python_version(),
+                       "results": results}, fout, indent=2, sort_keys=True)
+        self.stdout.write("Results written to {}".format(options["output"]))
@@ -0,0 +1,70 @@
+import json
+import os
+import platform
+import subprocess as sp
+import django
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_databases, teardown_databases
+from django.utils import timezone
+from mothulity import benchmark, models, utils
+
+
+class Command(BaseCommand):
+    help = ("Time full scheduler ticks against a simulated cluster with the "
+            "test database filled with synthetic jobs and write the results "
+            "as JSON.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes",
+                            nargs="+",
+                            type=int,
+                            default=[1000, 10000, 100000],
+                            help="Numbers of synthetic jobs. Default 1000 10000 100000.")
+        parser.add_argument("--ticks",
+                            type=int,
+                            default=3,
+                            help="Ticks timed per size. Default 3.")
+        parser.add_argument("--output",
+                            default="mothulity_benchmark.json",
+                            help="JSON file the results are written to.")
+
+    def handle(self, *args, **options):
+        base_dir = os.path.abspath(os.path.join(os.path.dirname(benchmark.__file__)))
+        with open("{}/tests/sinfo.log".format(base_dir)) as fin:
+            sinfo_str = fin.read()
+        with open("{}/tests/squeue.log".format(base_dir)) as fin:
+            squeue_str = fin.read()
+        try:
+            commit = sp.check_output(["git", "rev-parse", "HEAD"],
+                                     cwd=base_dir,
+                                     stderr=sp.DEVNULL).decode("utf-8").strip()
+        except (OSError, sp.CalledProcessError):
+            commit = None
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            site = models.Site.objects.create(domain="benchmark.test", name="benchmark")
+            models.PathSettings.objects.create(site=site)
+            models.WebServerSettings.objects.create(site=site)
+            models.HPCSettings.objects.create(site=site, hpc_name="benchmark")
+            site_settings = utils.get_site_settings(site.domain)
+            results = []
+            for jobs in options["sizes"]:
+                self.stdout.write("Benchmarking {} jobs".format(jobs))
+                results.append(benchmark.benchmark(site_settings,
+                                                   jobs,
+                                                   sinfo_str,
+                                                   squeue_str,
+                                                   ticks=options["ticks"]))
+                self.stdout.write(json.dumps(results[-1]["ticks"][0], sort_keys=True))
+            vendor = connection.vendor
+        finally:
+            teardown_databases(old_config, verbosity=0)
+        with open(options["output"], "w") as fout:
+            json.dump({"commit": commit,
+                       "time": timezone.now().isoformat(),
+                       "python": platform.python_version(),
+                       "django": django.get_version(),
+                       "database": vendor,
+                       "results": results}, fout, indent=2, sort_keys=True)
+        self.stdout.write("Results written to {}".format(options["output"]))
@@ -0,0 +1,240 @@
+import bisect
+import contextlib
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+from django.conf import settings
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class Registry:
+    """
+    Thread-safe collection of latency histograms and gauges rendered in the
+    Prometheus text format. Metrics are keyed by name and labels.
+
+    Parameters
+    -------
+    buckets: tuple of float, default DEFAULT_BUCKETS
+        Upper bounds, in seconds, of the histograms buckets.
+    """
+    def __init__(self,
+                 buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.gauges = {}
+
+    @staticmethod
+    def key(name,
+            labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def observe(self,
+                name,
+                value,
+                **labels):
+        """
+        Add the value to the histogram.
+        """
+        key = self.key(name, labels)
+        with self.lock:
+            hist = self.histograms.setdefault(
+                key,
+                {"buckets": [0] * len(self.buckets), "count": 0, "sum": 0.0},
+            )
+            pos = bisect.bisect_left(self.buckets, value)
+            if pos < len(self.buckets):
+                hist["buckets"][pos] += 1
+            hist["count"] += 1
+            hist["sum"] += value
+
+    def set_gauge(self,
+                  name,
+                  value,
+                  **labels):
+        """
+        Set the gauge to the value.
+        """
+        with self.lock:
+            self.gauges[self.key(name, labels)] = value
+
+    def clear_gauges(self,
+                     name):
+        """
+        Remove the gauge with all its labels, eg. before setting it for the
+        labels which are still present.
+        """
+        with self.lock:
+            self.gauges = {k: v for k, v in self.gauges.items() if k[0] != name}
+
+    @contextlib.contextmanager
+    def timer(self,
+              name,
+              **labels):
+        """
+        Observe wall-time of the block in the histogram.
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def count(self,
+              name):
+        """
+        Return number of observations of the histogram, summed over labels.
+        """
+        with self.lock:
+            return sum([v["count"] for (n, _), v in self.histograms.items() if n == name])
+
+    def to_dict(self):
+        """
+        Return JSON-serializable copy of the metrics.
+        """
+        with self.lock:
+            return {
+                "buckets": list(self.buckets),
+                "histograms": [[n, dict(l), v] for (n, l), v in self.histograms.items()],
+                "gauges": [[n, dict(l), v] for (n, l), v in self.gauges.items()],
+            }
+
+    def merge(self,
+              other,
+              **labels):
+        """
+        Add the histograms and gauges of the other registry, with the same
+        buckets, extending their labels with the given ones.
+        """
+        with self.lock, other.lock:
+            for (name, other_labels), hist in other.histograms.items():
+                merged = self.histograms.setdefault(
+                    self.key(name, dict(other_labels, **labels)),
+                    {"buckets": [0] * len(self.buckets), "count": 0, "sum": 0.0},
+                )
+                merged["buckets"] = [i + j for i, j in zip(merged["buckets"], hist["buckets"])]
+                merged["count"] += hist["count"]
+                merged["sum"] += hist["sum"]
+            for (name, other_labels), value in other.gauges.items():
+                self.gauges[self.key(name, dict(other_labels, **labels))] = value
+
+    @classmethod
+    def from_dict(cls,
+                  data):
+        """
+        Return Registry restored from Registry.to_dict output.
+        """
+        registry = cls(buckets=data["buckets"])
+        registry.histograms = {registry.key(n, l): v for n, l, v in data["histograms"]}
+        registry.gauges = {registry.key(n, l): v for n, l, v in data["gauges"]}
+        return registry
+
+    def render(self):
+        """
+        Return the metrics in the Prometheus text exposition format.
+        """
+        def labels_str(labels, **extra):
+            labels = list(labels) + sorted(extra.items())
+            if not labels:
+                return ""
+            return "{{{}}}".format(",".join(['{}="{}"'.format(k, str(v).replace('"', '\\"'))
+                                             for k, v in labels]))
+        lines = []
+        with self.lock:
+            typed = set()
+            for (name, labels), value in sorted(self.gauges.items()):
+                if name not in typed:
+                    lines.append("# TYPE {} gauge".format(name))
+                    typed.add(name)
+                lines.append("{}{} {}".format(name, labels_str(labels), value))
+            for (name, labels), hist in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append("# TYPE {} histogram".format(name))
+                    typed.add(name)
+                cumulative = 0
+                for bound, count in zip(self.buckets, hist["buckets"]):
+                    cumulative += count
+                    lines.append("{}_bucket{} {}".format(name, labels_str(labels, le=bound), cumulative))
+                lines.append("{}_bucket{} {}".format(name, labels_str(labels, le="+Inf"), hist["count"]))
+                lines.append("{}_sum{} {}".format(name, labels_str(labels), hist["sum"]))
+                lines.append("{}_count{} {}".format(name, labels_str(labels), hist["count"]))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def metrics_file(worker=None):
+    """
+    Return path of the file the scheduler worker dumps its metrics to. It is
+    settings.MOTHULITY_METRICS_FILE or a file in the temporary directory,
+    with the worker name inserted before the extension.
+    """
+    path = getattr(settings,
+                   "MOTHULITY_METRICS_FILE",
+                   os.path.join(tempfile.gettempdir(), "mothulity_scheduler_metrics.json"))
+    if worker is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return "{}.{}{}".format(root, worker.replace(os.sep, "_"), ext)
+
+
+def dump(registry=REGISTRY,
+         path=None,
+         worker=None):
+    """
+    Write the metrics to the file of the worker atomically, so the web
+    server never reads a half-written one and the workers do not overwrite
+    each other's metrics.
+    """
+    path = path or metrics_file(worker)
+    tmp_path = "{}.{}".format(path, os.getpid())
+    with open(tmp_path, "w") as fout:
+        json.dump(registry.to_dict(), fout)
+    os.replace(tmp_path, path)
+
+
+def load(path=None):
+    """
+    Return Registry read from the file or empty Registry if there is none.
+    Without the path, the files of all the scheduler workers updated within
+    settings.MOTHULITY_METRICS_MAX_AGE seconds (default 3600) are merged,
+    each metric labeled with its <worker>.
+    """
+    if path is not None:
+        try:
+            with open(path) as fin:
+                return Registry.from_dict(json.load(fin))
+        except (OSError, ValueError):
+            return Registry()
+    root, ext = os.path.splitext(metrics_file())
+    oldest = time.time() - getattr(settings, "MOTHULITY_METRICS_MAX_AGE", 3600)
+    merged = Registry()
+    for worker_path in sorted(glob.glob("{}.*{}".format(glob.escape(root), ext))):
+        try:
+            if os.path.getmtime(worker_path) < oldest:
+                continue
+            registry = load(worker_path)
+        except OSError:
+            continue
+        if registry.buckets == merged.buckets:
+            merged.merge(registry, worker=worker_path[len(root) + 1:len(worker_path) - len(ext)])
+    return merged
+
+
+def query_timer(execute,
+                sql,
+                params,
+                many,
+                context):
+    """
+    Database execute wrapper observing every query in the
+    <mothulity_db_query_seconds> histogram.
+    """
+    with REGISTRY.timer("mothulity_db_query_seconds"):
+        return execute(sql, params, many, context)
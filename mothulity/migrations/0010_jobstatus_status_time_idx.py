@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.1.2 on 2026-10-18 10:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mothulity', '0009_article'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='jobstatus',
+            index=models.Index(fields=['job_status', 'submission_time'], name='mothulity_status_time_idx'),
+        ),
+    ]
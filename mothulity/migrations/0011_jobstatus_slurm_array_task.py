@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.1.2 on 2026-10-18 10:55
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mothulity', '0010_jobstatus_status_time_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='jobstatus',
+            name='slurm_array_task',
+            field=models.IntegerField(null=True),
+        ),
+    ]
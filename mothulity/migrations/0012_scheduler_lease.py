@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.1.2 on 2026-10-18 12:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mothulity', '0011_jobstatus_slurm_array_task'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SchedulerLease',
+            fields=[
+                ('name', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('holder', models.CharField(max_length=100)),
+                ('expires', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='jobstatus',
+            name='claimed_by',
+            field=models.CharField(max_length=100, null=True),
+        ),
+        migrations.AddField(
+            model_name='jobstatus',
+            name='claim_expires',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.1.2 on 2026-10-18 16:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mothulity', '0012_scheduler_lease'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IntakeStatus',
+            fields=[
+                ('job_id', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('intake_status', models.CharField(default='queued', max_length=10)),
+                ('error', models.CharField(blank=True, max_length=20)),
+                ('seqs_count', models.IntegerField(null=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
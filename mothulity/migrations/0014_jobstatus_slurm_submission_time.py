@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.1.2 on 2026-10-18 17:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mothulity', '0013_intakestatus'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='jobstatus',
+            name='slurm_submission_time',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.1.2 on 2026-10-18 17:45
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mothulity', '0014_jobstatus_slurm_submission_time'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('job_id', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('token_hash', models.CharField(max_length=64)),
+                ('client_ip', models.GenericIPAddressField(null=True)),
+                ('started', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
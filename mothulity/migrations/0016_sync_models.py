@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.1.2 on 2026-10-18 18:30
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+SETTINGS_MODELS = ("HPCSettings", "PathSettings", "WebServerSettings")
+
+
+def table_columns(schema_editor,
+                  table):
+    with schema_editor.connection.cursor() as cursor:
+        return {i.name for i in schema_editor.connection.introspection.get_table_description(cursor, table)}
+
+
+def create_missing(apps, schema_editor):
+    """
+    Create the settings tables and columns the database does not have yet.
+    The settings models had no migrations before, so their tables were made
+    by hand and may lack the newer columns.
+    """
+    tables = schema_editor.connection.introspection.table_names()
+    for name in SETTINGS_MODELS:
+        model = apps.get_model("mothulity", name)
+        if model._meta.db_table not in tables:
+            schema_editor.create_model(model)
+            continue
+        columns = table_columns(schema_editor, model._meta.db_table)
+        for field in model._meta.local_fields:
+            if field.column not in columns:
+                schema_editor.add_field(model, field)
+
+
+def remove_stale_column(name):
+    """
+    Return function dropping the SubmissionData column removed from the
+    model without a migration, where the database still has it.
+    """
+    def remove(apps, schema_editor):
+        model = apps.get_model("mothulity", "SubmissionData")
+        field = model._meta.get_field(name)
+        if field.column in table_columns(schema_editor, model._meta.db_table):
+            schema_editor.remove_field(model, field)
+    return remove
+
+
+def remove_tables(apps, schema_editor):
+    for name in SETTINGS_MODELS:
+        schema_editor.delete_model(apps.get_model("mothulity", name))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sites', '0002_alter_domain_unique'),
+        ('mothulity', '0015_uploadsession'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(state_operations=[
+            migrations.CreateModel(
+                name='HPCSettings',
+                fields=[
+                    ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                    ('hpc_name', models.CharField(default='headnode', help_text='Name of the HPC used by the ssh.', max_length=30)),
+                    ('free_Ns_minimum_number', models.IntegerField(default=20, help_text='Minimum number of free N nodes in order to submit the job.')),
+                    ('free_PHIs_minimum_number', models.IntegerField(default=5, help_text='Minimum number of free PHI nodes in order to submit the job.')),
+                    ('retry_maximum_number', models.IntegerField(default=1, help_text='Maximum number of resubmissions before a failed job is removed.')),
+                    ('scheduler_interval', models.IntegerField(default=300, help_text='Time interval (in seconds) for the scheduler. Values above 30 are recommended due to the delays in the database and SLURM communication. Changes are picked up by the running scheduler, without restarting its services.')),
+                    ('queue_policy', models.CharField(choices=[('fifo', 'Oldest first'), ('lifo', 'Newest first'), ('sjf', 'Smallest number of reads first'), ('aging', 'Smallest number of reads first, with aging')], default='fifo', help_text='Order in which pending jobs are submitted.', max_length=10)),
+                    ('array_submission_minimum', models.IntegerField(default=0, help_text='Minimum number of jobs submitted to one partition at once to send them as one SLURM job array instead of one sbatch per job. 0 disables job arrays.')),
+                    ('scheduler_lease_time', models.IntegerField(default=900, help_text='Time (in seconds) after which the leader scheduler is considered dead and another scheduler worker takes over monitoring the jobs. Jobs claimed by a dead worker are released after the same time. It should be a few scheduler intervals.')),
+                    ('queue_aging_reads_per_hour', models.IntegerField(default=1000000, help_text='Used by the aging queue policy. For every hour of waiting a pending job is treated as if it had this many reads less, so the big jobs are not starved.')),
+                    ('site', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='sites.Site')),
+                ],
+            ),
+            migrations.CreateModel(
+                name='PathSettings',
+                fields=[
+                    ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                    ('upload_path', models.CharField(default='/mnt/mothulity_HPC/jobs/', help_text='Input files upload path. It must point to the location ON THE WEBSERVER which also MOUNTED FROM HPC. MUST CONTAIN TRAILING SLASH.', max_length=300)),
+                    ('hpc_path', models.CharField(default='/home/mothulity/jobs/', help_text='Must point to the same location as the above upload_path but from the HPC ITSELF. MUST CONTAIN TRAILING SLASH.', max_length=300)),
+                    ('storage_backend', models.CharField(choices=[('local', 'Local - write straight to the upload_path'), ('staging', 'Staging - write to a local directory, move complete files to the upload_path')], default='local', help_text='How the uploaded files are written. Staging keeps half-written files off the HPC mount. Its local directory is set with MOTHULITY_STAGING_DIR.', max_length=10)),
+                    ('site', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='sites.Site')),
+                ],
+            ),
+            migrations.CreateModel(
+                name='WebServerSettings',
+                fields=[
+                    ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                    ('files_upload_expiry_time', models.IntegerField(default=1200, help_text='Session expiry time in seconds used for the files-upload view.')),
+                    ('site', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='sites.Site')),
+                ],
+            ),
+        ]),
+        migrations.RunPython(create_missing, remove_tables),
+        migrations.RunPython(remove_stale_column('max_length'), migrations.RunPython.noop),
+        migrations.SeparateDatabaseAndState(state_operations=[
+            migrations.RemoveField(
+                model_name='submissiondata',
+                name='max_length',
+            ),
+        ]),
+        migrations.RunPython(remove_stale_column('min_length'), migrations.RunPython.noop),
+        migrations.SeparateDatabaseAndState(state_operations=[
+            migrations.RemoveField(
+                model_name='submissiondata',
+                name='min_length',
+            ),
+        ]),
+    ]
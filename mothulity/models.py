@@ -55,19 +55,126 @@ class JobStatus(models.Model):
     -------
     added_time: int
         Number of times a job has been submitted.
+    slurm_array_task: int
+        Task index if the job was submitted as a part of SLURM job array. The
+        slurm_id is the array job ID then.
+    slurm_submission_time: datetime
+        Time the job was last accepted by sbatch.
+    claimed_by: str
+        Scheduler worker which is submitting the job.
+    claim_expires: datetime
+        Time after which the other workers may claim the job.
     """
     job_id = models.OneToOneField(JobID,
                                   on_delete=models.CASCADE,
                                   primary_key=True)
     job_status = models.CharField(max_length=10)
     slurm_id = models.IntegerField(null=True)
+    slurm_array_task = models.IntegerField(null=True)
     retry = models.IntegerField(default=0)
     submission_time = models.DateTimeField("submission time",
                                            default=timezone.now)
+    slurm_submission_time = models.DateTimeField(null=True)
+    claimed_by = models.CharField(max_length=100, null=True)
+    claim_expires = models.DateTimeField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["job_status", "submission_time"],
+                         name="mothulity_status_time_idx"),
+        ]
 
     def __str__(self):
         return self.job_status
 
+    def slurm_key(self):
+        """
+        Return SLURM ID of the job as shown by squeue -r - slurm_id or
+        <slurm_id>_<slurm_array_task> for job array tasks.
+        """
+        if self.slurm_array_task is None:
+            return self.slurm_id
+        return "{}_{}".format(self.slurm_id, self.slurm_array_task)
+
+
+class SchedulerLease(models.Model):
+    """
+    Model for the leases held by the scheduler workers. The worker holding
+    the <scheduler> lease is the leader.
+
+    Parameters
+    -------
+    name: str
+        Name of the lease.
+    holder: str
+        Scheduler worker holding the lease.
+    expires: datetime
+        Time after which the lease can be taken over.
+    """
+    name = models.CharField(max_length=50, primary_key=True)
+    holder = models.CharField(max_length=100)
+    expires = models.DateTimeField()
+
+    def __str__(self):
+        return self.name
+
+
+class IntakeStatus(models.Model):
+    """
+    Model for the uploads being checked in the background before their Job
+    ID is created.
+
+    Parameters
+    -------
+    job_id: str
+        Job ID the upload will get.
+    intake_status: str
+        <queued>, <checking>, <ready> or <rejected>.
+    error: str
+        Key of views.upload_errors if the upload was rejected.
+    seqs_count: int
+        Total number of reads, known once the files are validated.
+    updated: datetime
+        Time of the last change of the status.
+    """
+    job_id = models.CharField(max_length=50, primary_key=True)
+    intake_status = models.CharField(max_length=10, default="queued")
+    error = models.CharField(max_length=20, blank=True)
+    seqs_count = models.IntegerField(null=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.job_id
+
+
+class UploadSession(models.Model):
+    """
+    Model for the resumable uploads started with the upload API, until they
+    are swept.
+
+    Parameters
+    -------
+    job_id: str
+        Job ID the upload will get.
+    token_hash: str
+        SHA-256 hex digest of the token returned to the client, which has to
+        be sent with every chunk.
+    client_ip: str
+        Address the upload was started from.
+    started: datetime
+        Time the upload was started.
+    updated: datetime
+        Time the last chunk was written.
+    """
+    job_id = models.CharField(max_length=50, primary_key=True)
+    token_hash = models.CharField(max_length=64)
+    client_ip = models.GenericIPAddressField(null=True)
+    started = models.DateTimeField(default=timezone.now, db_index=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.job_id
+
 
 class Article(models.Model):
     """
@@ -92,6 +199,13 @@ class PathSettings(models.Model):
         max_length=300,
         help_text='Must point to the same location as the above upload_path but from the HPC ITSELF. MUST CONTAIN TRAILING SLASH.'
     )
+    storage_backend = models.CharField(
+        default='local',
+        max_length=10,
+        choices=(('local', 'Local - write straight to the upload_path'),
+                 ('staging', 'Staging - write to a local directory, move complete files to the upload_path')),
+        help_text='How the uploaded files are written. Staging keeps half-written files off the HPC mount. Its local directory is set with MOTHULITY_STAGING_DIR.',
+    )
 
 
 class WebServerSettings(models.Model):
@@ -129,5 +243,28 @@ class HPCSettings(models.Model):
         )
     scheduler_interval = models.IntegerField(
         default=300,
-        help_text='Time interval (in seconds) for the scheduler. Values above 30 are recommended due to the delays in the database and SLURM communication. For changes to apply the scheduler services must be restarted.'
+        help_text='Time interval (in seconds) for the scheduler. Values above 30 are recommended due to the delays in the database and SLURM communication. Changes are picked up by the running scheduler, without restarting its services.'
+        )
+    queue_policy = models.CharField(
+        max_length=10,
+        default='fifo',
+        choices=[
+            ('fifo', 'Oldest first'),
+            ('lifo', 'Newest first'),
+            ('sjf', 'Smallest number of reads first'),
+            ('aging', 'Smallest number of reads first, with aging'),
+        ],
+        help_text='Order in which pending jobs are submitted.',
+        )
+    array_submission_minimum = models.IntegerField(
+        default=0,
+        help_text='Minimum number of jobs submitted to one partition at once to send them as one SLURM job array instead of one sbatch per job. 0 disables job arrays.',
+        )
+    scheduler_lease_time = models.IntegerField(
+        default=900,
+        help_text='Time (in seconds) after which the leader scheduler is considered dead and another scheduler worker takes over monitoring the jobs. Jobs claimed by a dead worker are released after the same time. It should be a few scheduler intervals.',
+        )
+    queue_aging_reads_per_hour = models.IntegerField(
+        default=1000000,
+        help_text='Used by the aging queue policy. For every hour of waiting a pending job is treated as if it had this many reads less, so the big jobs are not starved.',
         )
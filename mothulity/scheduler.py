@@ -0,0 +1,638 @@
+import asyncio
+import collections
+import functools
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from mothulity import fastq, metrics, storage, utils
+
+
+TRANSITION_MESSAGES = {
+    "dead": "JobID {} above retry limit. Changing its status to <dead>",
+    "pending": "JobID {} is NOT done and is NOT runnning. Will be resubmitted",
+    "done": "JobID {} is done",
+}
+
+
+def worker_name():
+    """
+    Return name of the scheduler worker running in this process.
+    """
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+def submitted_transition(job_id,
+                         in_queue,
+                         done,
+                         retry,
+                         retry_maximum_number):
+    """
+    State machine of submitted job.
+
+    Parameters
+    -------
+    job_id: str
+        Job ID.
+    in_queue: bool
+        True if the job is in squeue output, in any state, or sacct reports it
+        has not ended yet.
+    done: bool or None
+        True if the job results are present. Not checked if the job is in the
+        queue or sacct reports it failed.
+    retry: int
+        Number of resubmissions so far.
+    retry_maximum_number: int
+        Maximum number of resubmissions.
+
+    Returns
+    -------
+    Transition or None
+        New status, and new retry number if it changes, or None if the job
+        stays submitted.
+    """
+    if in_queue:
+        return None
+    if done:
+        return utils.Transition(job_id, "done", None)
+    if retry < retry_maximum_number:
+        return utils.Transition(job_id, "pending", retry + 1)
+    return utils.Transition(job_id, "dead", None)
+
+
+_sweepers = {}
+
+
+def get_sweeper(upload_path):
+    """
+    Return process-wide utils.OrphanSweeper of the upload path, so the sweep
+    continues where the previous tick stopped.
+    """
+    if upload_path not in _sweepers:
+        _sweepers[upload_path] = utils.OrphanSweeper(upload_path)
+    return _sweepers[upload_path]
+
+
+class BlockingPool:
+    """
+    Process-wide thread pool of the scheduler blocking operations. A timed out
+    operation cannot be stopped, so its thread stays busy until the function
+    returns. The pool counts the busy threads, so a tick can be skipped
+    instead of queueing behind the operations of the previous ticks.
+
+    Parameters
+    -------
+    max_workers: int
+        Number of threads.
+
+    Attributes
+    -------
+    busy: int
+        Number of operations running in the threads.
+    """
+    def __init__(self,
+                 max_workers):
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix="mothulity-scheduler")
+        self.lock = threading.Lock()
+        self.busy = 0
+
+    def call(self,
+             func):
+        with self.lock:
+            self.busy += 1
+        try:
+            return func()
+        finally:
+            with self.lock:
+                self.busy -= 1
+
+    def submit(self,
+               func):
+        """
+        Return asyncio future of the function run in the pool.
+        """
+        return asyncio.get_event_loop().run_in_executor(self.executor, self.call, func)
+
+    def saturated(self):
+        """
+        Return True if all the threads are still busy.
+        """
+        return self.busy >= self.max_workers
+
+
+_blocking_pools = {}
+
+
+def get_blocking_pool(max_workers):
+    """
+    Return process-wide BlockingPool with max_workers threads.
+    """
+    if max_workers not in _blocking_pools:
+        _blocking_pools[max_workers] = BlockingPool(max_workers)
+    return _blocking_pools[max_workers]
+
+
+class SubmissionBudget:
+    """
+    Free nodes per partition which can still be used within the tick. Each
+    admitted job takes its nodes from the budget right away, so the same free
+    nodes are never counted for two jobs and a job is submitted to exactly one
+    partition. Nodes of a failed submission are not given back - the job
+    stays pending and the next tick takes a fresh snapshot.
+
+    Parameters
+    -------
+    snapshot: utils.ClusterSnapshot
+        Snapshot of the cluster taken in the tick.
+    hpc_settings: models.HPCSettings
+        HPC settings with the minimum numbers of free nodes.
+    nodes_per_job: int, default <1>
+        Number of nodes used by one job.
+
+    Attributes
+    -------
+    partitions: list of tuple
+        Partition name and minimum number of free nodes, in the order the
+        partitions are tried.
+    """
+    def __init__(self,
+                 snapshot,
+                 hpc_settings,
+                 nodes_per_job=1):
+        self.snapshot = snapshot
+        self.nodes_per_job = nodes_per_job
+        self.partitions = [
+            ("accel", hpc_settings.free_PHIs_minimum_number),
+            ("long", hpc_settings.free_Ns_minimum_number),
+        ]
+
+    def __str__(self):
+        return ", ".join(["{} {} (minimum {})".format(partition, self.free(partition), minimum)
+                          for partition, minimum in self.partitions])
+
+    def free(self,
+             partition):
+        """
+        Return number of idle nodes in the partition.
+        """
+        return self.snapshot.nodes(partition, "idle") or 0
+
+    def admit(self):
+        """
+        Take nodes for one job from the first partition which stays above its
+        minimum of free nodes afterwards.
+
+        Returns
+        -------
+        str or None
+            Partition name or None if no partition has enough free nodes.
+        """
+        for partition, minimum in self.partitions:
+            if self.free(partition) - self.nodes_per_job >= minimum:
+                self.snapshot.allocate(partition, self.nodes_per_job)
+                return partition
+
+
+class Scheduler:
+    """
+    Asyncio engine running a single scheduler tick. The four phases - submit
+    pending jobs, check submitted jobs, close done jobs and sweep the
+    directories without JobID - run concurrently, so a slow check in one of
+    them does not hold the others.
+
+    Blocking operations (ssh commands and file system checks) run in the
+    process-wide BlockingPool, at most max_concurrency at a time and each
+    limited to timeout seconds. The ssh commands are killed after the
+    timeout, other operations are abandoned, and the tick is skipped while
+    the abandoned ones still hold all the threads. Database queries stay in
+    the event loop thread.
+
+    Parameters
+    -------
+    hpc_settings: models.HPCSettings
+        HPC settings of the site.
+    path_settings: models.PathSettings
+        Path settings of the site.
+    web_server_settings: models.WebServerSettings
+        Web-Server settings of the site.
+    max_concurrency: int, default <8>
+        Maximum number of blocking operations running at the same time.
+    timeout: float, default <120>
+        Seconds after which a blocking operation is given up.
+    worker: str, default <None>
+        Name of the scheduler worker, <hostname:pid> if not given. Every
+        worker submits the pending jobs it claimed. Only the worker holding
+        the scheduler lease - the leader - monitors, closes and sweeps.
+    lease_name: str, default <scheduler>
+        Name of the lease the leader holds.
+    """
+    def __init__(self,
+                 hpc_settings,
+                 path_settings,
+                 web_server_settings,
+                 max_concurrency=8,
+                 timeout=120,
+                 worker=None,
+                 lease_name="scheduler"):
+        self.hpc_settings = hpc_settings
+        self.path_settings = path_settings
+        self.web_server_settings = web_server_settings
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.worker = worker or worker_name()
+        self.lease_name = lease_name
+
+    def job_sshfs_dir(self,
+                      job_id):
+        """
+        Return path to the job directory on the Web-Server.
+        """
+        return "{}{}/".format(self.path_settings.upload_path,
+                              str(job_id).replace("-", "_"))
+
+    async def blocking(self,
+                       func,
+                       *args,
+                       **kwargs):
+        """
+        Run blocking function in the thread pool and return its result.
+
+        Raises
+        -------
+        asyncio.TimeoutError
+            If the function did not return within the timeout.
+        """
+        async with self.semaphore:
+            return await asyncio.wait_for(
+                self.pool.submit(functools.partial(func, *args, **kwargs)),
+                self.timeout,
+            )
+
+    async def ssh_cmd(self,
+                      cmd):
+        """
+        Run the command on the HPC via utils.ssh_cmd.
+        """
+        return await self.blocking(utils.ssh_cmd,
+                                   cmd=cmd,
+                                   machine=self.hpc_settings.hpc_name,
+                                   timeout=self.timeout)
+
+    async def take_snapshot(self):
+        """
+        Return utils.ClusterSnapshot taken with concurrent sinfo and squeue.
+        """
+        started = timezone.now()
+        sinfo_str, squeue_str = await asyncio.gather(
+            self.ssh_cmd(utils.ClusterSnapshot.sinfo_cmd),
+            self.ssh_cmd(utils.ClusterSnapshot.squeue_cmd),
+        )
+        return utils.ClusterSnapshot(sinfo_str, squeue_str, time=started)
+
+    async def account(self,
+                      snapshot,
+                      slurm_ids):
+        """
+        Add sacct state of the jobs to the snapshot with one sacct call. If
+        sacct fails the jobs are checked in the job directories instead.
+        """
+        if not slurm_ids:
+            return
+        try:
+            snapshot.account(await self.ssh_cmd(utils.render_sacct_cmd(slurm_ids)))
+        except Exception as e:
+            print("sacct failed, checking the job directories instead: {!r}".format(e))
+
+    async def gather_jobs(self,
+                          coros):
+        """
+        Run coroutines concurrently and report exceptions without stopping
+        the others.
+        """
+        for result in await asyncio.gather(*coros, return_exceptions=True):
+            if isinstance(result, Exception):
+                print("Scheduler operation failed: {!r}".format(result))
+
+    async def queue_submit(self,
+                           job_id,
+                           partition="accel"):
+        """
+        Asynchronous counterpart of utils.queue_submit, submitting the job with
+        the slurm setting of the partition it was admitted to.
+        """
+        sbatch_out = await self.ssh_cmd(
+            utils.render_queue_cmd(job_id=job_id,
+                                   hpc_path=self.path_settings.hpc_path,
+                                   slurm_setting=utils.SLURM_SETTINGS[partition]))
+        print(sbatch_out)
+        slurm_id = utils.parse_sbatch(sbatch_out)
+        if slurm_id is None:
+            return False
+        return utils.update_status(job_id,
+                                   "submitted",
+                                   old_status="pending",
+                                   slurm_id=slurm_id,
+                                   slurm_array_task=None,
+                                   slurm_submission_time=timezone.now())
+
+    async def submit_array(self,
+                           job_ids,
+                           partition):
+        """
+        Submit jobs admitted to the partition as one SLURM job array. The
+        array script is written to the upload path and removed once sbatch
+        has read it. If the submission fails the jobs stay pending for the
+        next tick.
+        """
+        script = utils.render_array_script(job_ids=job_ids,
+                                           hpc_path=self.path_settings.hpc_path,
+                                           partition=partition)
+        script_name = ".mothulity_array_{}.sh".format(uuid.uuid4().hex)
+        await self.blocking(utils.write_text,
+                            "{}{}".format(self.path_settings.upload_path, script_name),
+                            script)
+        try:
+            sbatch_out = await self.ssh_cmd(
+                "sbatch {}{}".format(self.path_settings.hpc_path, script_name))
+        finally:
+            await self.blocking(os.remove,
+                                "{}{}".format(self.path_settings.upload_path, script_name))
+        print(sbatch_out)
+        array_id = utils.parse_sbatch(sbatch_out)
+        if array_id is None:
+            return
+        submitted = timezone.now()
+        with transaction.atomic():
+            for task, job_id in enumerate(job_ids):
+                utils.update_status(job_id,
+                                    "submitted",
+                                    old_status="pending",
+                                    slurm_id=array_id,
+                                    slurm_array_task=task,
+                                    slurm_submission_time=submitted)
+        print("JobIDs {} submitted to {} as job array {}".format(
+            ", ".join(job_ids), partition, array_id))
+
+    async def submit_job(self,
+                         job_id,
+                         partition):
+        """
+        Submit pending job admitted to the partition. If the submission fails
+        the job stays pending for the next tick.
+        """
+        if await self.queue_submit(job_id, partition) is True:
+            print("JobID {} submitted to {}".format(job_id, partition))
+
+    async def submit_pending(self,
+                             snapshot):
+        """
+        Phase submitting pending jobs. Jobs are admitted one by one, in the
+        queue policy order, until the free nodes budget is used up.
+        """
+        ids = utils.claim_pending_ids(worker=self.worker,
+                                      claim_time=self.hpc_settings.scheduler_lease_time,
+                                      policy=self.hpc_settings.queue_policy,
+                                      hpc_settings=self.hpc_settings)
+        try:
+            await self.submit_claimed(ids, await snapshot)
+        finally:
+            utils.release_claims(self.worker, ids)
+
+    async def submit_claimed(self,
+                             ids,
+                             snapshot):
+        """
+        Submit the claimed jobs within the free nodes budget.
+        """
+        budget = SubmissionBudget(snapshot, self.hpc_settings)
+        print("Free nodes - {}".format(budget))
+        admitted = collections.OrderedDict()
+        for i in ids:
+            partition = budget.admit()
+            if partition is None:
+                print("\nJobID {} Status: pending. Free nodes are at the minimum - {}\n".format(i, budget))
+                break
+            admitted.setdefault(partition, []).append(i)
+        submissions = []
+        array_minimum = self.hpc_settings.array_submission_minimum
+        for partition, job_ids in admitted.items():
+            if array_minimum > 0 and len(job_ids) >= array_minimum:
+                submissions.append(self.submit_array(job_ids, partition))
+            else:
+                submissions.extend([self.submit_job(i, partition) for i in job_ids])
+        await self.gather_jobs(submissions)
+
+    async def check_submitted(self,
+                              snapshot):
+        """
+        Phase checking submitted jobs. The jobs which left the queue are
+        looked up with one sacct call. Only the ones which COMPLETED, or are
+        unknown to sacct, are checked for the results in the job directory -
+        the failed ones are resubmitted without touching the filesystem.
+        Every submitted job is evaluated with submitted_transition and all the
+        transitions are applied in one transaction. Jobs accepted by sbatch
+        after the snapshot was taken, eg by the submit phase of the same tick
+        or by another worker, are left for the next tick - they may be
+        missing from its squeue output.
+        """
+        jobs = utils.get_jobs_with_status("submitted")
+        snapshot = await snapshot
+        jobs = [i for i in jobs
+                if i.slurm_submission_time is None or i.slurm_submission_time <= snapshot.time]
+        not_in_queue = [i for i in jobs if snapshot.job(i.slurm_key()) is None]
+        await self.account(snapshot,
+                           [i.slurm_id for i in not_in_queue if i.slurm_id is not None])
+        states = {i.job_id.job_id: snapshot.accounting(i.slurm_key())
+                  for i in not_in_queue}
+        to_check = [i for i in not_in_queue
+                    if states[i.job_id.job_id] in (None, "COMPLETED")]
+        dones = await asyncio.gather(
+            *[self.blocking(utils.isdone, self.job_sshfs_dir(i.job_id), filename="*shared")
+              for i in to_check],
+            return_exceptions=True
+        )
+        dones = dict(zip([i.job_id.job_id for i in to_check], dones))
+        await self.gather_jobs([
+            self.blocking(utils.collect_array_log,
+                          self.path_settings.upload_path,
+                          i.slurm_id,
+                          i.slurm_array_task,
+                          self.job_sshfs_dir(i.job_id))
+            for i in not_in_queue if i.slurm_array_task is not None
+        ])
+        transitions = []
+        for i in jobs:
+            job_id = i.job_id.job_id
+            print("\nJobID {} Status: submitted. Retries: {}\n".format(job_id, i.retry))
+            if isinstance(dones.get(job_id), Exception):
+                print("JobID {} could not be checked: {!r}".format(job_id, dones[job_id]))
+                continue
+            if states.get(job_id) not in (None, "COMPLETED") + utils.SACCT_ACTIVE_STATES:
+                print("JobID {} ended with {}, exit code {}".format(
+                    job_id, states[job_id], snapshot.accounting(i.slurm_key(), "EXITCODE")))
+            transition = submitted_transition(
+                job_id=job_id,
+                in_queue=(job_id not in states or
+                          states[job_id] in utils.SACCT_ACTIVE_STATES),
+                done=dones.get(job_id, False),
+                retry=i.retry,
+                retry_maximum_number=self.hpc_settings.retry_maximum_number,
+            )
+            if transition is not None:
+                print(TRANSITION_MESSAGES[transition.new_status].format(job_id))
+                transitions.append(transition)
+        applied = utils.apply_transitions(transitions, old_status="submitted")
+        await self.gather_jobs([
+            self.blocking(utils.remove_except, self.job_sshfs_dir(i.job_id), fastq.PATTERNS, safety=False)
+            for i in applied if i.new_status == "pending"
+        ])
+
+    async def close_job(self,
+                        job_id):
+        """
+        Close done job if the zipped analysis is present.
+        """
+        print("\nJobID {} Status: done.\n".format(job_id))
+        job_sshfs_dir = self.job_sshfs_dir(job_id)
+        if await self.blocking(utils.isdone, job_sshfs_dir, filename='*zip'):
+            await self.blocking(utils.remove_except, job_sshfs_dir, '*zip', safety=False)
+            utils.update_status(job_id, 'closed', old_status='done')
+
+    async def close_done(self):
+        """
+        Phase closing done jobs.
+        """
+        await self.gather_jobs([self.close_job(i)
+                                for i in utils.get_ids_with_status("done")])
+
+    async def sweep_dir(self,
+                        directory):
+        """
+        Remove the directory if it is stale.
+        """
+        if await self.blocking(utils.isstale,
+                               directory,
+                               self.web_server_settings.files_upload_expiry_time):
+            print("{} is old and has no JobID. Removing it".format(directory))
+            await self.blocking(storage.get_storage(self.path_settings).remove_dir,
+                                os.path.basename(directory.rstrip("/")))
+
+    async def sweep_orphans(self):
+        """
+        Phase removing stale directories without JobID, old intake statuses
+        and upload sessions. Each tick checks the next batch of directories, so the
+        upload path is swept over a few ticks instead of all at once. Intakes
+        stuck longer than settings.MOTHULITY_INTAKE_TIMEOUT (default 3600
+        seconds) are rejected.
+        """
+        rejected = utils.reject_stale_intakes(getattr(settings, "MOTHULITY_INTAKE_TIMEOUT", 3600))
+        if rejected:
+            print("Rejected {} stale intakes".format(rejected))
+        utils.remove_old_intake_statuses(self.web_server_settings.files_upload_expiry_time)
+        utils.remove_old_upload_sessions(self.web_server_settings.files_upload_expiry_time)
+        sweeper = get_sweeper(self.path_settings.upload_path)
+        names = await self.blocking(sweeper.scan)
+        await self.gather_jobs([self.sweep_dir(i) for i in sweeper.without_entries(names)])
+
+    async def timed_phase(self,
+                          name,
+                          coro):
+        """
+        Await the phase and record its wall-time.
+        """
+        start = time.monotonic()
+        try:
+            await coro
+        finally:
+            self.phase_seconds[name] = time.monotonic() - start
+            metrics.REGISTRY.observe("mothulity_scheduler_phase_seconds",
+                                     self.phase_seconds[name],
+                                     phase=name)
+
+    async def tick(self):
+        """
+        Run all the phases concurrently. Workers other than the leader only
+        submit.
+        """
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.leader = utils.acquire_lease(self.lease_name,
+                                          self.worker,
+                                          self.hpc_settings.scheduler_lease_time)
+        snapshot = asyncio.ensure_future(self.take_snapshot())
+        phases = [self.timed_phase("submit", self.submit_pending(snapshot))]
+        if self.leader:
+            phases.extend([
+                self.timed_phase("monitor", self.check_submitted(snapshot)),
+                self.timed_phase("close", self.close_done()),
+                self.timed_phase("sweep", self.sweep_orphans()),
+            ])
+        await self.gather_jobs(phases)
+        if not snapshot.done():
+            snapshot.cancel()
+
+    def report(self,
+               tick_seconds,
+               counts):
+        """
+        Update the tick metrics, dump them for the metrics view and print
+        them as one JSON log line.
+        """
+        queue_depth = utils.get_queue_depth()
+        metrics.REGISTRY.clear_gauges("mothulity_queue_depth")
+        for status, jobs in queue_depth.items():
+            metrics.REGISTRY.set_gauge("mothulity_queue_depth", jobs, status=status)
+        metrics.REGISTRY.observe("mothulity_scheduler_tick_seconds", tick_seconds)
+        metrics.REGISTRY.set_gauge("mothulity_scheduler_last_tick_seconds", tick_seconds)
+        metrics.REGISTRY.set_gauge("mothulity_scheduler_interval_seconds",
+                                   self.hpc_settings.scheduler_interval)
+        try:
+            metrics.dump(worker=self.worker)
+        except OSError as e:
+            print("Could not write the scheduler metrics: {!r}".format(e))
+        print(json.dumps({
+            "event": "scheduler_tick",
+            "worker": self.worker,
+            "leader": self.leader,
+            "tick_seconds": round(tick_seconds, 3),
+            "overrun": tick_seconds > self.hpc_settings.scheduler_interval,
+            "phase_seconds": {k: round(v, 3) for k, v in self.phase_seconds.items()},
+            "calls": counts,
+            "queue_depth": queue_depth,
+        }, sort_keys=True))
+
+    def run(self):
+        """
+        Run the tick in a new event loop and wait for it to finish. The tick
+        is skipped if the blocking operations of the previous ticks still
+        hold all the threads.
+        """
+        self.pool = get_blocking_pool(self.max_concurrency)
+        if self.pool.saturated():
+            print(json.dumps({
+                "event": "scheduler_tick_skipped",
+                "worker": self.worker,
+                "busy_threads": self.pool.busy,
+            }, sort_keys=True))
+            return
+        loop = asyncio.new_event_loop()
+        self.phase_seconds = {}
+        counted = {"ssh": "mothulity_ssh_seconds",
+                   "isdone": "mothulity_isdone_seconds",
+                   "db": "mothulity_db_query_seconds"}
+        before = {k: metrics.REGISTRY.count(v) for k, v in counted.items()}
+        start = time.monotonic()
+        try:
+            with connection.execute_wrapper(metrics.query_timer):
+                loop.run_until_complete(self.tick())
+        finally:
+            loop.close()
+        self.report(time.monotonic() - start,
+                    {k: metrics.REGISTRY.count(v) - before[k] for k, v in counted.items()})
@@ -0,0 +1,437 @@
+import contextlib
+import copy
+import heapq
+import io
+import json
+import math
+import os
+import random
+import shlex
+import shutil
+import subprocess as sp
+import tempfile
+import time
+import uuid
+from datetime import timedelta
+from django.db.models import F
+from django.test.utils import setup_databases, teardown_databases
+from mothulity import models, scheduler, utils
+
+
+class SimulatedJob:
+    """
+    Job, or job array task, in the simulated cluster.
+    """
+    def __init__(self,
+                 slurm_key,
+                 partition,
+                 job_dir,
+                 duration,
+                 submitted):
+        self.slurm_key = slurm_key
+        self.partition = partition
+        self.job_dir = job_dir
+        self.duration = duration
+        self.submitted = submitted
+        self.started = None
+        self.state = "PENDING"
+
+
+class SimulatedCluster:
+    """
+    SLURM stand-in answering sbatch, squeue, sinfo and sacct commands in the
+    formats of mothulity/tests/sinfo.log and squeue.log. It keeps a pool of
+    idle and allocated nodes per partition and runs the jobs on a virtual
+    clock, moved forward with advance. A finished job leaves the results
+    (<mothur.job.shared> and <analysis_mothur.job.zip>) in its directory, as
+    mothulity does. Partitions are independent pools - the nodes shared by
+    partitions of the real cluster are not modelled.
+
+    Parameters
+    -------
+    sinfo_str: str
+        sinfo output with the starting nodes.
+    squeue_str: str, default <"">
+        squeue output with the starting jobs. They keep running and their
+        nodes stay allocated.
+    duration: callable, default <None>
+        Takes the job directory and returns the job run time in seconds.
+        One hour if not given.
+    failure_rate: float, default <0>
+        Probability the job ends with FAILED, without the results.
+    seed: int, default <None>
+        Seed of the failures.
+    """
+    first_slurm_id = 2000000
+
+    def __init__(self,
+                 sinfo_str,
+                 squeue_str="",
+                 duration=None,
+                 failure_rate=0,
+                 seed=None):
+        self.nodes_index = {k: v for k, v in utils.index_sinfo(sinfo_str).items()
+                            if k[1] in ("idle", "alloc")}
+        self.background = [i for i in squeue_str.split("\n")[1:] if i.strip()]
+        self.duration = duration or (lambda job_dir: 3600)
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.now = 0.0
+        self.next_slurm_id = self.first_slurm_id
+        self.queue = []
+        self.running = []
+        self.accounting = {}
+        self.busy_node_seconds = {}
+        self.commands = 0
+
+    def capacity(self,
+                 partition):
+        """
+        Return number of idle and allocated nodes of the partition.
+        """
+        return (self.nodes_index.get((partition, "idle"), 0) +
+                self.nodes_index.get((partition, "alloc"), 0))
+
+    def utilization(self,
+                    partition):
+        """
+        Return fraction of the partition nodes used by the simulated jobs
+        since the start.
+        """
+        if not self.now or not self.capacity(partition):
+            return 0.0
+        return self.busy_node_seconds.get(partition, 0) / (self.capacity(partition) * self.now)
+
+    def run(self,
+            cmd):
+        """
+        Return output of the command as the cluster would print it.
+
+        Raises
+        -------
+        subprocess.CalledProcessError
+            If the command is not known to the simulator.
+        """
+        self.commands += 1
+        words = shlex.split(cmd)
+        if words[:1] == ["sinfo"]:
+            return self.sinfo()
+        if words[:1] == ["squeue"]:
+            return self.squeue()
+        if words[:1] == ["sacct"]:
+            return self.sacct([utils.slurm_key(i) for i in words[words.index("-j") + 1].split(",")])
+        if words[:2] == ["srun", "mothulity"]:
+            setting = words[words.index("--use-slurm-setting") + 1]
+            partition = {v: k for k, v in utils.SLURM_SETTINGS.items()}[setting]
+            return self.sbatch(partition, [words[2]])
+        if words[:1] == ["sbatch"]:
+            return self.sbatch_array(words[1])
+        raise sp.CalledProcessError(127, cmd, "command not found")
+
+    def sbatch(self,
+               partition,
+               job_dirs,
+               array=False):
+        """
+        Queue the jobs, as tasks of one job array if array is True.
+        """
+        slurm_id = self.next_slurm_id
+        self.next_slurm_id += 1
+        for task, job_dir in enumerate(job_dirs):
+            key = "{}_{}".format(slurm_id, task) if array else slurm_id
+            job = SimulatedJob(key, partition, job_dir, self.duration(job_dir), self.now)
+            self.queue.append(job)
+            self.accounting[key] = job
+        self.schedule()
+        return "Submitted batch job {}".format(slurm_id)
+
+    def sbatch_array(self,
+                     script_path):
+        """
+        Submit the job array script rendered by utils.render_array_script.
+        """
+        with open(script_path) as fin:
+            lines = fin.read().split("\n")
+        partition = [i.split("=")[1] for i in lines if i.startswith("#SBATCH --partition=")][0]
+        job_dirs = [i.split(" cd ")[1].split(" ")[0] for i in lines if " cd " in i]
+        return self.sbatch(partition, job_dirs, array=True)
+
+    def schedule(self):
+        """
+        Start the queued jobs, in the submission order, on the idle nodes.
+        """
+        for job in list(self.queue):
+            if self.nodes_index.get((job.partition, "idle"), 0) > 0:
+                self.nodes_index[(job.partition, "idle")] -= 1
+                self.nodes_index[(job.partition, "alloc")] = self.nodes_index.get((job.partition, "alloc"), 0) + 1
+                job.started = self.now
+                job.state = "RUNNING"
+                self.queue.remove(job)
+                heapq.heappush(self.running, (self.now + job.duration, id(job), job))
+
+    def finish(self,
+               job):
+        self.nodes_index[(job.partition, "alloc")] -= 1
+        self.nodes_index[(job.partition, "idle")] += 1
+        if self.random.random() < self.failure_rate:
+            job.state = "FAILED"
+            return
+        job.state = "COMPLETED"
+        for i in ("mothur.job.shared", "analysis_mothur.job.zip"):
+            utils.write_text(os.path.join(job.job_dir, i), "simulated\n")
+
+    def advance(self,
+                seconds):
+        """
+        Move the virtual clock forward, finishing the jobs due and starting
+        the queued ones on the freed nodes.
+        """
+        target = self.now + seconds
+        while True:
+            next_time = self.running[0][0] if self.running else target
+            next_time = min(next_time, target)
+            for partition in {i[2].partition for i in self.running}:
+                busy = len([i for i in self.running if i[2].partition == partition])
+                self.busy_node_seconds[partition] = (self.busy_node_seconds.get(partition, 0) +
+                                                     busy * (next_time - self.now))
+            self.now = next_time
+            if not self.running or self.running[0][0] > target:
+                break
+            self.finish(heapq.heappop(self.running)[2])
+            self.schedule()
+        self.now = target
+
+    def sinfo(self):
+        lines = ["PARTITION AVAIL  TIMELIMIT  NODES  STATE NODELIST"]
+        for (partition, state), nodes in sorted(self.nodes_index.items()):
+            if nodes > 0:
+                lines.append("{:>9}    up   infinite {:>6} {:>6} sim[1-{}]".format(
+                    partition, nodes, state, nodes))
+        return "\n".join(lines) + "\n"
+
+    def squeue(self):
+        lines = ["JOBID PARTITION     NAME     USER ST       TIME  NODES NODELIST(REASON)"]
+        lines.extend(self.background)
+        for job in self.queue + [i[2] for i in self.running]:
+            elapsed = int(self.now - job.started) if job.started is not None else 0
+            lines.append("{} {:>9} mothulity mothulity {:>2} {:>10} 1 {}".format(
+                job.slurm_key,
+                job.partition,
+                "R" if job.state == "RUNNING" else "PD",
+                "{}:{:02d}:{:02d}".format(elapsed // 3600, elapsed % 3600 // 60, elapsed % 60),
+                "sim" if job.state == "RUNNING" else "(Resources)"))
+        return "\n".join(lines) + "\n"
+
+    def sacct(self,
+              slurm_ids):
+        slurm_ids = {str(i) for i in slurm_ids}
+        return "".join(["{}|{}|{}\n".format(key, job.state, "1:0" if job.state == "FAILED" else "0:0")
+                        for key, job in self.accounting.items()
+                        if str(key).split("_")[0] in slurm_ids])
+
+
+class SimulatedScheduler(scheduler.Scheduler):
+    """
+    Scheduler sending its commands to the SimulatedCluster instead of the
+    computing cluster. It leads with its own <simulator> lease, so it never
+    competes with the real scheduler workers.
+    """
+    def __init__(self,
+                 *args,
+                 cluster,
+                 **kwargs):
+        kwargs.setdefault("lease_name", "simulator")
+        super().__init__(*args, **kwargs)
+        self.cluster = cluster
+
+    async def ssh_cmd(self,
+                      cmd):
+        return self.cluster.run(cmd)
+
+    def report(self,
+               tick_seconds,
+               counts):
+        pass
+
+
+def synthetic_submissions(jobs=500,
+                          hours=24,
+                          reads_median=200000,
+                          seed=None):
+    """
+    Return list of (arrival second, number of reads) of jobs arriving at
+    random over the hours, with log-normally distributed number of reads.
+    """
+    rand = random.Random(seed)
+    return sorted([(rand.uniform(0, hours * 3600),
+                    int(rand.lognormvariate(math.log(reads_median), 1)))
+                   for i in range(jobs)])
+
+
+def add_job(seqs_count,
+            upload_path):
+    """
+    Add pending job with the number of reads and its directory and return its
+    Job ID.
+    """
+    job_id = str(uuid.uuid4())
+    job = models.JobID.objects.create(job_id=job_id)
+    models.SeqsStats.objects.create(job_id=job, seqs_count=seqs_count)
+    models.SubmissionData.objects.create(job_id=job,
+                                         job_name="simulated",
+                                         notify_email="simulated@localhost",
+                                         max_ambig=0,
+                                         max_homop=8,
+                                         min_overlap=10,
+                                         screen_criteria=95,
+                                         chop_length=250,
+                                         precluster_diffs=2,
+                                         classify_seqs_cutoff=80,
+                                         amplicon_type="16S")
+    models.JobStatus.objects.create(job_id=job, job_status="pending")
+    os.mkdir("{}{}".format(upload_path, job_id.replace("-", "_")))
+    return job_id
+
+
+def simulate(site_settings,
+             submissions,
+             sinfo_str,
+             squeue_str="",
+             policy="fifo",
+             tick=None,
+             seconds_per_read=0.01,
+             job_seconds=600,
+             failure_rate=0,
+             max_hours=None,
+             seed=None):
+    """
+    Replay the submissions against the SimulatedCluster with the scheduler
+    ticking every tick of virtual time, in a temporary upload path. The
+    simulated jobs are created in and left in the database, so it has to be
+    a throwaway one, eg the test database set up by main.
+
+    Parameters
+    -------
+    site_settings: utils.SiteSettings
+        Settings of the site. Copies are used, with the queue policy and the
+        upload path changed.
+    submissions: list of tuple
+        (arrival second, number of reads) of the jobs, eg. from
+        synthetic_submissions.
+    sinfo_str: str
+        sinfo output with the starting nodes.
+    squeue_str: str, default <"">
+        squeue output with the starting jobs.
+    policy: str, default <fifo>
+        Queue policy from utils.PENDING_POLICIES.
+    tick: int, default <None>
+        Seconds of virtual time between the ticks. HPC Settings Scheduler
+        interval if not given.
+    seconds_per_read: float, default <0.01>
+        Job run time per read.
+    job_seconds: float, default <600>
+        Job run time regardless of the number of reads.
+    failure_rate: float, default <0>
+        Probability of a job failing.
+    max_hours: float, default <None>
+        Virtual hours after which the simulation stops. Last arrival plus a
+        day if not given. It stops earlier once all the jobs are closed or
+        dead.
+    seed: int, default <None>
+        Seed of the job failures.
+
+    Returns
+    -------
+    dict
+        Throughput, turnaround and node utilization.
+    """
+    hpc_settings = copy.copy(site_settings.hpc_settings)
+    hpc_settings.queue_policy = policy
+    tick = tick or hpc_settings.scheduler_interval
+    path_settings = copy.copy(site_settings.path_settings)
+    upload_path = "{}/".format(tempfile.mkdtemp(prefix="mothulity_simulation_"))
+    path_settings.upload_path = path_settings.hpc_path = upload_path
+    reads = {}
+    cluster = SimulatedCluster(
+        sinfo_str,
+        squeue_str,
+        duration=lambda job_dir: job_seconds + seconds_per_read * reads[os.path.basename(job_dir.rstrip("/"))],
+        failure_rate=failure_rate,
+        seed=seed,
+    )
+    max_seconds = (max_hours * 3600 if max_hours is not None
+                   else (submissions[-1][0] if submissions else 0) + 24 * 3600)
+    arrivals = {}
+    finished = {}
+    start = time.monotonic()
+    try:
+        pending = list(submissions)
+        while cluster.now <= max_seconds:
+            while pending and pending[0][0] <= cluster.now:
+                arrival, seqs_count = pending.pop(0)
+                job_id = add_job(seqs_count, upload_path)
+                reads[job_id.replace("-", "_")] = seqs_count
+                arrivals[job_id] = arrival
+            with contextlib.redirect_stdout(io.StringIO()):
+                SimulatedScheduler(hpc_settings=hpc_settings,
+                                   path_settings=path_settings,
+                                   web_server_settings=site_settings.web_server_settings,
+                                   worker="simulator",
+                                   cluster=cluster).run()
+            for status in ("closed", "dead"):
+                for job_id in utils.get_ids_with_status(status):
+                    if job_id in arrivals and job_id not in finished:
+                        finished[job_id] = (status, cluster.now)
+            if not pending and len(finished) == len(arrivals):
+                break
+            cluster.advance(tick)
+            models.JobStatus.objects.filter(job_status="pending").update(
+                submission_time=F("submission_time") - timedelta(seconds=tick))
+    finally:
+        shutil.rmtree(upload_path, ignore_errors=True)
+    turnarounds = sorted([v[1] - arrivals[k] for k, v in finished.items() if v[0] == "closed"])
+    hours = cluster.now / 3600
+    return {
+        "policy": policy,
+        "jobs": len(arrivals),
+        "closed": len(turnarounds),
+        "dead": len([i for i in finished.values() if i[0] == "dead"]),
+        "simulated_hours": round(hours, 2),
+        "throughput_per_hour": round(len(turnarounds) / hours, 2) if hours else 0.0,
+        "turnaround_mean_seconds": round(sum(turnarounds) / len(turnarounds)) if turnarounds else None,
+        "turnaround_p95_seconds": round(turnarounds[int(0.95 * (len(turnarounds) - 1))]) if turnarounds else None,
+        "utilization": {i: round(cluster.utilization(i), 3)
+                        for i in sorted(cluster.busy_node_seconds)},
+        "wall_seconds": round(time.monotonic() - start, 2),
+    }
+
+
+def main(site_settings,
+         jobs=500,
+         hours=24,
+         policies=("fifo", "lifo", "sjf", "aging"),
+         seed=0):
+    """
+    Simulate a day of synthetic submissions for every policy, starting from
+    the test sinfo and squeue logs, and print the results as JSON lines. Each
+    policy is simulated in a fresh test database, so the site database is
+    only read for the settings.
+    """
+    base_dir = os.path.abspath(os.path.dirname(__file__))
+    with open("{}/tests/sinfo.log".format(base_dir)) as fin:
+        sinfo_str = fin.read()
+    with open("{}/tests/squeue.log".format(base_dir)) as fin:
+        squeue_str = fin.read()
+    submissions = synthetic_submissions(jobs=jobs, hours=hours, seed=seed)
+    for policy in policies:
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            result = simulate(site_settings,
+                              submissions,
+                              sinfo_str,
+                              squeue_str,
+                              policy=policy,
+                              seed=seed)
+        finally:
+            teardown_databases(old_config, verbosity=0)
+        print(json.dumps(result, sort_keys=True))
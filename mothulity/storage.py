@@ -0,0 +1,228 @@
+import errno
+import os
+import shutil
+import tempfile
+from django.conf import settings
+from mothulity import utils
+
+
+def job_dir(job_id):
+    """
+    Return name of the job directory of the Job ID.
+    """
+    return str(job_id).replace("-", "_")
+
+
+class LocalStorage:
+    """
+    Stores the uploaded files of the jobs straight in their directories in
+    the upload path, with in-process system calls.
+
+    Parameters
+    -------
+    root: str
+        Upload path, with trailing slash.
+    mod: int, default <0o666>
+        Permissions of the stored files.
+    """
+    def __init__(self,
+                 root,
+                 mod=0o666):
+        self.root = root
+        self.mod = mod
+
+    def path(self,
+             job_dir,
+             filename=""):
+        """
+        Return path to the job directory or to the file in it.
+        """
+        return os.path.join(self.root, job_dir, filename)
+
+    def partial_path(self,
+                     job_dir,
+                     filename):
+        """
+        Return path the file is written to until it is committed.
+        """
+        return self.path(job_dir, filename)
+
+    def partial_files(self,
+                      job_dir):
+        """
+        Return names of the files written to the job directory, committed or
+        not.
+        """
+        return sorted(i.name for i in os.scandir(self.path(job_dir)) if i.is_file())
+
+    def current_path(self,
+                     job_dir,
+                     filename):
+        """
+        Return path the file can be read from, committed or not.
+        """
+        return self.path(job_dir, filename)
+
+    def create_dir(self,
+                   job_dir):
+        """
+        Create the job directory and return its path.
+        """
+        os.mkdir(self.path(job_dir))
+        return self.path(job_dir)
+
+    def close_dir(self,
+                  job_dir):
+        """
+        Release what was kept for writing to the job directory once its
+        files are committed.
+        """
+        pass
+
+    def remove_dir(self,
+                   job_dir):
+        """
+        Remove the job directory with its files.
+
+        Returns
+        -------
+        bool
+            False if the directory could not be removed.
+        """
+        return utils.remove_dir(self.path(job_dir), safety=False) is not False
+
+    def open_write(self,
+                   job_dir,
+                   filename):
+        """
+        Return the file opened for writing at its partial path.
+        """
+        return open(self.partial_path(job_dir, filename), "w+b")
+
+    def commit(self,
+               job_dir,
+               filename):
+        """
+        Put the written file in place in the job directory and return its
+        path.
+        """
+        path = self.path(job_dir, filename)
+        os.chmod(path, self.mod)
+        return path
+
+    def discard(self,
+                job_dir,
+                filename):
+        """
+        Remove the written file.
+        """
+        try:
+            os.remove(self.partial_path(job_dir, filename))
+        except FileNotFoundError:
+            pass
+
+
+class StagingStorage(LocalStorage):
+    """
+    Stages the uploaded files in the local staging directory and moves them
+    into the job directories in the upload path, eg the sshfs mount of the
+    HPC, only when they are complete and validated. A file is copied next to
+    its destination under a hidden name first and then renamed, so a
+    half-written file never shows up on the cluster.
+
+    Parameters
+    -------
+    root: str
+        Upload path, with trailing slash.
+    staging_dir: str, default <None>
+        Local staging directory. Defaults to settings.MOTHULITY_STAGING_DIR
+        or <mothulity_staging> in the temporary directory.
+    mod: int, default <0o666>
+        Permissions of the stored files.
+    """
+    def __init__(self,
+                 root,
+                 staging_dir=None,
+                 mod=0o666):
+        super().__init__(root, mod=mod)
+        self.staging_dir = staging_dir or getattr(
+            settings,
+            "MOTHULITY_STAGING_DIR",
+            os.path.join(tempfile.gettempdir(), "mothulity_staging"),
+        )
+        os.makedirs(self.staging_dir, exist_ok=True)
+
+    def partial_path(self,
+                     job_dir,
+                     filename):
+        return os.path.join(self.staging_dir, job_dir, filename)
+
+    def partial_files(self,
+                      job_dir):
+        names = set(super().partial_files(job_dir))
+        staged = os.path.join(self.staging_dir, job_dir)
+        if os.path.isdir(staged):
+            names.update(i.name for i in os.scandir(staged) if i.is_file())
+        return sorted(names)
+
+    def current_path(self,
+                     job_dir,
+                     filename):
+        staged = self.partial_path(job_dir, filename)
+        return staged if os.path.exists(staged) else self.path(job_dir, filename)
+
+    def create_dir(self,
+                   job_dir):
+        path = super().create_dir(job_dir)
+        os.mkdir(os.path.join(self.staging_dir, job_dir))
+        return path
+
+    def close_dir(self,
+                  job_dir):
+        shutil.rmtree(os.path.join(self.staging_dir, job_dir), ignore_errors=True)
+
+    def remove_dir(self,
+                   job_dir):
+        self.close_dir(job_dir)
+        return super().remove_dir(job_dir)
+
+    def commit(self,
+               job_dir,
+               filename):
+        staged = self.partial_path(job_dir, filename)
+        path = self.path(job_dir, filename)
+        if not os.path.exists(staged):
+            return super().commit(job_dir, filename)
+        os.chmod(staged, self.mod)
+        try:
+            os.replace(staged, path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            part = self.path(job_dir, ".{}.part".format(filename))
+            shutil.copyfile(staged, part)
+            os.chmod(part, self.mod)
+            os.replace(part, path)
+            os.remove(staged)
+        return path
+
+
+BACKENDS = {
+    "local": LocalStorage,
+    "staging": StagingStorage,
+}
+
+
+def get_storage(path_settings):
+    """
+    Return the storage backend chosen in the path settings of the site.
+
+    Parameters
+    -------
+    path_settings: models.PathSettings
+
+    Returns
+    -------
+    LocalStorage or StagingStorage
+    """
+    return BACKENDS[path_settings.storage_backend](path_settings.upload_path)
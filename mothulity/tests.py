@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-from django.test import TestCase
+from django.test import TestCase, override_settings
 import unittest
 from django.urls import reverse
 from django.conf import settings
@@ -8,11 +8,24 @@ from django.utils import timezone
 import socket
 import pytz
 from time import sleep
+import time
 from io import BytesIO
 import os
+import base64
+import bz2
+import gzip
+import hashlib
+import shutil
+import subprocess as sp
+import tempfile
+import threading
 import uuid
+from glob import glob
+import Bio.SeqIO
 from random import randint
-from mothulity import views, models, forms, utils
+from django.contrib.auth.models import User
+from django.core.files.uploadhandler import StopFutureHandlers, StopUpload
+from mothulity import views, models, forms, utils, transport, scheduler, metrics, watcher, simulator, benchmark, fastq, uploadhandlers, storage
 
 base_dir = os.path.abspath(os.path.dirname(__file__))
 hostname_production = 'xe-mothulity-dizak'
@@ -198,6 +211,61 @@ class UtilsTests(TestCase):
                                             "TIME"),
                          self.TIME_2)
 
+    def test_cluster_snapshot(self):
+        """
+        Tests whether the cluster snapshot returns the same values as parsing
+        sinfo and squeue outputs directly.
+        """
+        with open(self.sinfo_file) as fin:
+            sinfo_str = fin.read()
+        with open(self.squeue_file) as fin:
+            squeue_str = fin.read()
+        snapshot = utils.ClusterSnapshot(sinfo_str, squeue_str)
+        self.assertEqual(snapshot.nodes("long", "idle"), self.long_idle_nodes)
+        self.assertEqual(utils.parse_sinfo(snapshot, "accel", "idle"),
+                         self.accel_idle_nodes)
+        self.assertEqual(utils.parse_sinfo(snapshot, "accel", "alloc"),
+                         self.accel_alloc_nodes)
+        self.assertEqual(snapshot.nodes("short", "down"), 3)
+        self.assertIsNone(snapshot.nodes("gpu", "idle"))
+        self.assertEqual(utils.parse_squeue(snapshot, self.JOBID_1, "PARTITION"),
+                         self.PARTITION_1)
+        self.assertEqual(snapshot.job(self.JOBID_2, "USER"), self.USER_2)
+        self.assertTrue(snapshot.isrunning(self.JOBID_1))
+        self.assertFalse(snapshot.isrunning(42))
+
+    def test_cluster_snapshot_allocate(self):
+        """
+        Tests whether nodes allocated within the tick are no longer idle.
+        """
+        with open(self.sinfo_file) as fin:
+            snapshot = utils.ClusterSnapshot(fin.read())
+        snapshot.allocate("accel", 2)
+        self.assertEqual(snapshot.nodes("accel", "idle"), self.accel_idle_nodes - 2)
+        self.assertEqual(snapshot.nodes("accel", "alloc"), self.accel_alloc_nodes + 2)
+
+    def test_get_pending_fingerprint(self):
+        """
+        Tests whether fingerprint changes when job becomes pending.
+        """
+        fingerprint = utils.get_pending_fingerprint()
+        self.assertEqual(fingerprint, (0, None))
+        models.JobStatus(job_id=self.j_id, job_status="pending").save()
+        self.assertNotEqual(utils.get_pending_fingerprint(), fingerprint)
+
+    def test_wait_for_work(self):
+        """
+        Tests whether utils.wait_for_work sleeps until timeout without new
+        work and wakes up early with new work.
+        """
+        fingerprint = utils.get_pending_fingerprint()
+        self.assertFalse(utils.wait_for_work(0.2, fingerprint, poll_min=0.05))
+        self.assertFalse(utils.wait_for_work(None, fingerprint))
+        models.JobStatus(job_id=self.j_id, job_status="pending").save()
+        start = timezone.now()
+        self.assertTrue(utils.wait_for_work(60, fingerprint, poll_min=0.05))
+        self.assertLess((timezone.now() - start).total_seconds(), 1)
+
     # def test_ssh_cmd(self):
     #     """
     #     Tests whether commands via ssh are successful.
@@ -241,6 +309,27 @@ class UtilsTests(TestCase):
             [],
             )
 
+    def test_remove_files(self):
+        """
+        Tests whether removed files and bytes are reported and nothing is
+        removed with safety on.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        paths = [os.path.join(tmp_dir, str(i)) for i in range(20)]
+        for i in paths:
+            with open(i, "w") as fout:
+                fout.write("12345")
+        self.assertEqual(utils.remove_files(paths + [tmp_dir], safety=True),
+                         utils.RemovalReport(21, 100 + os.lstat(tmp_dir).st_size, []))
+        self.assertEqual(len(os.listdir(tmp_dir)), 20)
+        self.assertEqual(utils.remove_files(paths + [tmp_dir], safety=False),
+                         utils.RemovalReport(20, 100, [tmp_dir]))
+        self.assertEqual(os.listdir(tmp_dir), [])
+        os.makedirs(os.path.join(tmp_dir, "sub", "subsub"))
+        open(os.path.join(tmp_dir, "sub", "subsub", "file"), "w").close()
+        self.assertEqual(utils.remove_dir(tmp_dir, safety=False), [])
+        self.assertFalse(os.path.exists(tmp_dir))
+
     def test_remove_dir_safety_off(self):
         """
         Tests whether directory is properly removed.
@@ -293,6 +382,7 @@ class UtilsTests(TestCase):
             )
 
 
+@override_settings(MOTHULITY_INTAKE_WORKERS=0)
 class ViewsResponseTests(TestCase):
     """
     Tests for the response codes.
@@ -585,3 +675,1286 @@ class FormsTest(TestCase):
         form = forms.OptionsForm(self.form_data)
         if form.is_valid():
             self.assertEqual(form.cleaned_data["job_name"], self.clean_job_name)
+
+
+class TransportTests(TestCase):
+    """
+    Tests for the pooled shell sessions with the local backend.
+    """
+    def setUp(self):
+        """
+        Sets up class level attributes for the tests.
+        """
+        self.pool = transport.TransportPool(backend="local", max_sessions=2)
+
+    def tearDown(self):
+        """
+        Closes the sessions left in the pool.
+        """
+        self.pool.close()
+
+    def test_run(self):
+        """
+        Tests whether command output is returned.
+        """
+        self.assertEqual(self.pool.run("echo foo; printf bar"), "foo\nbar")
+        self.assertEqual(self.pool.run("true"), "")
+
+    def test_run_error(self):
+        """
+        Tests whether non-zero exit status raises the same exception as
+        subprocess.check_output.
+        """
+        with self.assertRaises(sp.CalledProcessError) as ctx:
+            self.pool.run("echo foo; exit 3")
+        self.assertEqual(ctx.exception.returncode, 3)
+        self.assertEqual(ctx.exception.output, "foo\n")
+        self.assertEqual(self.pool.run("echo foo"), "foo\n")
+
+    def test_session_reused(self):
+        """
+        Tests whether consecutive commands run in the same shell process.
+        """
+        self.assertEqual(self.pool.run("echo $$"), self.pool.run("echo $$"))
+
+    def test_reconnect(self):
+        """
+        Tests whether dead session is replaced with a new one.
+        """
+        pid = self.pool.run("echo $$")
+        os.kill(int(pid), 9)
+        sleep(0.1)
+        self.assertNotEqual(self.pool.run("echo $$"), pid)
+
+    def test_timeout(self):
+        """
+        Tests whether command running too long is interrupted.
+        """
+        with self.assertRaises(sp.TimeoutExpired):
+            self.pool.run("sleep 5", timeout=0.2)
+
+    def test_timeout_default(self):
+        """
+        Tests whether the pool timeout applies to commands run without one,
+        even if they keep printing, and whether the timed out session and
+        its command are killed instead of being returned to the pool.
+        """
+        pool = transport.TransportPool(backend="local", max_sessions=1, timeout=0.5)
+        try:
+            pid = pool.run("echo $$")
+            start = time.monotonic()
+            with self.assertRaises(sp.TimeoutExpired):
+                pool.run("while true; do echo x; sleep 0.1; done")
+            self.assertLess(time.monotonic() - start, 3)
+            with self.assertRaises(ProcessLookupError):
+                os.kill(int(pid), 0)
+            self.assertNotEqual(pool.run("echo $$"), pid)
+        finally:
+            pool.close()
+
+    @override_settings(MOTHULITY_SSH_BACKEND="local")
+    def test_ssh_cmd(self):
+        """
+        Tests whether utils.ssh_cmd passes quoted commands the same way as the
+        local shell did for ssh.
+        """
+        self.assertEqual(utils.ssh_cmd('"cd {} && ls -d tests"'.format(base_dir)),
+                         "tests")
+
+
+class StubScheduler(scheduler.Scheduler):
+    """
+    Scheduler answering ssh commands with the test sinfo, squeue and sacct
+    logs instead of asking the computing cluster.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        with open("{}/tests/sinfo.log".format(base_dir)) as fin:
+            self.sinfo_str = fin.read()
+        with open("{}/tests/squeue.log".format(base_dir)) as fin:
+            self.squeue_str = fin.read()
+        with open("{}/tests/sacct.log".format(base_dir)) as fin:
+            self.sacct_str = fin.read()
+        self.sbatch_delay = 0
+        self.cmds = []
+
+    async def ssh_cmd(self, cmd):
+        self.cmds.append(cmd)
+        if cmd == utils.ClusterSnapshot.sinfo_cmd:
+            return self.sinfo_str
+        if cmd == utils.ClusterSnapshot.squeue_cmd:
+            return self.squeue_str
+        if cmd.startswith("sacct"):
+            return self.sacct_str
+        await self.blocking(sleep, self.sbatch_delay)
+        return "Submitted batch job 42"
+
+
+class JobsTestCase(TestCase):
+    """
+    Base for the tests needing site settings, temporary upload path and jobs
+    in different states.
+    """
+    def setUp(self):
+        """
+        Sets up site settings, temporary upload path and jobs in different
+        states.
+        """
+        self.upload_path = "{}/".format(tempfile.mkdtemp())
+        site = models.Site(id=randint(1, 10),
+                           domain='scheduler.test',
+                           name='mothulity')
+        site.save()
+        self.path_settings = models.PathSettings(site=site,
+                                                 upload_path=self.upload_path,
+                                                 hpc_path='/tmp/')
+        self.path_settings.save()
+        self.web_server_settings = models.WebServerSettings(site=site)
+        self.web_server_settings.save()
+        self.hpc_settings = models.HPCSettings(site=site)
+        self.hpc_settings.save()
+        self.submission_data_dict = {"job_name": "test-job",
+                                     "notify_email": "test@mail.com",
+                                     "max_ambig": 0,
+                                     "max_homop": 8,
+                                     "min_overlap": 10,
+                                     "screen_criteria": 95,
+                                     "chop_length": 250,
+                                     "precluster_diffs": 2,
+                                     "classify_seqs_cutoff": 80,
+                                     "amplicon_type": "16S"}
+        self.pending_id = self.add_job("pending")
+        self.done_id = self.add_job("done")
+        done_dir = "{}{}/".format(self.upload_path, self.done_id.replace("-", "_"))
+        os.mkdir(done_dir)
+        for i in ("1.fastq", "mothur.job.sh", "analysis_mothur.job.zip"):
+            open("{}{}".format(done_dir, i), "w").close()
+        self.done_dir = done_dir
+
+    def tearDown(self):
+        """
+        Distroys tests left-overs.
+        """
+        shutil.rmtree(self.upload_path)
+
+    def add_job(self, job_status, seqs_count=42, submission_time=None):
+        """
+        Adds job with the status to the models and returns its Job ID.
+        """
+        job_id = str(uuid.uuid4())
+        job = models.JobID(job_id=job_id)
+        job.save()
+        models.SeqsStats(job_id=job, seqs_count=seqs_count).save()
+        models.SubmissionData(job_id=job, **self.submission_data_dict).save()
+        models.JobStatus(job_id=job,
+                         job_status=job_status,
+                         submission_time=submission_time or timezone.now()).save()
+        return job_id
+
+
+
+class SchedulerTests(JobsTestCase):
+    """
+    Tests for the asyncio scheduler engine.
+    """
+    def get_scheduler(self, **kwargs):
+        return StubScheduler(hpc_settings=self.hpc_settings,
+                             path_settings=self.path_settings,
+                             web_server_settings=self.web_server_settings,
+                             **kwargs)
+
+    def test_tick(self):
+        """
+        Tests whether one tick submits pending job and closes done job.
+        """
+        sched = self.get_scheduler()
+        sched.run()
+        self.assertEqual(sched.cmds.count(utils.ClusterSnapshot.sinfo_cmd), 1)
+        self.assertEqual(sched.cmds.count(utils.ClusterSnapshot.squeue_cmd), 1)
+        self.assertEqual(len([i for i in sched.cmds if i.startswith("srun mothulity")]), 1)
+        self.assertEqual(utils.get_slurm_id(self.pending_id), 42)
+        self.assertEqual([str(i) for i in utils.get_ids_with_status("submitted")], [self.pending_id])
+        self.assertEqual([str(i) for i in utils.get_ids_with_status("closed")], [self.done_id])
+        self.assertEqual(os.listdir(self.done_dir), ["analysis_mothur.job.zip"])
+
+    def test_tick_all_transitions(self):
+        """
+        Tests whether every submitted job is evaluated within one tick.
+        """
+        done_ids = [self.add_job("submitted") for i in range(2)]
+        for i in done_ids:
+            job_dir = "{}{}/".format(self.upload_path, i.replace("-", "_"))
+            os.mkdir(job_dir)
+            open("{}mothur.job.shared".format(job_dir), "w").close()
+        retry_id = self.add_job("submitted")
+        dead_id = self.add_job("submitted")
+        utils.add_retry(dead_id, 1)
+        queued_id = self.add_job("submitted")
+        utils.add_slurm_id(queued_id, 1324233)
+        self.get_scheduler().run()
+        self.assertEqual(sorted(str(i) for i in utils.get_ids_with_status("done")),
+                         sorted(done_ids))
+        self.assertEqual(utils.get_retry(retry_id), 1)
+        self.assertIn(retry_id, [str(i) for i in utils.get_ids_with_status("pending")])
+        self.assertEqual([str(i) for i in utils.get_ids_with_status("dead")], [dead_id])
+        self.assertIn(queued_id, [str(i) for i in utils.get_ids_with_status("submitted")])
+
+    def test_tick_submitted_after_snapshot(self):
+        """
+        Tests whether job accepted by sbatch after the snapshot was taken is
+        not retried although squeue did not list it.
+        """
+        late_id = self.add_job("submitted")
+        early_id = self.add_job("submitted")
+        utils.update_status(late_id, "submitted", slurm_id=999,
+                            slurm_submission_time=timezone.now() + timezone.timedelta(minutes=1))
+        utils.update_status(early_id, "submitted", slurm_id=998,
+                            slurm_submission_time=timezone.now() - timezone.timedelta(minutes=1))
+        self.get_scheduler().run()
+        self.assertEqual(utils.get_retry(late_id), 0)
+        self.assertIn(late_id, [str(i) for i in utils.get_ids_with_status("submitted")])
+        self.assertEqual(utils.get_retry(early_id), 1)
+
+    def test_tick_status_changed_meanwhile(self):
+        """
+        Tests whether directory of the job is not cleaned for the resubmission
+        if the job status changed while it was checked.
+        """
+        raced_id = self.add_job("submitted")
+        utils.update_status(raced_id, "submitted", slurm_id=997,
+                            slurm_submission_time=timezone.now() - timezone.timedelta(minutes=1))
+        raced_dir = "{}{}/".format(self.upload_path, raced_id.replace("-", "_"))
+        os.mkdir(raced_dir)
+        for i in ("R1.fastq", "mothur.job.sh"):
+            open("{}{}".format(raced_dir, i), "w").close()
+
+        class RacingScheduler(StubScheduler):
+            async def blocking(self, func, *args, **kwargs):
+                if func is utils.isdone:
+                    utils.change_status(raced_id, "closed")
+                return await super().blocking(func, *args, **kwargs)
+
+        RacingScheduler(hpc_settings=self.hpc_settings,
+                        path_settings=self.path_settings,
+                        web_server_settings=self.web_server_settings).run()
+        self.assertEqual(utils.get_retry(raced_id), 0)
+        self.assertEqual(sorted(os.listdir(raced_dir)), ["R1.fastq", "mothur.job.sh"])
+
+    def test_index_sacct(self):
+        """
+        Tests whether sacct output is indexed by slurm's ID with the first
+        word of the state.
+        """
+        with open("{}/tests/sacct.log".format(base_dir)) as fin:
+            snapshot = utils.ClusterSnapshot(sacct_str=fin.read())
+        self.assertEqual(snapshot.accounting(1324230), "COMPLETED")
+        self.assertEqual(snapshot.accounting("1324232"), "CANCELLED")
+        self.assertEqual(snapshot.accounting(1324231, "EXITCODE"), "1:0")
+        self.assertEqual(snapshot.accounting("1324240_1"), "TIMEOUT")
+        self.assertIsNone(snapshot.accounting(1324233))
+        self.assertIsNone(snapshot.accounting(None))
+        self.assertEqual(utils.render_sacct_cmd([3, 1, 3]),
+                         "sacct -n -P -X -o JobID,State,ExitCode -j 1,3")
+
+    def test_tick_sacct(self):
+        """
+        Tests whether jobs which left the queue are judged by one sacct call
+        and only the COMPLETED ones are checked for the results.
+        """
+        job_ids = {}
+        for slurm_id in (1324230, 1324231, 1324234, 1324235):
+            job_ids[slurm_id] = self.add_job("submitted")
+            utils.add_slurm_id(job_ids[slurm_id], slurm_id)
+            job_dir = "{}{}/".format(self.upload_path, job_ids[slurm_id].replace("-", "_"))
+            os.mkdir(job_dir)
+            open("{}mothur.job.shared".format(job_dir), "w").close()
+        sched = self.get_scheduler()
+        sched.run()
+        self.assertEqual([i for i in sched.cmds if i.startswith("sacct")],
+                         [utils.render_sacct_cmd(job_ids.keys())])
+        self.assertEqual(sorted(str(i) for i in utils.get_ids_with_status("done")),
+                         sorted([job_ids[1324230], job_ids[1324235]]))
+        self.assertIn(job_ids[1324231], [str(i) for i in utils.get_ids_with_status("pending")])
+        self.assertIn(job_ids[1324234], [str(i) for i in utils.get_ids_with_status("submitted")])
+
+    def test_get_pending_ids(self):
+        """
+        Tests whether pending Job IDs are limited and ordered in one query.
+        """
+        ids = [self.add_job("pending") for i in range(3)]
+        with self.assertNumQueries(1):
+            pending_ids = utils.get_pending_ids(ids_quantity=2)
+        self.assertEqual(pending_ids, ids[::-1][:2])
+
+    def test_pending_policies(self):
+        """
+        Tests whether the queue policies order pending jobs as expected.
+        """
+        models.JobStatus.objects.all().delete()
+        now = timezone.now()
+        big_old = self.add_job("pending", 50000000, now - timezone.timedelta(hours=60))
+        small_new = self.add_job("pending", 1000, now)
+        medium = self.add_job("pending", 2000000, now - timezone.timedelta(hours=1))
+        self.assertEqual(utils.get_pending_ids(policy="fifo"), [big_old, medium, small_new])
+        self.assertEqual(utils.get_pending_ids(policy="lifo"), [small_new, medium, big_old])
+        self.assertEqual(utils.get_pending_ids(policy="sjf"), [small_new, medium, big_old])
+        self.assertEqual(utils.get_pending_ids(policy="aging", hpc_settings=self.hpc_settings),
+                         [big_old, small_new, medium])
+        self.assertEqual(utils.get_pending_ids(1, policy="aging", hpc_settings=self.hpc_settings),
+                         [big_old])
+
+    def test_aging_policy_bounded(self):
+        """
+        Tests whether the aging policy fetches only the smallest and the
+        oldest candidates.
+        """
+        models.JobStatus.objects.all().delete()
+        now = timezone.now()
+        oldest = self.add_job("pending", 50000000, now - timezone.timedelta(hours=60))
+        smallest = self.add_job("pending", 10, now)
+        for i in range(10):
+            self.add_job("pending", 3000000 + i, now - timezone.timedelta(minutes=i))
+        jobs = models.JobStatus.objects.filter(job_status="pending")
+        with self.assertNumQueries(2):
+            self.assertEqual(utils.aging_policy(jobs, 2, self.hpc_settings), [oldest, smallest])
+
+    def test_update_status(self):
+        """
+        Tests whether status is changed only from the expected old status.
+        """
+        self.assertFalse(utils.update_status(self.done_id, "closed", old_status="pending"))
+        self.assertTrue(utils.update_status(self.done_id, "closed", old_status="done", slurm_id=7))
+        self.assertEqual(utils.get_slurm_id(self.done_id), 7)
+        self.assertEqual([str(i) for i in utils.get_ids_with_status("closed")], [self.done_id])
+
+    def test_start_job(self):
+        """
+        Tests whether new job is made pending with its options, a pending
+        job gets the new options and a job already submitted is left
+        untouched.
+        """
+        job = models.JobID.objects.create(job_id=str(uuid.uuid4()))
+        self.assertTrue(utils.start_job(job, dict(self.submission_data_dict, job_name="first")))
+        self.assertTrue(utils.start_job(job, self.submission_data_dict))
+        self.assertEqual(len(utils.get_ids_with_status("pending")), 2)
+        utils.update_status(job.job_id, "submitted", slurm_id=42)
+        self.assertFalse(utils.start_job(job, dict(self.submission_data_dict, job_name="again")))
+        self.assertEqual(utils.get_slurm_id(job.job_id), 42)
+        self.assertEqual(models.JobStatus.objects.get(job_id=job).job_status, "submitted")
+        self.assertEqual(models.SubmissionData.objects.get(job_id=job).job_name, "test-job")
+
+    def test_apply_transitions(self):
+        """
+        Tests whether transitions are applied in one transaction with one
+        locking query and one query per new status and retry number, and only
+        to jobs which still have the old status.
+        """
+        ids = [self.add_job("submitted") for i in range(4)]
+        utils.change_status(ids[3], "closed")
+        transitions = [utils.Transition(ids[0], "done", None),
+                       utils.Transition(ids[1], "pending", 1),
+                       utils.Transition(ids[2], "pending", 1),
+                       utils.Transition(ids[3], "done", None)]
+        with self.assertNumQueries(5):
+            applied = utils.apply_transitions(transitions, old_status="submitted")
+        self.assertEqual(applied, transitions[:3])
+        self.assertEqual([str(i) for i in utils.get_ids_with_status("done")],
+                         [self.done_id, ids[0]])
+        self.assertEqual(utils.get_retry(ids[2]), 1)
+        self.assertEqual([str(i) for i in utils.get_ids_with_status("closed")], [ids[3]])
+
+    def test_submission_budget(self):
+        """
+        Tests whether jobs are admitted to one partition each until the
+        minimum numbers of free nodes are reached.
+        """
+        with open("{}/tests/sinfo.log".format(base_dir)) as fin:
+            snapshot = utils.ClusterSnapshot(fin.read())
+        budget = scheduler.SubmissionBudget(snapshot, self.hpc_settings)
+        admitted = [budget.admit() for i in range(60)]
+        self.assertEqual(admitted.count("accel"), 12 - self.hpc_settings.free_PHIs_minimum_number)
+        self.assertEqual(admitted.count("long"), 61 - self.hpc_settings.free_Ns_minimum_number)
+        self.assertIsNone(budget.admit())
+
+    def test_tick_budget(self):
+        """
+        Tests whether no more jobs are submitted than the free nodes allow.
+        """
+        self.hpc_settings.free_PHIs_minimum_number = 11
+        self.hpc_settings.free_Ns_minimum_number = 61
+        for i in range(3):
+            self.add_job("pending")
+        sched = self.get_scheduler()
+        sched.run()
+        self.assertEqual(len([i for i in sched.cmds if i.startswith("srun mothulity")]), 1)
+        self.assertEqual(len(utils.get_ids_with_status("pending")), 3)
+
+    def test_tick_long_partition(self):
+        """
+        Tests whether job admitted to partition long is submitted with its
+        slurm setting.
+        """
+        self.hpc_settings.free_PHIs_minimum_number = 12
+        sched = self.get_scheduler()
+        sched.run()
+        srun_cmds = [i for i in sched.cmds if i.startswith("srun mothulity")]
+        self.assertEqual(len(srun_cmds), 1)
+        self.assertIn("--use-slurm-setting long", srun_cmds[0])
+        self.assertEqual(srun_cmds[0],
+                         utils.render_queue_cmd(self.pending_id,
+                                                self.path_settings.hpc_path,
+                                                slurm_setting="long"))
+
+    def test_tick_array(self):
+        """
+        Tests whether jobs admitted together are submitted as one job array
+        and each gets its array task index.
+        """
+        self.hpc_settings.array_submission_minimum = 2
+        ids = [self.pending_id] + [self.add_job("pending") for i in range(2)]
+        sched = self.get_scheduler()
+        sched.run()
+        sbatch_cmds = [i for i in sched.cmds if i.startswith("sbatch")]
+        self.assertEqual(len(sbatch_cmds), 1)
+        self.assertFalse([i for i in sched.cmds if i.startswith("srun mothulity")])
+        tasks = {i.job_id.job_id: i.slurm_key() for i in utils.get_jobs_with_status("submitted")}
+        self.assertEqual(sorted(tasks.values()), ["42_0", "42_1", "42_2"])
+        self.assertEqual([i for i in os.listdir(self.upload_path) if i.endswith(".sh")], [])
+
+    def test_render_array_script(self):
+        """
+        Tests whether every job gets its own array task.
+        """
+        ids = [self.pending_id, self.add_job("pending")]
+        script = utils.render_array_script(ids, "/hpc/", "long")
+        self.assertIn("#SBATCH --array=0-1", script)
+        for line in utils.render_sbatch_header("long"):
+            self.assertIn(line, script)
+        self.assertIn("#SBATCH --partition=long\n", script)
+        self.assertIn("#SBATCH --exclusive\n", script)
+        self.assertIn("#SBATCH --output=/hpc/.mothulity_array_%A_%a.log\n", script)
+        self.assertNotIn("/dev/null", script)
+        for task, job_id in enumerate(ids):
+            job_dir = "/hpc/{}/".format(job_id.replace("-", "_"))
+            self.assertIn("    {}) exec > {}mothulity_array.log 2>&1; cd {} && mothulity {}".format(
+                task, job_dir, job_dir, job_dir), script)
+        self.assertIn("--run bash", script)
+        self.assertIn("--use-slurm-setting long", script)
+
+    def test_collect_array_log(self):
+        """
+        Tests whether SLURM output of the job array task is moved to the job
+        directory.
+        """
+        job_dir = "{}{}/".format(self.upload_path, self.pending_id.replace("-", "_"))
+        os.makedirs(job_dir, exist_ok=True)
+        utils.write_text("{}{}".format(self.upload_path, utils.array_log_name(42, 1)), "CANCELLED")
+        self.assertIs(utils.collect_array_log(self.upload_path, 42, 1, job_dir), True)
+        with open("{}mothulity_array.slurm.log".format(job_dir)) as fin:
+            self.assertEqual(fin.read(), "CANCELLED")
+        self.assertIs(utils.collect_array_log(self.upload_path, 42, 1, job_dir), False)
+
+    def test_snapshot_array_tasks(self):
+        """
+        Tests whether job array tasks listed by squeue -r are found.
+        """
+        with open("{}/tests/squeue.log".format(base_dir)) as fin:
+            squeue_str = fin.read()
+        squeue_str += "42_1     accel mothulit   mothulity PD 0:00      1 (Resources)\n"
+        snapshot = utils.ClusterSnapshot(squeue_str=squeue_str)
+        status = models.JobStatus.objects.get(job_id__job_id=self.pending_id)
+        status.slurm_id, status.slurm_array_task = 42, 1
+        self.assertEqual(snapshot.job(status.slurm_key()), "PD")
+        self.assertEqual(utils.parse_squeue(squeue_str, "42_1", "ST"), "PD")
+        self.assertIsNone(snapshot.job(42))
+        self.assertEqual(snapshot.job(1324233), "R")
+
+    def test_submitted_transition(self):
+        """
+        Tests the state machine of submitted job.
+        """
+        self.assertIsNone(scheduler.submitted_transition("a", True, None, 0, 1))
+        self.assertEqual(scheduler.submitted_transition("a", False, True, 5, 1),
+                         utils.Transition("a", "done", None))
+        self.assertEqual(scheduler.submitted_transition("a", False, False, 0, 1),
+                         utils.Transition("a", "pending", 1))
+        self.assertEqual(scheduler.submitted_transition("a", False, False, 1, 1),
+                         utils.Transition("a", "dead", None))
+
+    def test_tick_timeout(self):
+        """
+        Tests whether operation exceeding timeout does not hold other phases.
+        """
+        sched = self.get_scheduler(timeout=0.2)
+        sched.sbatch_delay = 2
+        sched.run()
+        self.assertEqual([str(i) for i in utils.get_ids_with_status("pending")], [self.pending_id])
+        self.assertEqual([str(i) for i in utils.get_ids_with_status("closed")], [self.done_id])
+
+    def test_tick_pool_saturated(self):
+        """
+        Tests whether tick is skipped while the operations abandoned by the
+        previous ticks hold all the threads of the pool.
+        """
+        pool = scheduler.get_blocking_pool(1)
+        release = threading.Event()
+        abandoned = pool.executor.submit(pool.call, release.wait)
+        while not pool.busy:
+            sleep(0.01)
+        sched = self.get_scheduler(max_concurrency=1)
+        sched.run()
+        self.assertEqual(sched.cmds, [])
+        release.set()
+        abandoned.result()
+        sched.run()
+        self.assertEqual([str(i) for i in utils.get_ids_with_status("submitted")], [self.pending_id])
+
+    def test_get_site_settings(self):
+        """
+        Tests whether site settings are loaded with one query, cached and
+        reloaded after they are saved.
+        """
+        site = self.hpc_settings.site
+        with self.assertNumQueries(1):
+            site_settings = utils.get_site_settings(site.domain)
+            self.assertEqual(site_settings.path_settings.upload_path, self.upload_path)
+            self.assertEqual(site_settings.hpc_settings.scheduler_interval, 300)
+        with self.assertNumQueries(0):
+            self.assertIs(utils.get_site_settings(site.domain), site_settings)
+        self.hpc_settings.scheduler_interval = 60
+        self.hpc_settings.save()
+        self.assertEqual(utils.get_site_settings(site.domain).hpc_settings.scheduler_interval, 60)
+        with override_settings(MOTHULITY_SETTINGS_CACHE_TIME=0):
+            utils.clear_site_settings()
+            with self.assertNumQueries(2):
+                utils.get_site_settings(site.domain)
+                utils.get_site_settings(site.domain)
+
+    def test_orphan_sweeper(self):
+        """
+        Tests whether sweeper walks the upload path in batches, remembers
+        where it stopped and starts over at the end.
+        """
+        orphans = sorted(["orphan_{}".format(i) for i in range(3)])
+        for i in orphans:
+            os.mkdir("{}{}".format(self.upload_path, i))
+        open("{}not_a_dir".format(self.upload_path), "w").close()
+        sweeper = utils.OrphanSweeper(self.upload_path, batch_size=2)
+        upload_path = os.path.abspath(self.upload_path)
+        batches = [sweeper.next_batch() for i in range(3)]
+        self.assertEqual(sorted(batches[0] + batches[1]),
+                         ["{}/{}/".format(upload_path, i) for i in orphans])
+        self.assertEqual(batches[2], batches[0])
+        self.assertEqual(utils.get_dirs_without_entries(self.upload_path),
+                         ["{}/{}/".format(upload_path, i) for i in orphans])
+
+    def test_scheduler_lease(self):
+        """
+        Tests whether the lease has one holder until it expires or is
+        released.
+        """
+        self.assertTrue(utils.acquire_lease("scheduler", "worker-a", 60))
+        self.assertTrue(utils.acquire_lease("scheduler", "worker-a", -1))
+        self.assertTrue(utils.acquire_lease("scheduler", "worker-b", 60))
+        self.assertFalse(utils.acquire_lease("scheduler", "worker-a", 60))
+        utils.release_lease("scheduler", "worker-b")
+        self.assertTrue(utils.acquire_lease("scheduler", "worker-a", 60))
+
+    def test_claim_pending_ids(self):
+        """
+        Tests whether workers claim disjoint pending jobs and claims are
+        released or expire.
+        """
+        for i in range(3):
+            self.add_job("pending")
+        claimed_a = utils.claim_pending_ids("worker-a", 60, ids_quantity=2)
+        claimed_b = utils.claim_pending_ids("worker-b", 60, ids_quantity=4)
+        self.assertEqual(len(claimed_a), 2)
+        self.assertEqual(len(claimed_b), 2)
+        self.assertFalse(set(claimed_a) & set(claimed_b))
+        self.assertEqual(utils.claim_pending_ids("worker-c", 60), [])
+        utils.release_claims("worker-a", claimed_a)
+        self.assertEqual(sorted(utils.claim_pending_ids("worker-c", -1)), sorted(claimed_a))
+        self.assertEqual(sorted(utils.claim_pending_ids("worker-b", 60)),
+                         sorted(claimed_a + claimed_b))
+
+    def test_tick_follower(self):
+        """
+        Tests whether worker without the lease only submits and releases its
+        claims.
+        """
+        utils.acquire_lease("scheduler", "leader", 60)
+        sched = self.get_scheduler(worker="follower")
+        sched.run()
+        self.assertFalse(sched.leader)
+        self.assertEqual([str(i) for i in utils.get_ids_with_status("submitted")], [self.pending_id])
+        self.assertEqual([str(i) for i in utils.get_ids_with_status("done")], [self.done_id])
+        self.assertFalse(models.JobStatus.objects.exclude(claimed_by=None).exists())
+
+    def test_metrics_access(self):
+        """
+        Tests whether metrics are served only to staff users and to the
+        requests with the metrics token.
+        """
+        url = reverse("mothulity:metrics")
+        self.assertEqual(self.client.get(url).status_code, 403)
+        with override_settings(MOTHULITY_METRICS_TOKEN="s3cret"):
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION="Bearer wrong").status_code, 403)
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION="Bearer s3cret").status_code, 200)
+        user = User.objects.create_user("admin", password="pass", is_staff=True)
+        self.client.force_login(user)
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_tick_metrics(self):
+        """
+        Tests whether tick dumps phases timings and queue depth for the
+        metrics view.
+        """
+        metrics_file = "{}metrics.json".format(self.upload_path)
+        sched = self.get_scheduler()
+        with override_settings(MOTHULITY_METRICS_FILE=metrics_file,
+                               MOTHULITY_METRICS_TOKEN="s3cret"):
+            sched.run()
+            response = self.client.get(reverse("mothulity:metrics"),
+                                       HTTP_AUTHORIZATION="Bearer s3cret")
+        self.assertEqual(response.status_code, 200)
+        content = response.content.decode("utf-8")
+        for phase in ("submit", "monitor", "close", "sweep"):
+            self.assertIn('mothulity_scheduler_phase_seconds_count{{phase="{}",worker="{}"}}'.format(
+                phase, sched.worker), content)
+        self.assertEqual([i for i in content.splitlines() if i.startswith("mothulity_queue_depth")],
+                         ['mothulity_queue_depth{status="closed"} 1',
+                          'mothulity_queue_depth{status="submitted"} 1'])
+        self.assertIn("mothulity_db_query_seconds_count", content)
+
+
+class MetricsTests(TestCase):
+    """
+    Tests for the scheduler metrics registry.
+    """
+    def test_render(self):
+        """
+        Tests whether histograms are rendered with cumulative buckets.
+        """
+        registry = metrics.Registry(buckets=(0.1, 1))
+        registry.observe("latency_seconds", 0.05, command="sinfo")
+        registry.observe("latency_seconds", 0.5, command="sinfo")
+        registry.observe("latency_seconds", 5, command="sinfo")
+        registry.set_gauge("queue_depth", 3, status="pending")
+        self.assertEqual(registry.count("latency_seconds"), 3)
+        self.assertEqual(registry.render().splitlines(), [
+            "# TYPE queue_depth gauge",
+            'queue_depth{status="pending"} 3',
+            "# TYPE latency_seconds histogram",
+            'latency_seconds_bucket{command="sinfo",le="0.1"} 1',
+            'latency_seconds_bucket{command="sinfo",le="1"} 2',
+            'latency_seconds_bucket{command="sinfo",le="+Inf"} 3',
+            'latency_seconds_sum{command="sinfo"} 5.55',
+            'latency_seconds_count{command="sinfo"} 3',
+        ])
+
+    def test_dump_load(self):
+        """
+        Tests whether dumped metrics are loaded back unchanged and missing
+        file gives empty registry.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, "metrics.json")
+        registry = metrics.Registry()
+        registry.observe("latency_seconds", 0.3)
+        registry.set_gauge("queue_depth", 1, status="done")
+        metrics.dump(registry, path)
+        self.assertEqual(metrics.load(path).render(), registry.render())
+        self.assertEqual(metrics.load(os.path.join(tmp_dir, "none.json")).render(), "\n")
+        shutil.rmtree(tmp_dir)
+
+    def test_dump_load_workers(self):
+        """
+        Tests whether every worker dumps its own file and the recent files
+        are merged with the worker label.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        with override_settings(MOTHULITY_METRICS_FILE=os.path.join(tmp_dir, "metrics.json")):
+            for worker, value in (("a:1", 0.3), ("b:2", 3.5), ("old:3", 1)):
+                registry = metrics.Registry()
+                registry.observe("latency_seconds", value)
+                metrics.dump(registry, worker=worker)
+            os.utime(metrics.metrics_file("old:3"), (0, 0))
+            merged = metrics.load()
+        self.assertEqual(sorted(os.listdir(tmp_dir)),
+                         ["metrics.a:1.json", "metrics.b:2.json", "metrics.old:3.json"])
+        self.assertEqual([i for i in merged.render().splitlines() if "_sum" in i],
+                         ['latency_seconds_sum{worker="a:1"} 0.3',
+                          'latency_seconds_sum{worker="b:2"} 3.5'])
+        shutil.rmtree(tmp_dir)
+
+
+class StubResultsHandler(watcher.ResultsHandler):
+    """
+    Results handler treating jobs with slurm's ID as COMPLETED instead of
+    asking sacct.
+    """
+    def completed(self, job_statuses):
+        self.sacct_calls = getattr(self, "sacct_calls", 0) + 1
+        return {i.slurm_key() for i in job_statuses if i.slurm_id is not None}
+
+
+class WatcherTests(JobsTestCase):
+    """
+    Tests for the results watcher.
+    """
+    def write(self, job_dir, filename):
+        with open(os.path.join(job_dir, filename), "w") as fout:
+            fout.write("results")
+
+    def test_polling_watcher(self):
+        """
+        Tests whether files are reported once, after they stopped changing.
+        """
+        polling = watcher.PollingWatcher(self.upload_path, interval=0, patterns=("*zip",))
+        self.assertEqual(polling.events(), [])
+        self.assertEqual(polling.events(), [(self.done_dir.rstrip("/"), "analysis_mothur.job.zip")])
+        self.assertEqual(polling.events(), [])
+
+    def test_polling_watcher_dirs(self):
+        """
+        Tests whether only the directories of the jobs waiting for the results
+        are scanned.
+        """
+        closed_id = self.add_job("closed")
+        closed_dir = "{}{}/".format(self.upload_path, closed_id.replace("-", "_"))
+        os.mkdir(closed_dir)
+        self.write(closed_dir, "analysis_mothur.job.zip")
+        handler = watcher.ResultsHandler(self.hpc_settings)
+        self.assertEqual(handler.job_dirs(), [self.done_id.replace("-", "_")])
+        polling = watcher.PollingWatcher(self.upload_path, interval=0, patterns=("*zip",),
+                                         dirs=handler.job_dirs)
+        polling.events()
+        self.assertEqual(polling.events(), [(self.done_dir.rstrip("/"), "analysis_mothur.job.zip")])
+
+    def test_inotify_watcher(self):
+        """
+        Tests whether files written to existing and new job directories are
+        reported.
+        """
+        try:
+            inotify = watcher.InotifyWatcher(self.upload_path)
+        except OSError:
+            raise unittest.SkipTest("inotify is not available")
+        self.assertIn((self.done_dir.rstrip("/"), "analysis_mothur.job.zip"), inotify.events(0))
+        new_dir = os.path.join(self.upload_path, "new_job")
+        os.mkdir(new_dir)
+        self.write(new_dir, "mothur.job.shared")
+        self.write(self.done_dir, "mothur.job.shared")
+        events = inotify.events(1) + inotify.events(0.1) + inotify.events(0.1)
+        inotify.close()
+        self.assertIn((new_dir, "mothur.job.shared"), events)
+        self.assertIn((self.done_dir.rstrip("/"), "mothur.job.shared"), events)
+
+    def test_results_handler(self):
+        """
+        Tests whether results close done job and mark completed submitted job
+        done.
+        """
+        handler = StubResultsHandler(self.hpc_settings)
+        handler([(self.done_dir, "analysis_mothur.job.zip")])
+        self.assertEqual([str(i) for i in utils.get_ids_with_status("closed")], [self.done_id])
+        self.assertEqual(os.listdir(self.done_dir), ["analysis_mothur.job.zip"])
+        running_id = self.add_job("submitted")
+        finished_ids = [self.add_job("submitted") for i in range(2)]
+        for slurm_id, job_id in enumerate(finished_ids, 1324230):
+            utils.add_slurm_id(job_id, slurm_id)
+        handler.sacct_calls = 0
+        handler([("{}{}/".format(self.upload_path, i.replace("-", "_")), "mothur.job.shared")
+                 for i in [running_id] + finished_ids])
+        self.assertEqual(handler.sacct_calls, 1)
+        self.assertEqual([str(i) for i in utils.get_ids_with_status("submitted")], [running_id])
+        self.assertEqual(sorted(str(i) for i in utils.get_ids_with_status("done")),
+                         sorted(finished_ids))
+
+
+class SimulatorTests(JobsTestCase):
+    """
+    Tests for the simulated cluster and the scheduler replay.
+    """
+    def setUp(self):
+        super().setUp()
+        with open("{}/tests/sinfo.log".format(base_dir)) as fin:
+            self.sinfo_str = fin.read()
+        with open("{}/tests/squeue.log".format(base_dir)) as fin:
+            self.squeue_str = fin.read()
+
+    def test_simulated_cluster(self):
+        """
+        Tests whether jobs wait for free nodes, run on the virtual clock and
+        leave the results.
+        """
+        cluster = simulator.SimulatedCluster("PARTITION AVAIL TIMELIMIT NODES STATE NODELIST\n"
+                                             "accel up infinite 1 idle phi1\n",
+                                             duration=lambda job_dir: 100)
+        job_dirs = ["{}job_{}/".format(self.upload_path, i) for i in range(2)]
+        for i in job_dirs:
+            os.mkdir(i)
+            self.assertEqual(cluster.run("srun mothulity {} --use-slurm-setting phi".format(i)),
+                             "Submitted batch job {}".format(cluster.next_slurm_id - 1))
+        snapshot = utils.ClusterSnapshot(cluster.run("sinfo"), cluster.run("squeue -r"))
+        self.assertEqual(snapshot.nodes("accel", "idle"), None)
+        self.assertEqual(snapshot.nodes("accel", "alloc"), 1)
+        self.assertEqual(snapshot.job(2000000), "R")
+        self.assertEqual(snapshot.job(2000001), "PD")
+        cluster.advance(150)
+        snapshot.account(cluster.run(utils.render_sacct_cmd([2000000, 2000001])))
+        self.assertEqual(snapshot.accounting(2000000), "COMPLETED")
+        self.assertEqual(snapshot.accounting(2000001), "RUNNING")
+        self.assertEqual(sorted(os.listdir(job_dirs[0])), ["analysis_mothur.job.zip", "mothur.job.shared"])
+        self.assertEqual(os.listdir(job_dirs[1]), [])
+        cluster.advance(100)
+        self.assertEqual(cluster.utilization("accel"), 200 / 250)
+
+    def test_simulate(self):
+        """
+        Tests whether replayed submissions are all closed by the scheduler
+        leading with its own lease.
+        """
+        site_settings = utils.SiteSettings(site=self.hpc_settings.site,
+                                           path_settings=self.path_settings,
+                                           web_server_settings=self.web_server_settings,
+                                           hpc_settings=self.hpc_settings)
+        self.hpc_settings.array_submission_minimum = 2
+        models.JobStatus.objects.all().delete()
+        utils.acquire_lease("scheduler", "leader", 60)
+        result = simulator.simulate(site_settings,
+                                    simulator.synthetic_submissions(jobs=20, hours=2, seed=1),
+                                    self.sinfo_str,
+                                    self.squeue_str,
+                                    policy="sjf",
+                                    seed=1)
+        self.assertEqual((result["jobs"], result["closed"], result["dead"]), (20, 20, 0))
+        self.assertGreater(result["turnaround_mean_seconds"], 600)
+        self.assertGreater(result["utilization"]["accel"], 0)
+        self.assertEqual(models.JobStatus.objects.exclude(job_status="closed").count(), 0)
+        self.assertTrue(models.SchedulerLease.objects.filter(name="scheduler", holder="leader").exists())
+
+    def test_benchmark(self):
+        """
+        Tests whether benchmark counts queries, subprocesses and cluster
+        commands of every tick and leaves the database untouched.
+        """
+        site_settings = utils.SiteSettings(site=self.hpc_settings.site,
+                                           path_settings=self.path_settings,
+                                           web_server_settings=self.web_server_settings,
+                                           hpc_settings=self.hpc_settings)
+        jobs_count = models.JobID.objects.count()
+        result = benchmark.benchmark(site_settings, 100, self.sinfo_str, self.squeue_str, ticks=2)
+        self.assertEqual(result["statuses"],
+                         {"pending": 5, "submitted": 10, "done": 5, "closed": 70, "dead": 10})
+        self.assertEqual(len(result["ticks"]), 2)
+        for tick in result["ticks"]:
+            self.assertGreater(tick["queries"], 0)
+            self.assertEqual(tick["subprocess_calls"], 0)
+            self.assertGreaterEqual(tick["cluster_commands"], 2)
+            self.assertEqual(sorted(tick["phase_seconds"]), ["close", "monitor", "submit", "sweep"])
+        self.assertEqual(models.JobID.objects.count(), jobs_count)
+        self.assertEqual([str(i) for i in utils.get_ids_with_status("pending")], [self.pending_id])
+
+
+class FastqTests(TestCase):
+    """
+    Tests for the streaming FASTQ validation and upload handler.
+    """
+    def setUp(self):
+        self.fastq_file = "{}/tests/Mock_S280_L001_R1_001.fastq".format(base_dir)
+        self.not_fastq_file = "{}/tests/not_a_fastq_file_R1.fastq".format(base_dir)
+        self.upload_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.upload_dir)
+
+    def validate(self,
+                 data,
+                 chunk_size=1000):
+        validator = fastq.FastqValidator()
+        for i in range(0, len(data), chunk_size):
+            validator.feed(data[i:i + chunk_size])
+        return validator.close()
+
+    def test_validator(self):
+        """
+        Tests whether reads are counted regardless of the chunks boundaries
+        and line endings.
+        """
+        with open(self.fastq_file, "rb") as fin:
+            data = fin.read()
+        self.assertEqual(self.validate(data), 4779)
+        self.assertEqual(self.validate(data, chunk_size=7), 4779)
+        self.assertEqual(self.validate(data.replace(b"\n", b"\r\n").rstrip()), 4779)
+
+    def test_validator_errors(self):
+        """
+        Tests whether non-FASTQ, truncated records, mismatched quality and
+        empty data raise FastqError.
+        """
+        with open(self.not_fastq_file, "rb") as fin:
+            not_fastq = fin.read()
+        for data in (not_fastq,
+                     b"@r1\nACGT\n+\nIIII\n@r2\nACGT\n",
+                     b"@r1\nACGT\n+\nIII\n",
+                     b""):
+            with self.assertRaises(fastq.FastqError):
+                self.validate(data)
+
+    def test_validator_lines(self):
+        """
+        Tests whether a line without the newline is rejected once it exceeds
+        the maximum length, and a wrong header as soon as its first byte
+        arrives.
+        """
+        validator = fastq.FastqValidator()
+        validator.lines.max_line_length = 100
+        validator.feed(b"@r1\n" + b"A" * 100)
+        with self.assertRaises(fastq.FastqError):
+            validator.feed(b"A")
+        validator = fastq.FastqValidator()
+        validator.feed(b"@r1\nACGT\n+\nIIII\n")
+        with self.assertRaises(fastq.FastqError):
+            validator.feed(b"r")
+
+    def test_upload_handler(self):
+        """
+        Tests whether the handler writes the valid file with its reads count
+        and removes the invalid one, stopping the upload.
+        """
+        with open(self.fastq_file, "rb") as fin:
+            data = fin.read()
+        handler = uploadhandlers.FastqUploadHandler(
+            storage=storage.LocalStorage(os.path.dirname(self.upload_dir)),
+            job_dir=os.path.basename(self.upload_dir),
+        )
+        with self.assertRaises(StopFutureHandlers):
+            handler.new_file("file_field", "R1.fastq", "text/plain", len(data))
+        for i in range(0, len(data), handler.chunk_size):
+            handler.receive_data_chunk(data[i:i + handler.chunk_size], i)
+        uploaded = handler.file_complete(len(data))
+        uploaded.close()
+        self.assertEqual(uploaded.reads, 4779)
+        with open(os.path.join(self.upload_dir, "R1.fastq"), "rb") as fin:
+            self.assertEqual(fin.read(), data)
+        with self.assertRaises(StopFutureHandlers):
+            handler.new_file("file_field", "R2.fastq", "text/plain", 100)
+        with self.assertRaises(StopUpload):
+            handler.receive_data_chunk(b"It is not as fastq file\n", 0)
+        self.assertEqual(os.listdir(self.upload_dir), ["R1.fastq"])
+        self.assertEqual(len(handler.errors), 1)
+
+    def test_count_reads(self):
+        """
+        Tests whether reads counted in small chunks match Biopython's
+        count, and whether broken files raise FastqError.
+        """
+        self.assertEqual(fastq.count_reads(self.fastq_file, buffer_size=100), 4779)
+        fastq_glob = "{}/tests/Mock_S280_L001_R*_001.fastq".format(base_dir)
+        self.assertEqual(utils.count_seqs(fastq_glob),
+                         sum(len(list(Bio.SeqIO.parse(i, "fastq"))) for i in glob(fastq_glob)))
+        for name, data in (("no_marker.fastq", b"@r1\nACGT\n-\nIIII\n"),
+                           ("truncated.fastq", b"@r1\nACGT\n+\nIIII\n@r2\nACGT\n"),
+                           ("no_newlines.fastq", b"@" * (fastq.MAX_LINE_LENGTH + 1))):
+            path = os.path.join(self.upload_dir, name)
+            with open(path, "wb") as fout:
+                fout.write(data)
+            with self.assertRaises(fastq.FastqError):
+                fastq.count_reads(path)
+
+    def test_compressed(self):
+        """
+        Tests whether gzip, concatenated gzip and bz2 data is validated and
+        counted like the plain one, and truncated data raises FastqError.
+        """
+        with open(self.fastq_file, "rb") as fin:
+            data = fin.read()
+        half = data.index(b"\n@", len(data) // 2) + 1
+        samples = (("gz", gzip.compress(data)),
+                   ("gz", gzip.compress(data[:half]) + gzip.compress(data[half:])),
+                   ("bz2", bz2.compress(data)))
+        for suffix, compressed in samples:
+            self.assertEqual(self.validate(compressed), 4779)
+            path = os.path.join(self.upload_dir, "R1.fastq.{}".format(suffix))
+            with open(path, "wb") as fout:
+                fout.write(compressed)
+            self.assertEqual(fastq.count_reads(path, buffer_size=1000), 4779)
+            with open(path, "wb") as fout:
+                fout.write(compressed[:len(compressed) // 2])
+            with self.assertRaises(fastq.FastqError):
+                self.validate(compressed[:len(compressed) // 2])
+            with self.assertRaises(fastq.FastqError):
+                fastq.count_reads(path)
+
+    def test_decompression_bomb(self):
+        """
+        Tests whether a small, highly compressed chunk is decompressed in
+        bounded pieces and rejected once the decompressed size exceeds the
+        limit.
+        """
+        data = b"@r1\nACGT\n+\nIIII\n" * (1 << 20)
+        for compress in (gzip.compress, bz2.compress):
+            compressed = compress(data)
+            self.assertLess(len(compressed), len(data) // 100)
+            decompressor = fastq.Decompressor(fastq.detect_codec(compressed))
+            pieces = [len(i) for i in decompressor.decompress(compressed)]
+            self.assertLessEqual(max(pieces), fastq.DECOMPRESS_CHUNK)
+            self.assertEqual(sum(pieces), len(data))
+            validator = fastq.FastqValidator(max_size=len(data) // 4)
+            with self.assertRaisesRegex(fastq.FastqError, "exceeds"):
+                validator.feed(compressed)
+            self.assertLessEqual(validator.decompressor.size,
+                                 len(data) // 4 + fastq.DECOMPRESS_CHUNK)
+
+    def test_remove_except_patterns(self):
+        """
+        Tests whether files matching any of the patterns are kept.
+        """
+        for i in ("R1.fastq", "R2.fastq.gz", "mothur.job.sh"):
+            open(os.path.join(self.upload_dir, i), "w").close()
+        utils.remove_except(self.upload_dir, fastq.PATTERNS, safety=False)
+        self.assertEqual(sorted(os.listdir(self.upload_dir)), ["R1.fastq", "R2.fastq.gz"])
+
+    def test_codec_benchmark(self):
+        """
+        Tests whether every codec is benchmarked on the same reads.
+        """
+        result = benchmark.codec_benchmark(self.fastq_file, repeat=1)
+        self.assertEqual(sorted(result), ["bz2", "gzip", "plain"])
+        self.assertEqual({i["reads"] for i in result.values()}, {4779})
+        self.assertGreater(result["gzip"]["ratio"], 1)
+
+
+@override_settings(ALLOWED_HOSTS=["scheduler.test", "testserver"],
+                   MOTHULITY_SSH_BACKEND="local",
+                   MOTHULITY_INTAKE_WORKERS=0)
+class ChunkedUploadTests(JobsTestCase):
+    """
+    Tests for the resumable chunked upload.
+    """
+    def setUp(self):
+        super().setUp()
+        with open("{}/tests/Mock_S280_L001_R1_001.fastq".format(base_dir), "rb") as fin:
+            self.data = gzip.compress(fin.read())
+        self.bin_dir = tempfile.mkdtemp()
+        utils.write_text(os.path.join(self.bin_dir, "srun"), "#!/bin/sh\nexit 0\n", mod=0o755)
+        self.path = os.environ["PATH"]
+        os.environ["PATH"] = "{}:{}".format(self.bin_dir, self.path)
+        transport.close_pools()
+
+    def tearDown(self):
+        os.environ["PATH"] = self.path
+        transport.close_pools()
+        shutil.rmtree(self.bin_dir)
+        super().tearDown()
+
+    def start(self):
+        """
+        Starts the upload and sends its token with all the following
+        requests.
+        """
+        response = self.client.post(reverse("mothulity:upload_start"))
+        self.assertEqual(response.status_code, 201)
+        self.client.defaults["HTTP_UPLOAD_TOKEN"] = response.json()["token"]
+        return response.json()["job"]
+
+    def patch(self, job, filename, data, offset, **headers):
+        return self.client.generic("PATCH",
+                                   reverse("mothulity:upload_file", args=[job, filename]),
+                                   data,
+                                   content_type="application/offset+octet-stream",
+                                   HTTP_UPLOAD_OFFSET=str(offset),
+                                   **headers)
+
+    def upload(self, job, filename, data, start=0, chunk_size=100000):
+        for offset in range(start, len(data), chunk_size):
+            response = self.patch(job, filename, data[offset:offset + chunk_size], offset)
+            self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_resume(self):
+        """
+        Tests whether chunks are appended only at the current offset, bad
+        checksums are discarded and the upload resumes from the offset.
+        """
+        job = self.start()
+        chunk = self.data[:1000]
+        checksum = "sha1 {}".format(base64.b64encode(hashlib.sha1(chunk).digest()).decode())
+        response = self.patch(job, "R1.fastq.gz", chunk, 0, HTTP_UPLOAD_CHECKSUM=checksum)
+        self.assertEqual(response["Upload-Offset"], "1000")
+        response = self.patch(job, "R1.fastq.gz", self.data[1000:2000], 1000,
+                              HTTP_UPLOAD_CHECKSUM=checksum)
+        self.assertEqual(response.status_code, 460)
+        self.assertEqual(response["Upload-Offset"], "1000")
+        self.assertEqual(self.patch(job, "R1.fastq.gz", chunk, 0).status_code, 409)
+        self.assertEqual(self.patch(job, "R1.txt", chunk, 0).status_code, 400)
+        response = self.client.head(reverse("mothulity:upload_file", args=[job, "R1.fastq.gz"]))
+        self.assertEqual(response["Upload-Offset"], "1000")
+        self.upload(job, "R1.fastq.gz", self.data, start=1000)
+        with open("{}{}/R1.fastq.gz".format(self.upload_path, job.replace("-", "_")), "rb") as fin:
+            self.assertEqual(fin.read(), self.data)
+
+    def test_finish(self):
+        """
+        Tests whether finished upload creates the Job ID with the reads of
+        both files, and non-FASTQ and unpaired files are rejected.
+        """
+        job = self.start()
+        self.upload(job, "R1.fastq.gz", self.data)
+        response = self.client.post(reverse("mothulity:upload_finish", args=[job]))
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()["status"], "rejected")
+        self.assertEqual(response.json()["error"], views.upload_errors["uneven"])
+        self.upload(job, "R2.fastq", b"It is not as fastq file\n")
+        response = self.client.post(reverse("mothulity:upload_finish", args=[job]))
+        self.assertEqual(response.json()["error"], views.upload_errors["format"])
+        self.upload(job, "R2.fastq", gzip.decompress(self.data))
+        self.client.post(reverse("mothulity:upload_finish", args=[job]))
+        response = self.client.get(reverse("mothulity:intake_status", args=[job]))
+        self.assertEqual(response.json()["status"], "ready")
+        self.assertEqual(response.json()["reads"], 2 * 4779)
+        self.assertEqual(models.SeqsStats.objects.get(job_id__job_id=job).seqs_count, 2 * 4779)
+        self.assertEqual(self.patch(job, "R3.fastq", b"@", 0).status_code, 404)
+        response = self.client.get(response.json()["options"])
+        self.assertContains(response, "Parameters to run mothulity")
+
+    def test_token(self):
+        """
+        Tests whether chunks and finish are accepted only with the token of
+        the upload.
+        """
+        job = self.start()
+        token = self.client.defaults.pop("HTTP_UPLOAD_TOKEN")
+        self.assertEqual(self.patch(job, "R1.fastq.gz", self.data[:1000], 0).status_code, 404)
+        self.assertEqual(self.patch(job, "R1.fastq.gz", self.data[:1000], 0,
+                                    HTTP_UPLOAD_TOKEN="wrong").status_code, 404)
+        self.assertEqual(self.client.post(reverse("mothulity:upload_finish", args=[job])).status_code, 404)
+        self.assertEqual(self.patch(job, "R1.fastq.gz", self.data[:1000], 0,
+                                    HTTP_UPLOAD_TOKEN=token).status_code, 200)
+
+    def test_size_limit(self):
+        """
+        Tests whether chunks making the upload larger than the limit are
+        rejected and leave the file at its offset.
+        """
+        job = self.start()
+        with override_settings(MOTHULITY_UPLOAD_MAX_BYTES=1500):
+            self.assertEqual(self.patch(job, "R1.fastq.gz", self.data[:1000], 0).status_code, 200)
+            response = self.patch(job, "R2.fastq.gz", self.data[:1000], 0)
+            self.assertEqual(response.status_code, 413)
+            self.assertEqual(response["Upload-Offset"], "0")
+            self.assertEqual(self.patch(job, "R2.fastq.gz", self.data[:500], 0).status_code, 200)
+        path = os.path.join(self.upload_path, "chunk")
+        with self.assertRaises(uploadhandlers.UploadTooLarge):
+            uploadhandlers.append_chunk(path, 0, BytesIO(b"x" * 200), max_size=100)
+        self.assertEqual(os.path.getsize(path), 0)
+
+    def test_rate_limit(self):
+        """
+        Tests whether a client may start only the allowed number of uploads
+        an hour.
+        """
+        with override_settings(MOTHULITY_UPLOAD_STARTS_PER_HOUR=2):
+            self.start()
+            self.start()
+            self.assertEqual(self.client.post(reverse("mothulity:upload_start")).status_code, 429)
+            self.assertEqual(self.client.post(reverse("mothulity:upload_start"),
+                                              REMOTE_ADDR="10.0.0.2").status_code, 201)
+        models.UploadSession.objects.update(updated=timezone.now() - timezone.timedelta(hours=2))
+        self.assertEqual(utils.remove_old_upload_sessions(60), 3)
+
+    def test_form_upload(self):
+        """
+        Tests whether the form upload returns the polling page while the
+        intake is queued and the options form once it is checked.
+        """
+        data = gzip.decompress(self.data)
+        files = [("file_field", BytesIO(data)), ("file_field", BytesIO(data))]
+        for i, (_, fin) in enumerate(files):
+            fin.name = "R{}.fastq".format(i + 1)
+        with override_settings(MOTHULITY_INTAKE_WORKERS=1):
+            response = self.client.post(reverse("mothulity:index"), {"file_field": [i for _, i in files]})
+        self.assertContains(response, "Checking your files")
+        intake_status = models.IntakeStatus.objects.get()
+        self.assertEqual(intake_status.intake_status, "queued")
+        for fin in (i for _, i in files):
+            fin.seek(0)
+        response = self.client.post(reverse("mothulity:index"), {"file_field": [i for _, i in files]})
+        self.assertContains(response, "Parameters to run mothulity")
+        self.assertEqual(models.IntakeStatus.objects.filter(intake_status="ready").count(), 1)
+
+    def test_remove_old_intake_statuses(self):
+        """
+        Tests whether only intake statuses older than the expiry time are
+        removed.
+        """
+        models.IntakeStatus.objects.create(job_id="old")
+        models.IntakeStatus.objects.create(job_id="new")
+        models.IntakeStatus.objects.filter(job_id="old").update(
+            updated=timezone.now() - timezone.timedelta(seconds=120))
+        self.assertEqual(utils.remove_old_intake_statuses(60), 1)
+        self.assertEqual([str(i) for i in models.IntakeStatus.objects.all()], ["new"])
+
+    def test_reject_stale_intakes(self):
+        """
+        Tests whether only intakes queued or checked longer than the timeout
+        are rejected.
+        """
+        for job_id, status in (("queued", "queued"),
+                               ("checking", "checking"),
+                               ("ready", "ready"),
+                               ("new", "queued")):
+            models.IntakeStatus.objects.create(job_id=job_id, intake_status=status)
+        models.IntakeStatus.objects.exclude(job_id="new").update(
+            updated=timezone.now() - timezone.timedelta(seconds=120))
+        self.assertEqual(utils.reject_stale_intakes(60), 2)
+        self.assertEqual(
+            sorted(models.IntakeStatus.objects.filter(
+                intake_status="rejected", error="intake").values_list("job_id", flat=True)),
+            ["checking", "queued"])
+        self.assertEqual(models.IntakeStatus.objects.get(job_id="new").intake_status, "queued")
+
+    def test_staging_storage(self):
+        """
+        Tests whether the staged chunks show up in the job directory only
+        when the finished upload is committed.
+        """
+        staging_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, staging_dir)
+        self.path_settings.storage_backend = "staging"
+        self.path_settings.save()
+        with override_settings(MOTHULITY_STAGING_DIR=staging_dir):
+            job = self.start()
+            job_dir = "{}{}/".format(self.upload_path, job.replace("-", "_"))
+            self.upload(job, "R1.fastq.gz", self.data)
+            self.upload(job, "R2.fastq.gz", self.data)
+            self.assertEqual(os.listdir(job_dir), [])
+            self.assertEqual(sorted(os.listdir(os.path.join(staging_dir, job.replace("-", "_")))),
+                             ["R1.fastq.gz", "R2.fastq.gz"])
+            response = self.client.post(reverse("mothulity:upload_finish", args=[job]))
+        self.assertEqual(response.json()["status"], "ready")
+        self.assertEqual(sorted(os.listdir(job_dir)), ["R1.fastq.gz", "R2.fastq.gz"])
+        self.assertEqual(os.listdir(staging_dir), [])
+        self.assertEqual(os.stat("{}R1.fastq.gz".format(job_dir)).st_mode & 0o777, 0o666)
+
+    def test_storage_commit(self):
+        """
+        Tests whether a staged file is committed under its name only once
+        complete and discarded files leave nothing behind.
+        """
+        staging_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, staging_dir)
+        job_storage = storage.StagingStorage(self.upload_path, staging_dir=staging_dir)
+        job_storage.create_dir("job")
+        for filename in ("R1.fastq", "R2.fastq"):
+            with job_storage.open_write("job", filename) as fout:
+                fout.write(b"@r1\nACGT\n+\nIIII\n")
+        self.assertEqual(job_storage.partial_files("job"), ["R1.fastq", "R2.fastq"])
+        self.assertEqual(os.listdir(job_storage.path("job")), [])
+        job_storage.commit("job", "R1.fastq")
+        job_storage.discard("job", "R2.fastq")
+        self.assertEqual(os.listdir(job_storage.path("job")), ["R1.fastq"])
+        self.assertTrue(job_storage.remove_dir("job"))
+        self.assertEqual(os.listdir(staging_dir), [])
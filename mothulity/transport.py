@@ -0,0 +1,284 @@
+import atexit
+import os
+import queue
+import select
+import shlex
+import signal
+import subprocess as sp
+import tempfile
+import threading
+import time
+import uuid
+from django.conf import settings
+
+
+SSH_OPTIONS = [
+    "-o", "BatchMode=yes",
+    "-o", "ControlMaster=auto",
+    "-o", "ControlPath={}/mothulity-ssh-%r@%h:%p".format(tempfile.gettempdir()),
+    "-o", "ControlPersist=600",
+    "-o", "ServerAliveInterval=30",
+]
+
+BACKENDS = {
+    "ssh": lambda machine: ["ssh"] + SSH_OPTIONS + [machine, "sh"],
+    "local": lambda machine: ["sh"],
+}
+
+
+class SessionClosed(Exception):
+    """
+    Shell session ended before the command was sent.
+    """
+    pass
+
+
+class ShellSession:
+    """
+    Long-lived shell, local or remote, which runs commands sent to its stdin
+    one after another. The end of each command output is marked with a random
+    marker followed by the command exit status. The shell is started in its
+    own process group, so closing it kills the commands it started too.
+
+    Parameters
+    -------
+    argv: list of str
+        Command starting the shell, eg. <["ssh", "headnode", "sh"]>.
+    """
+    def __init__(self,
+                 argv):
+        self.argv = argv
+        self.marker = uuid.uuid4().hex
+        self.proc = sp.Popen(argv,
+                             stdin=sp.PIPE,
+                             stdout=sp.PIPE,
+                             bufsize=0,
+                             start_new_session=True)
+
+    def alive(self):
+        """
+        Return True if the shell process is still running.
+        """
+        return self.proc.poll() is None
+
+    def close(self):
+        """
+        Stop the shell process and the commands it started.
+        """
+        try:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.proc.wait()
+        self.proc.stdin.close()
+        self.proc.stdout.close()
+
+    def run(self,
+            cmd,
+            timeout=None):
+        """
+        Run the command in a subshell and return its exit status and output.
+
+        Parameters
+        -------
+        cmd: str
+            Command to run.
+        timeout: float, default <None>
+            Seconds to wait for the command to finish, no matter how much
+            output it sends meanwhile. The session is closed if the command
+            does not finish in time.
+
+        Returns
+        -------
+        tuple of int and str
+            Exit status and output of the command.
+
+        Raises
+        -------
+        SessionClosed
+            If the shell ended before the command was sent. It is safe to
+            retry the command in another session then.
+        subprocess.CalledProcessError
+            If the shell ended while the command was running.
+        subprocess.TimeoutExpired
+            If the command did not finish within the timeout.
+        """
+        if not self.alive():
+            raise SessionClosed()
+        script = "( {} ) </dev/null\nprintf '\\n{} %d\\n' $?\n".format(cmd, self.marker)
+        try:
+            self.proc.stdin.write(script.encode("utf-8"))
+        except (BrokenPipeError, ValueError):
+            raise SessionClosed()
+        end = "\n{} ".format(self.marker).encode("utf-8")
+        fd = self.proc.stdout.fileno()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        out = b""
+        pos = -1
+        while True:
+            left = None if deadline is None else max(0, deadline - time.monotonic())
+            ready, _, _ = select.select([fd], [], [], left)
+            if not ready:
+                self.close()
+                raise sp.TimeoutExpired(cmd, timeout)
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                self.close()
+                raise sp.CalledProcessError(255, cmd, out.decode("utf-8"))
+            out += chunk
+            if pos == -1:
+                pos = out.find(end, max(0, len(out) - len(chunk) - len(end)))
+            if pos != -1 and out.endswith(b"\n"):
+                return (int(out[pos + len(end):].split()[0]),
+                        out[:pos].decode("utf-8"))
+
+
+class TransportPool:
+    """
+    Pool of long-lived shell sessions, at most max_sessions per machine. The
+    ssh sessions to the same machine share one multiplexed connection, so only
+    the first one pays for the handshake. Sessions which died are replaced
+    with new ones on the next command. A session whose command timed out or
+    failed is killed and never returned to the pool.
+
+    Parameters
+    -------
+    backend: str, default <ssh>
+        Name of the session backend from BACKENDS. The <local> backend runs
+        the commands in a local shell and stands in for the cluster in tests.
+    max_sessions: int, default <4>
+        Maximum number of concurrent sessions per machine.
+    timeout: float, default <300>
+        Seconds to wait for a command run without its own timeout.
+    """
+    def __init__(self,
+                 backend="ssh",
+                 max_sessions=4,
+                 timeout=300):
+        self.backend = backend
+        self.max_sessions = max_sessions
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.slots = {}
+
+    def _machine_slots(self,
+                       machine):
+        with self.lock:
+            if machine not in self.slots:
+                self.idle[machine] = queue.LifoQueue()
+                self.slots[machine] = threading.BoundedSemaphore(self.max_sessions)
+            return self.idle[machine], self.slots[machine]
+
+    def run(self,
+            cmd,
+            machine="headnode",
+            timeout=None):
+        """
+        Run the command on the machine in one of the pooled sessions.
+
+        Parameters
+        -------
+        cmd: str
+            Command to run.
+        machine: str, default <headnode>
+            Machine name on which command takes place.
+        timeout: float, default <None>
+            Seconds to wait for the command to finish. The timeout of the
+            pool if None.
+
+        Returns
+        -------
+        str
+            Command output.
+
+        Raises
+        -------
+        subprocess.CalledProcessError
+            If the command exit status is non-zero. Like with ssh, the status
+            is <255> if the session could not be started or was lost.
+        subprocess.TimeoutExpired
+            If the command did not finish within the timeout.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        idle, slots = self._machine_slots(machine)
+        slots.acquire()
+        try:
+            while True:
+                try:
+                    session = idle.get_nowait()
+                    reused = True
+                except queue.Empty:
+                    session = ShellSession(BACKENDS[self.backend](machine))
+                    reused = False
+                try:
+                    status, out = session.run(cmd, timeout=timeout)
+                except SessionClosed:
+                    session.close()
+                    if reused:
+                        continue
+                    raise sp.CalledProcessError(255, cmd)
+                except BaseException:
+                    session.close()
+                    raise
+                idle.put(session)
+                break
+        finally:
+            slots.release()
+        if status != 0:
+            raise sp.CalledProcessError(status, cmd, out)
+        return out
+
+    def close(self):
+        """
+        Close all the idle sessions.
+        """
+        with self.lock:
+            for idle in self.idle.values():
+                while True:
+                    try:
+                        idle.get_nowait().close()
+                    except queue.Empty:
+                        break
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(backend=None):
+    """
+    Return process-wide TransportPool of the backend. The backend defaults to
+    settings.MOTHULITY_SSH_BACKEND or <ssh> if not set. Commands run without
+    their own timeout wait settings.MOTHULITY_SSH_TIMEOUT seconds (default
+    300).
+    """
+    if backend is None:
+        backend = getattr(settings, "MOTHULITY_SSH_BACKEND", "ssh")
+    with _pools_lock:
+        if backend not in _pools:
+            _pools[backend] = TransportPool(
+                backend=backend,
+                max_sessions=getattr(settings, "MOTHULITY_SSH_MAX_SESSIONS", 4),
+                timeout=getattr(settings, "MOTHULITY_SSH_TIMEOUT", 300),
+            )
+        return _pools[backend]
+
+
+def remote_cmd(cmd):
+    """
+    Return the command as the remote shell received it from
+    <ssh machine cmd> run in a local shell - split into words by the local
+    shell and joined with spaces by ssh.
+    """
+    try:
+        return " ".join(shlex.split(cmd))
+    except ValueError:
+        return cmd
+
+
+@atexit.register
+def close_pools():
+    for pool in _pools.values():
+        pool.close()
@@ -0,0 +1,286 @@
+import base64
+import fcntl
+import hashlib
+import os
+from django.conf import settings
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers, StopUpload
+from django.core.files.uploadedfile import UploadedFile
+from mothulity import fastq
+
+
+def upload_max_bytes():
+    """
+    Return the limit of all the files of one upload,
+    settings.MOTHULITY_UPLOAD_MAX_BYTES (default 10 GiB).
+    """
+    return getattr(settings, "MOTHULITY_UPLOAD_MAX_BYTES", 10 * 1024 ** 3)
+
+
+def fastq_max_bytes():
+    """
+    Return the limit of the decompressed data of one FASTQ file -
+    fastq.MAX_COMPRESSION_RATIO times the upload limit.
+    """
+    return upload_max_bytes() * fastq.MAX_COMPRESSION_RATIO
+
+
+class FastqUploadedFile(UploadedFile):
+    """
+    File written by FastqUploadHandler to the job directory.
+
+    Attributes
+    -------
+    reads: int
+        Number of reads in the file.
+    path: str
+        Path to the file in the job directory.
+    """
+    def __init__(self,
+                 file,
+                 name,
+                 content_type,
+                 size,
+                 charset,
+                 reads,
+                 path,
+                 content_type_extra=None):
+        super().__init__(file, name, content_type, size, charset, content_type_extra)
+        self.reads = reads
+        self.path = path
+
+    def temporary_file_path(self):
+        return self.path
+
+
+class FastqUploadHandler(FileUploadHandler):
+    """
+    Writes the uploaded files in chunks with the storage backend, validating
+    the FASTQ records and counting the reads while the bytes arrive. The
+    upload is stopped on the first invalid record, without transferring the
+    rest of the file. Valid files are committed to the job directory as soon
+    as they are complete.
+
+    Parameters
+    -------
+    request: HTTP.request
+    storage: storage.LocalStorage
+        Storage backend of the site.
+    job_dir: str
+        Name of the existing job directory the files are written to.
+
+    Attributes
+    -------
+    errors: list of str
+        File names and their FASTQ errors.
+    """
+    def __init__(self,
+                 request=None,
+                 storage=None,
+                 job_dir=None):
+        super().__init__(request)
+        self.storage = storage
+        self.job_dir = job_dir
+        self.errors = []
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.file_name = os.path.basename(self.file_name)
+        self.file = self.storage.open_write(self.job_dir, self.file_name)
+        self.validator = fastq.FastqValidator(fastq_max_bytes())
+        raise StopFutureHandlers()
+
+    def reject(self,
+               error):
+        """
+        Remove the current file and stop the upload. The rest of the request
+        body is not read - the connection is closed after the error page is
+        sent back.
+        """
+        self.errors.append("{}: {}".format(self.file_name, error))
+        self.file.close()
+        self.storage.discard(self.job_dir, self.file_name)
+        raise StopUpload(connection_reset=True)
+
+    def receive_data_chunk(self,
+                           raw_data,
+                           start):
+        try:
+            self.validator.feed(raw_data)
+        except fastq.FastqError as e:
+            self.reject(e)
+        self.file.write(raw_data)
+
+    def file_complete(self,
+                      file_size):
+        try:
+            reads = self.validator.close()
+        except fastq.FastqError as e:
+            self.reject(e)
+        self.file.flush()
+        path = self.storage.commit(self.job_dir, self.file_name)
+        self.file.seek(0)
+        uploaded = FastqUploadedFile(file=self.file,
+                                     name=self.file_name,
+                                     content_type=self.content_type,
+                                     size=file_size,
+                                     charset=self.charset,
+                                     reads=reads,
+                                     path=path,
+                                     content_type_extra=self.content_type_extra)
+        return uploaded
+
+    def upload_interrupted(self):
+        if hasattr(self, "file") and not self.file.closed:
+            self.file.close()
+            self.storage.discard(self.job_dir, self.file_name)
+
+
+class UploadConflict(Exception):
+    """
+    Chunk does not start at the current size of the file or the file is
+    being written by another request.
+
+    Attributes
+    -------
+    offset: int
+        Current size of the file.
+    """
+    def __init__(self,
+                 offset):
+        super().__init__("Upload is at offset {}".format(offset))
+        self.offset = offset
+
+
+class ChecksumMismatch(Exception):
+    """
+    Chunk does not match its checksum or is shorter than declared.
+    """
+    pass
+
+
+class UploadTooLarge(Exception):
+    """
+    Chunk would make the file larger than allowed.
+    """
+    pass
+
+
+def parse_checksum(header):
+    """
+    Return the hash object and expected digest from the tus-style checksum
+    header, eg <sha1 Kq5sNclPz7QV2+lfQIuc6R7oRu0=>.
+
+    Parameters
+    -------
+    header: str
+        Algorithm name and base64 encoded digest separated by space.
+
+    Returns
+    -------
+    tuple
+        (hashlib hash object, bytes digest).
+
+    Raises
+    -------
+    ValueError
+        If the algorithm is not supported or the digest is not base64.
+    """
+    algorithm, digest = header.split()
+    if algorithm not in hashlib.algorithms_guaranteed:
+        raise ValueError("Unsupported checksum algorithm {}".format(algorithm))
+    return hashlib.new(algorithm), base64.b64decode(digest, validate=True)
+
+
+def upload_offset(path):
+    """
+    Return the number of bytes of the file already uploaded.
+    """
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+def append_chunk(path,
+                 offset,
+                 stream,
+                 length=None,
+                 checksum=None,
+                 chunk_size=64 * 1024,
+                 mod=0o666,
+                 max_size=None):
+    """
+    Append the chunk of the file read from the stream, if it starts at the
+    current end of the file. The file is locked while the chunk is written,
+    and truncated back to the offset if the chunk turns out to be short, to
+    not match the checksum or to exceed max_size, so a broken chunk can
+    simply be sent again.
+
+    Parameters
+    -------
+    path: str
+        Path to the uploaded file.
+    offset: int
+        Position of the chunk in the file.
+    stream: file-like
+        Stream with the chunk, eg HTTP.request.
+    length: int, default <None>
+        Declared length of the chunk.
+    checksum: str, default <None>
+        Tus-style checksum of the chunk, see parse_checksum.
+    chunk_size: int, default <65536>
+        Size of the pieces the chunk is read in.
+    mod: int, default <0o666>
+        Permissions of the created file.
+    max_size: int, default <None>
+        Maximum size of the file. Unlimited if None.
+
+    Returns
+    -------
+    int
+        New offset.
+
+    Raises
+    -------
+    UploadConflict
+        If the offset is not the current size of the file or another chunk
+        is being written.
+    ChecksumMismatch
+        If the chunk is short or does not match the checksum.
+    UploadTooLarge
+        If the file would be larger than max_size.
+    ValueError
+        If the checksum header is malformed.
+    """
+    digest = parse_checksum(checksum) if checksum else None
+    if max_size is not None and offset + (length or 0) > max_size:
+        raise UploadTooLarge("Upload is limited to {} bytes".format(max_size))
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, mod)
+    with os.fdopen(fd, "wb") as fout:
+        try:
+            fcntl.flock(fout, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise UploadConflict(upload_offset(path))
+        end = fout.seek(0, os.SEEK_END)
+        if end != offset:
+            raise UploadConflict(end)
+        written = 0
+        try:
+            for data in iter(lambda: stream.read(chunk_size), b""):
+                written += len(data)
+                if max_size is not None and offset + written > max_size:
+                    raise UploadTooLarge("Upload is limited to {} bytes".format(max_size))
+                fout.write(data)
+                if digest:
+                    digest[0].update(data)
+            if length is not None and written != length:
+                raise ChecksumMismatch("Got {} of {} bytes".format(written, length))
+            if digest and digest[0].digest() != digest[1]:
+                raise ChecksumMismatch("Chunk does not match its {} checksum".format(digest[0].name))
+        except BaseException:
+            fout.flush()
+            fout.truncate(offset)
+            raise
+    if offset == 0:
+        os.chmod(path, mod)
+    return offset + written
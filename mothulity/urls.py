@@ -5,6 +5,11 @@ from . import views
 app_name = "mothulity"
 
 urlpatterns = [url(r"^$", views.index, name="index"),
+               url(r"^upload$", views.upload_start, name="upload_start"),
+               url(r"^upload/(?P<job>[0-9a-f-]{36})$", views.upload_finish, name="upload_finish"),
+               url(r"^upload/(?P<job>[0-9a-f-]{36})/(?P<filename>[^/]+)$", views.upload_file, name="upload_file"),
+               url(r"^intake/(?P<job>[0-9a-f-]{36})$", views.intake_status, name="intake_status"),
                url(r"^submit/(?P<job>.+)$", views.submit, name="submit"),
                url(r"^status/(?P<job>.+)$", views.status, name="status"),
-               url(r"^wiki/(?P<title>.+)$", views.wiki, name="wiki")]
+               url(r"^wiki/(?P<title>.+)$", views.wiki, name="wiki"),
+               url(r"^metrics$", views.prometheus_metrics, name="metrics")]
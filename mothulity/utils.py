@@ -1,17 +1,27 @@
-import subprocess as sp
 from glob import glob
-import subprocess as sp
+import collections
 import os
+from concurrent.futures import ThreadPoolExecutor
 from skbio.io import sniff
 import Bio.SeqIO as sio
 import math
+import time
 from fnmatch import fnmatch
 import pytz
 import django
+import django.utils.timezone
 from django.conf import settings
+from datetime import timedelta
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, Max, Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.shortcuts import get_object_or_404
 from django.forms.models import model_to_dict
+from mothulity import fastq
+from mothulity import metrics
 from mothulity import models
+from mothulity import transport
 
 
 class ParserError(Exception):
@@ -41,6 +51,26 @@ def write_file(input_file,
             fout.write(chunk)
 
 
+def write_text(path,
+               text,
+               mod=0o644):
+    """
+    Saves text to the file with desired permissions.
+
+    Parameters
+    -------
+    path: str
+        Path to file save.
+    text: str
+        Content of the file.
+    mod: int, default <0o644>
+        Permissions of the file.
+    """
+    with open(path, "w") as fout:
+        fout.write(text)
+    os.chmod(path, mod)
+
+
 def chmod_file(input_file,
                mod=400):
     """
@@ -52,11 +82,9 @@ def chmod_file(input_file,
     input_file: str
         Path to input file.
     mod: int or str, default <400>
-        Desired permissions of the input_file
+        Desired permissions of the input_file, as octal digits.
     """
-    sp.check_output("chmod {} {}".format(mod,
-                                         input_file),
-                    shell=True).decode('utf-8')
+    os.chmod(input_file, int(str(mod), 8))
 
 
 def convert_size(size_bytes):
@@ -90,8 +118,9 @@ def parse_sinfo(input_str,
 
     Parameters
     -------
-    input_str: str
-        Output of the sinfo command.
+    input_str: str or ClusterSnapshot
+        Output of the sinfo command. If ClusterSnapshot is passed, the value
+        is looked up in its index instead of parsing the output again.
     partition: str
         Partition of desired nodes.
     state: str
@@ -102,6 +131,8 @@ def parse_sinfo(input_str,
     int
         Number of nodes in desired state and partition.
     """
+    if isinstance(input_str, ClusterSnapshot):
+        return input_str.nodes(partition, state)
     s_line = [i for i in input_str.split("\n") if partition in i and state in i]
     if len(s_line) > 1:
         raise ParserError("""Found more than one line matching. Check if sinfo
@@ -122,8 +153,9 @@ def parse_squeue(input_str,
 
     Parameters
     -------
-    input_str: str
-        Output of the squeue command.
+    input_str: str or ClusterSnapshot
+        Output of the squeue command. If ClusterSnapshot is passed, the value
+        is looked up in its index instead of parsing the output again.
     slurm_id: str or int
         slurm's ID of submitted job.
     key: str or int
@@ -136,42 +168,325 @@ def parse_squeue(input_str,
     None
         Returns None if record not found.
     """
+    if isinstance(input_str, ClusterSnapshot):
+        return input_str.job(slurm_id, key)
     s_line = [i for i in input_str.split("\n") if str(slurm_id) in i]
     if len(s_line) > 1:
         raise ParserError("""Found more than one line matching. Check if squeue
               command output has not been changed.""")
     elif len(s_line) == 0:
         return None
-    cols_vals = {"JOBID": int(s_line[0].split()[0]),
+    cols_vals = {"JOBID": slurm_key(s_line[0].split()[0]),
                  "PARTITION": str(s_line[0].split()[1]),
                  "NAME": str(s_line[0].split()[2]),
                  "USER": str(s_line[0].split()[3]),
                  "ST": str(s_line[0].split()[4]),
                  "TIME": str(s_line[0].split()[5]),
                  "NODES": int(s_line[0].split()[6])}
-    if cols_vals["JOBID"] == int(slurm_id):
+    if cols_vals["JOBID"] == slurm_key(slurm_id):
         return cols_vals[key]
 
 
+def index_sinfo(input_str):
+    """
+    Index sinfo command output by partition and state.
+
+    Parameters
+    -------
+    input_str: str
+        Output of the sinfo command.
+
+    Returns
+    -------
+    dict
+        Number of nodes keyed by (partition, state) tuple. The default
+        partition marker and the node state flags are stripped, so <short*>
+        and <down*> become <short> and <down>. Lines with the same partition
+        and state are summed.
+    """
+    nodes_index = {}
+    for line in input_str.split("\n"):
+        cols = line.split()
+        if len(cols) < 5 or cols[0] == "PARTITION":
+            continue
+        try:
+            nodes = int(cols[3])
+        except ValueError:
+            raise ParserError("""Could not read the number of nodes. Check if
+                  sinfo command output has not been changed.""")
+        key = (cols[0].rstrip("*"), cols[4].rstrip("*~#!%$@^-+"))
+        nodes_index[key] = nodes_index.get(key, 0) + nodes
+    return nodes_index
+
+
+def index_squeue(input_str):
+    """
+    Index squeue command output by the slurm's ID of the job.
+
+    Parameters
+    -------
+    input_str: str
+        Output of the squeue command.
+
+    Returns
+    -------
+    dict
+        Dicts of column name and value keyed by slurm's ID. Columns are the
+        same as the ones returned by parse_squeue. Job array tasks, listed by
+        squeue -r, are keyed and have JOBID of <array_id>_<task> str.
+    """
+    jobs_index = {}
+    for line in input_str.split("\n"):
+        cols = line.split()
+        if len(cols) < 7 or cols[0] == "JOBID":
+            continue
+        try:
+            cols_vals = {"JOBID": slurm_key(cols[0]),
+                         "PARTITION": str(cols[1]),
+                         "NAME": str(cols[2]),
+                         "USER": str(cols[3]),
+                         "ST": str(cols[4]),
+                         "TIME": str(cols[5]),
+                         "NODES": int(cols[6])}
+        except ValueError:
+            raise ParserError("""Could not read the job line. Check if squeue
+                  command output has not been changed.""")
+        jobs_index[cols_vals["JOBID"]] = cols_vals
+    return jobs_index
+
+
+SACCT_ACTIVE_STATES = ("PENDING",
+                       "RUNNING",
+                       "REQUEUED",
+                       "RESIZING",
+                       "SUSPENDED",
+                       "COMPLETING",
+                       "CONFIGURING",
+                       "STAGE_OUT",
+                       "SIGNALING")
+
+
+def render_sacct_cmd(slurm_ids):
+    """
+    Return sacct command listing state and exit code of the jobs, one line
+    per job or job array task.
+
+    Parameters
+    -------
+    slurm_ids: list of int
+        Slurm's IDs of the jobs or job arrays.
+
+    Returns
+    -------
+    str
+        sacct command.
+    """
+    return "sacct -n -P -X -o JobID,State,ExitCode -j {}".format(
+        ",".join([str(i) for i in sorted(set(slurm_ids))]))
+
+
+def index_sacct(input_str):
+    """
+    Index sacct command output, rendered by render_sacct_cmd, by the slurm's
+    ID of the job.
+
+    Parameters
+    -------
+    input_str: str
+        Output of the sacct command.
+
+    Returns
+    -------
+    dict
+        Dicts of STATE and EXITCODE keyed by slurm's ID. STATE is the first
+        word of the state, eg. <CANCELLED> for <CANCELLED by 1000>. Job array
+        tasks are keyed by <array_id>_<task> str, like in index_squeue.
+    """
+    jobs_index = {}
+    for line in input_str.split("\n"):
+        cols = line.strip().split("|")
+        if len(cols) != 3 or not cols[1]:
+            continue
+        jobs_index[slurm_key(cols[0])] = {"STATE": cols[1].split()[0],
+                                          "EXITCODE": cols[2]}
+    return jobs_index
+
+
+def slurm_key(slurm_id):
+    """
+    Return SLURM ID as int or as str if it is a job array task ID, eg.
+    <1324233_4>.
+    """
+    try:
+        return int(slurm_id)
+    except ValueError:
+        return str(slurm_id)
+
+
+class ClusterSnapshot:
+    """
+    State of the computing cluster taken once per scheduler tick with a single
+    sinfo and a single squeue call. All the scheduling decisions within the
+    tick are looked up in it instead of asking the cluster again.
+
+    Parameters
+    -------
+    sinfo_str: str, default <"">
+        Output of the sinfo command.
+    squeue_str: str, default <"">
+        Output of the squeue command.
+    sacct_str: str, default <"">
+        Output of the sacct command. See render_sacct_cmd.
+    time: datetime, default <None>
+        Time the squeue command was started, now if not given. Jobs accepted
+        by sbatch later may be missing from the snapshot.
+
+    Attributes
+    -------
+    nodes_index: dict
+        Number of nodes keyed by (partition, state). See index_sinfo.
+    jobs_index: dict
+        squeue columns keyed by slurm's ID. See index_squeue.
+    accounting_index: dict
+        sacct state and exit code keyed by slurm's ID. See index_sacct.
+    sinfo_cmd: str
+        Command taking the sinfo output.
+    squeue_cmd: str
+        Command taking the squeue output. Job arrays are listed task by task.
+    """
+    sinfo_cmd = "sinfo"
+    squeue_cmd = "squeue -r"
+
+    def __init__(self,
+                 sinfo_str="",
+                 squeue_str="",
+                 sacct_str="",
+                 time=None):
+        self.time = time or django.utils.timezone.now()
+        self.nodes_index = index_sinfo(sinfo_str)
+        self.jobs_index = index_squeue(squeue_str)
+        self.accounting_index = index_sacct(sacct_str)
+
+    @classmethod
+    def from_cluster(cls,
+                     machine="headnode"):
+        """
+        Take the snapshot with one sinfo and one squeue call via ssh.
+
+        Parameters
+        -------
+        machine: str, default <headnode>
+            Machine name on which commands take place.
+
+        Returns
+        -------
+        ClusterSnapshot
+        """
+        return cls(sinfo_str=ssh_cmd(cmd=cls.sinfo_cmd, machine=machine),
+                   squeue_str=ssh_cmd(cmd=cls.squeue_cmd, machine=machine))
+
+    def nodes(self,
+              partition,
+              state):
+        """
+        Return number of nodes in desired state and partition or None if there
+        is no such a line in sinfo output.
+        """
+        return self.nodes_index.get((partition, state))
+
+    def job(self,
+            slurm_id,
+            key="ST"):
+        """
+        Return desired squeue column of the job or None if the job is not in
+        the queue.
+        """
+        if slurm_id is None:
+            return None
+        try:
+            return self.jobs_index[slurm_key(slurm_id)][key]
+        except KeyError:
+            return None
+
+    def account(self,
+                sacct_str):
+        """
+        Add the sacct output to the snapshot.
+        """
+        self.accounting_index.update(index_sacct(sacct_str))
+
+    def accounting(self,
+                   slurm_id,
+                   key="STATE"):
+        """
+        Return desired sacct column of the job or None if the job is not in
+        the sacct output.
+        """
+        if slurm_id is None:
+            return None
+        try:
+            return self.accounting_index[slurm_key(slurm_id)][key]
+        except KeyError:
+            return None
+
+    def isrunning(self,
+                  slurm_id):
+        """
+        Return True if the job has <R> state in squeue output.
+        """
+        return self.job(slurm_id, "ST") == "R"
+
+    def allocate(self,
+                 partition,
+                 nodes=1):
+        """
+        Move nodes from idle to alloc state in the partition. Used to keep the
+        snapshot up to date with the jobs submitted within the tick.
+        """
+        idle = self.nodes_index.get((partition, "idle"), 0)
+        nodes = min(nodes, idle)
+        self.nodes_index[(partition, "idle")] = idle - nodes
+        self.nodes_index[(partition, "alloc")] = self.nodes_index.get((partition, "alloc"), 0) + nodes
+
+
 def ssh_cmd(cmd,
-            machine="headnode"):
+            machine="headnode",
+            timeout=None):
     """
-    Return output of remote command via ssh. Keys are obligatory!
+    Return output of remote command via ssh. Keys are obligatory! Commands
+    are sent through the pooled, long-lived sessions of the transport module
+    instead of starting a new ssh process each time.
 
     Parameters
     -------
     cmd: str
-        Command to use.
+        Command to use. It is received by the remote shell the same way as
+        with <ssh machine cmd>.
     machine: str, default <headnode>
         Machine name on which command takes place.
+    timeout: float, default <None>
+        Seconds to wait for the command to finish.
+        settings.MOTHULITY_SSH_TIMEOUT (default 300) if None.
 
     Return
     -------
     str
         Command output if cmd is fruitful function.
+
+    Raises
+    -------
+    subprocess.CalledProcessError
+        If the command exit status is non-zero.
+    subprocess.TimeoutExpired
+        If the command did not finish within the timeout.
     """
-    cmd = "ssh {} {}".format(machine, cmd)
-    return sp.check_output(cmd, shell=True).decode('utf-8').strip()
+    cmd = transport.remote_cmd(cmd)
+    with metrics.REGISTRY.timer("mothulity_ssh_seconds", command=cmd.split(" ")[0]):
+        return transport.get_pool().run(
+            cmd,
+            machine=machine,
+            timeout=timeout,
+        ).strip()
 
 
 def sniff_file(input_file,
@@ -202,7 +517,9 @@ def sniff_file(input_file,
 def count_seqs(input_files,
                file_format="fastq"):
     """
-    Return number of all reads in the files.
+    Return number of all reads in the files. FASTQ files are counted with
+    fastq.count_reads, in constant memory. Other formats are parsed with
+    Biopython.
 
     Parameters
     -------
@@ -217,9 +534,9 @@ def count_seqs(input_files,
         Sum of reads in input files.
     """
     input_glob = glob(input_files)
-    seqs = [sio.parse(i,
-                      file_format) for i in input_glob]
-    return sum([len(list(i)) for i in seqs])
+    if file_format == "fastq":
+        return sum(fastq.count_reads(i) for i in input_glob)
+    return sum(sum(1 for _ in sio.parse(i, file_format)) for i in input_glob)
 
 
 def render_moth_cmd(moth_exec="mothulity",
@@ -262,12 +579,91 @@ def render_moth_cmd(moth_exec="mothulity",
                              moth_opt_str)
 
 
+PENDING_POLICIES = {}
+
+
+def pending_policy(name):
+    """
+    Registers function as the pending jobs queue policy under given name. The
+    function takes the queryset of pending jobs, maximum number of Job IDs to
+    return and HPCSettings, and returns list of Job IDs in submission order.
+    """
+    def register(func):
+        PENDING_POLICIES[name] = func
+        return func
+    return register
+
+
+@pending_policy("fifo")
+def fifo_policy(jobs,
+                ids_quantity,
+                hpc_settings=None):
+    """
+    Oldest jobs first.
+    """
+    return list(jobs.order_by("submission_time").
+                values_list("job_id__job_id", flat=True)[:ids_quantity])
+
+
+@pending_policy("lifo")
+def lifo_policy(jobs,
+                ids_quantity,
+                hpc_settings=None):
+    """
+    Newest jobs first.
+    """
+    return list(jobs.order_by("-submission_time").
+                values_list("job_id__job_id", flat=True)[:ids_quantity])
+
+
+@pending_policy("sjf")
+def sjf_policy(jobs,
+               ids_quantity,
+               hpc_settings=None):
+    """
+    Jobs with the smallest number of reads first, oldest first among equal.
+    """
+    return list(jobs.order_by("job_id__seqsstats__seqs_count", "submission_time").
+                values_list("job_id__job_id", flat=True)[:ids_quantity])
+
+
+@pending_policy("aging")
+def aging_policy(jobs,
+                 ids_quantity,
+                 hpc_settings=None):
+    """
+    Jobs with the smallest number of reads first, but every hour of waiting
+    decreases the number by HPCSettings.queue_aging_reads_per_hour, so big
+    jobs are not starved by a stream of small ones. Only the ids_quantity
+    smallest and the ids_quantity oldest jobs are fetched and ranked, so the
+    oldest job always competes and the query stays bounded however long the
+    queue is.
+    """
+    reads_per_hour = getattr(hpc_settings, "queue_aging_reads_per_hour", 1000000)
+    now = django.utils.timezone.now()
+    candidates = {}
+    for order in (("job_id__seqsstats__seqs_count", "submission_time"),
+                  ("submission_time",)):
+        for row in jobs.order_by(*order).values_list("job_id__job_id",
+                                                     "job_id__seqsstats__seqs_count",
+                                                     "submission_time")[:ids_quantity]:
+            candidates[row[0]] = row
+    return [i[0] for i in sorted(
+        candidates.values(),
+        key=lambda i: ((i[1] or 0) -
+                       reads_per_hour * (now - i[2]).total_seconds() / 3600,
+                       i[2]),
+    )[:ids_quantity]]
+
+
 def get_pending_ids(ids_quantity=20,
                     status="pending",
-                    status_model=models.JobStatus):
+                    status_model=models.JobStatus,
+                    policy="lifo",
+                    hpc_settings=None):
     """
-    Returns Job IDs of oldest pending jobs within given limit retrieved from
-    JobStatus model.
+    Returns Job IDs of pending jobs within given limit retrieved from
+    JobStatus model, ordered by the queue policy.
 
     Parameters
     -------
@@ -277,18 +673,237 @@ def get_pending_ids(ids_quantity=20,
         Status of job in JobStatus model.
     status_model: django.models.Model, default JobStatus
         Django model to use.
+    policy: str, default <lifo>
+        Name of the queue policy from PENDING_POLICIES.
+    hpc_settings: models.HPCSettings, default <None>
+        Settings passed to the queue policy.
 
     Returns
     -------
     list of str
         job_id with <pending> status.
     """
-    ids = [i.job_id for i in status_model.objects.filter(job_status=status).
-           order_by("-submission_time")]
-    if len(ids) < ids_quantity:
-        return ids
-    else:
-        return ids[:ids_quantity]
+    return PENDING_POLICIES[policy](
+        status_model.objects.filter(job_status=status),
+        ids_quantity,
+        hpc_settings,
+    )
+
+
+def claim_pending_ids(worker,
+                      claim_time,
+                      ids_quantity=20,
+                      status="pending",
+                      status_model=models.JobStatus,
+                      policy="lifo",
+                      hpc_settings=None):
+    """
+    Claims pending jobs for the scheduler worker, so the other workers do not
+    submit them, and returns their Job IDs in the queue policy order. Jobs
+    claimed by the other workers are skipped until the claim expires. The
+    rows are locked with SELECT ... FOR UPDATE SKIP LOCKED where the database
+    supports it, so concurrent workers do not wait for each other. The claim
+    itself is a conditional UPDATE, which keeps the claims exclusive on the
+    other databases too.
+
+    Parameters
+    -------
+    worker: str
+        Name of the scheduler worker.
+    claim_time: int
+        Seconds after which the claim expires if it is not released.
+    ids_quantity: int, default <20>
+        Maximium number of Job IDs to claim.
+    status: str, default <pending>
+        Status of job in JobStatus model.
+    status_model: django.models.Model, default JobStatus
+        Django model to use.
+    policy: str, default <lifo>
+        Name of the queue policy from PENDING_POLICIES.
+    hpc_settings: models.HPCSettings, default <None>
+        Settings passed to the queue policy.
+
+    Returns
+    -------
+    list of str
+        job_id claimed by the worker.
+    """
+    now = django.utils.timezone.now()
+    expires = now + timedelta(seconds=claim_time)
+    claimable = (Q(claimed_by=None) |
+                 Q(claimed_by=worker) |
+                 Q(claim_expires__lt=now))
+    ids = PENDING_POLICIES[policy](
+        status_model.objects.filter(claimable, job_status=status),
+        ids_quantity,
+        hpc_settings,
+    )
+    with transaction.atomic():
+        jobs = status_model.objects.filter(claimable,
+                                           job_status=status,
+                                           job_id__job_id__in=ids)
+        if connection.features.has_select_for_update_skip_locked:
+            jobs = status_model.objects.filter(
+                job_id__in=list(jobs.select_for_update(skip_locked=True).
+                                values_list("job_id", flat=True)))
+        jobs.update(claimed_by=worker, claim_expires=expires)
+    claimed = set(status_model.objects.filter(job_id__job_id__in=ids,
+                                              claimed_by=worker,
+                                              claim_expires=expires).
+                  values_list("job_id__job_id", flat=True))
+    return [i for i in ids if i in claimed]
+
+
+def release_claims(worker,
+                   job_ids,
+                   status_model=models.JobStatus):
+    """
+    Releases claims of the scheduler worker on the jobs.
+
+    Parameters
+    -------
+    worker: str
+        Name of the scheduler worker.
+    job_ids: list of str
+        Job IDs to release.
+    status_model: django.models.Model, default JobStatus
+        Django model to use.
+    """
+    status_model.objects.filter(job_id__job_id__in=job_ids, claimed_by=worker).update(
+        claimed_by=None,
+        claim_expires=None,
+    )
+
+
+def acquire_lease(name,
+                  holder,
+                  lease_time,
+                  lease_model=models.SchedulerLease):
+    """
+    Acquires or renews the named lease for the holder. The lease is taken
+    over only if it is free or expired, so there is at most one holder at a
+    time.
+
+    Parameters
+    -------
+    name: str
+        Name of the lease.
+    holder: str
+        Name of the lease holder, eg. scheduler worker.
+    lease_time: int
+        Seconds after which the lease expires if it is not renewed.
+    lease_model: django.models.Model, default SchedulerLease
+        Django model to use.
+
+    Returns
+    -------
+    bool
+        True if the holder holds the lease now.
+    """
+    now = django.utils.timezone.now()
+    expires = now + timedelta(seconds=lease_time)
+    if lease_model.objects.filter(Q(holder=holder) | Q(expires__lt=now),
+                                  name=name).update(holder=holder,
+                                                    expires=expires):
+        return True
+    try:
+        with transaction.atomic():
+            lease_model.objects.create(name=name, holder=holder, expires=expires)
+    except IntegrityError:
+        return False
+    return True
+
+
+def release_lease(name,
+                  holder,
+                  lease_model=models.SchedulerLease):
+    """
+    Releases the named lease if it is held by the holder, so the other
+    holders do not have to wait for it to expire.
+
+    Parameters
+    -------
+    name: str
+        Name of the lease.
+    holder: str
+        Name of the lease holder.
+    lease_model: django.models.Model, default SchedulerLease
+        Django model to use.
+    """
+    lease_model.objects.filter(name=name, holder=holder).delete()
+
+
+def remove_old_intake_statuses(expiry_time,
+                               intake_model=models.IntakeStatus):
+    """
+    Removes intake statuses of the uploads not changed for longer than the
+    expiry time. Their pages stopped polling long ago.
+
+    Parameters
+    -------
+    expiry_time: int
+        Time in seconds.
+    intake_model: django.models.Model, default IntakeStatus
+        Django model to use.
+
+    Returns
+    -------
+    int
+        Number of removed statuses.
+    """
+    return intake_model.objects.filter(
+        updated__lt=django.utils.timezone.now() - timedelta(seconds=expiry_time),
+    ).delete()[0]
+
+
+def reject_stale_intakes(timeout,
+                         intake_model=models.IntakeStatus):
+    """
+    Rejects intakes queued or checked for longer than the timeout. The
+    intake workers live in the web server processes, so the uploads they
+    held are lost on restart and would stay queued forever.
+
+    Parameters
+    -------
+    timeout: int
+        Time in seconds.
+    intake_model: django.models.Model, default IntakeStatus
+        Django model to use.
+
+    Returns
+    -------
+    int
+        Number of rejected intakes.
+    """
+    now = django.utils.timezone.now()
+    return intake_model.objects.filter(
+        intake_status__in=("queued", "checking"),
+        updated__lt=now - timedelta(seconds=timeout),
+    ).update(intake_status="rejected", error="intake", updated=now)
+
+
+def remove_old_upload_sessions(expiry_time,
+                               session_model=models.UploadSession):
+    """
+    Removes sessions of the resumable uploads without a chunk for longer
+    than the expiry time, but not sooner than after an hour, so they still
+    count for the hourly limit of the started uploads.
+
+    Parameters
+    -------
+    expiry_time: int
+        Time in seconds.
+    session_model: django.models.Model, default UploadSession
+        Django model to use.
+
+    Returns
+    -------
+    int
+        Number of removed sessions.
+    """
+    return session_model.objects.filter(
+        updated__lt=django.utils.timezone.now() - timedelta(seconds=max(expiry_time, 3600)),
+    ).delete()[0]
 
 
 def get_ids_with_status(status="submitted",
@@ -308,7 +923,94 @@ def get_ids_with_status(status="submitted",
     list of str
         job_id with <submitted> status.
     """
-    return [i.job_id for i in status_model.objects.filter(job_status=status)]
+    return list(status_model.objects.filter(job_status=status).
+                values_list("job_id__job_id", flat=True))
+
+
+def get_queue_depth(status_model=models.JobStatus):
+    """
+    Returns number of jobs per status in one query.
+
+    Parameters
+    -------
+    status_model: django.models.Model, default JobStatus
+        Django model to use.
+
+    Returns
+    -------
+    dict
+        Number of jobs keyed by status.
+    """
+    return dict(status_model.objects.order_by().values_list("job_status").
+                annotate(jobs=Count("job_id")))
+
+
+def get_pending_fingerprint(status="pending",
+                            status_model=models.JobStatus):
+    """
+    Returns cheap summary of jobs with given status which changes when a job
+    gets the status.
+
+    Parameters
+    -------
+    status: str, default <pending>
+        Status of job in JobStatus model.
+    status_model: django.models.Model, default JobStatus
+        Django model to use.
+
+    Returns
+    -------
+    tuple
+        Number of jobs with the status and the latest submission time.
+    """
+    agg = status_model.objects.filter(job_status=status).aggregate(
+        jobs=Count("job_id"),
+        latest=Max("submission_time"),
+    )
+    return (agg["jobs"], agg["latest"])
+
+
+def wait_for_work(timeout,
+                  fingerprint,
+                  poll_min=1,
+                  poll_max=30,
+                  fingerprint_func=get_pending_fingerprint):
+    """
+    Sleep until timeout passes or new work arrives, whichever comes first.
+    The database is polled with exponential backoff - the first poll after
+    poll_min seconds, then every twice as long up to poll_max seconds.
+
+    Parameters
+    -------
+    timeout: float or None
+        Maximum number of seconds to sleep. None or negative values return
+        immediately.
+    fingerprint: tuple
+        Value of fingerprint_func taken after the last scheduler run.
+    poll_min: float, default <1>
+        Seconds before the first poll.
+    poll_max: float, default <30>
+        Maximum seconds between polls.
+    fingerprint_func: function, default get_pending_fingerprint
+        Function returning summary of work to do.
+
+    Returns
+    -------
+    bool
+        True if fingerprint changed before the timeout, False otherwise.
+    """
+    if timeout is None:
+        return False
+    deadline = time.monotonic() + timeout
+    interval = poll_min
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(interval, remaining))
+        if fingerprint_func() != fingerprint:
+            return True
+        interval = min(interval * 2, poll_max)
 
 
 def get_seqs_count(job_id):
@@ -362,52 +1064,300 @@ def get_retry(job_id):
     return models.JobID.objects.get(job_id=job_id).jobstatus.retry
 
 
-def queue_submit(job_id,
-                 machine,
-                 hpc_path,
-                 sbatch_success="Submitted batch job"):
+SLURM_RESOURCES = {
+    "phi": {
+        "partition": "accel",
+        "nodes": 1,
+        "ntasks": 1,
+        "exclusive": True,
+        "time": "14-00:00:00",
+    },
+    "long": {
+        "partition": "long",
+        "nodes": 1,
+        "ntasks": 1,
+        "exclusive": True,
+        "time": "14-00:00:00",
+    },
+}
+
+SLURM_SETTINGS = {v["partition"]: k for k, v in SLURM_RESOURCES.items()}
+
+
+def render_sbatch_header(slurm_setting,
+                         options=None):
     """
-    Retrieves required data from models by Job ID, renders mothulity command,
-    copies files to computing cluster and sends the mothulity command. Adds
-    JobStatus.slurm_id after slurm.
+    Renders #SBATCH lines requesting the per-job resources of the mothulity
+    slurm setting - one whole node of its partition, as counted by the
+    scheduler budget.
+
+    Parameters
+    -------
+    slurm_setting: str
+        Value of mothulity --use-slurm-setting option, key of
+        SLURM_RESOURCES.
+    options: dict, default <None>
+        Additional sbatch options, overriding the ones of the setting. True
+        renders a flag, None leaves the option out.
+
+    Returns
+    -------
+    list of str
+        #SBATCH lines.
+    """
+    resources = dict(SLURM_RESOURCES[slurm_setting], **(options or {}))
+    lines = []
+    for option, value in resources.items():
+        if value is True:
+            lines.append("#SBATCH --{}".format(option))
+        elif value is not None and value is not False:
+            lines.append("#SBATCH --{}={}".format(option, value))
+    return lines
+
+
+def render_queue_cmd(job_id,
+                     hpc_path,
+                     slurm_setting="phi",
+                     moth_exec="srun mothulity",
+                     shell="sbatch"):
+    """
+    Retrieves required data from models by Job ID and renders mothulity
+    command which submits the job to the queue.
 
     Parameters
     -------
     job_id: str
         Job ID by which rest of data are retrieved.
+    hpc_path: str
+        Path to the jobs directories on the computing cluster.
+    slurm_setting: str, default <phi>
+        Value of mothulity --use-slurm-setting option. See SLURM_SETTINGS for
+        the setting of each partition.
+    moth_exec: str, default <srun mothulity>
+        Mothulity executable.
+    shell: str, default <sbatch>
+        Value of mothulity --run option.
 
     Returns
     -------
-    bool
-        <True> if SLURM status equals <R>.
+    str
+        POSIX mothulity command.
     """
-    job = models.JobID.objects.get(job_id=job_id)
-    seqs_count = job.seqsstats.seqs_count
+    job = models.JobID.objects.select_related("submissiondata").get(job_id=job_id)
     sub_data = model_to_dict(job.submissiondata)
     job_id_dir = '{}{}/'.format(hpc_path, str(job_id).replace('-', '_'))
-    sub_data["use-slurm-setting"] = "phi"
-    moth_cmd = render_moth_cmd(
-        moth_exec="srun mothulity",
+    sub_data["use-slurm-setting"] = slurm_setting
+    return render_moth_cmd(
+        moth_exec=moth_exec,
         moth_files=job_id_dir,
         moth_opts=sub_data,
+        shell=shell,
         pop_elems=[
             "job_id",
             "amplicon_type"
         ],
     )
+
+
+def array_log_name(slurm_id,
+                   task="%a"):
+    """
+    Returns name of the SLURM output file of the job array task, written to
+    the jobs directories path. With the defaults it is the sbatch --output
+    pattern.
+    """
+    return ".mothulity_array_{}_{}.log".format(slurm_id, task)
+
+
+def render_array_script(job_ids,
+                        hpc_path,
+                        partition,
+                        log_name="mothulity_array.log"):
+    """
+    Renders SLURM job array script which runs mothulity for one job per array
+    task. Task index is the position of the job in job_ids. Every task gets
+    the resources of the slurm setting of the partition, the same as a job
+    submitted on its own, and writes its output to the job directory. SLURM
+    own messages of the task, eg about the time limit, go to the file named
+    with array_log_name.
+
+    Parameters
+    -------
+    job_ids: list of str
+        Job IDs by which rest of data are retrieved.
+    hpc_path: str
+        Path to the jobs directories on the computing cluster.
+    partition: str
+        SLURM partition the array is submitted to.
+    log_name: str, default <mothulity_array.log>
+        Name of the task log file written to the job directory.
+
+    Returns
+    -------
+    str
+        Job array script to submit with sbatch --array.
+    """
+    slurm_setting = SLURM_SETTINGS[partition]
+    lines = ["#!/bin/bash"]
+    lines.extend(render_sbatch_header(slurm_setting, {
+        "job-name": "mothulity_array",
+        "output": "{}{}".format(hpc_path, array_log_name("%A")),
+        "array": "0-{}".format(len(job_ids) - 1),
+    }))
+    lines.append('case "$SLURM_ARRAY_TASK_ID" in')
+    for task, job_id in enumerate(job_ids):
+        job_id_dir = '{}{}/'.format(hpc_path, str(job_id).replace('-', '_'))
+        lines.append("    {}) exec > {}{} 2>&1; cd {} && {} ;;".format(
+            task,
+            job_id_dir,
+            log_name,
+            job_id_dir,
+            render_queue_cmd(job_id=job_id,
+                             hpc_path=hpc_path,
+                             slurm_setting=slurm_setting,
+                             moth_exec="mothulity",
+                             shell="bash"),
+        ))
+    lines.append("esac")
+    return "\n".join(lines) + "\n"
+
+
+def collect_array_log(input_dir,
+                      slurm_id,
+                      task,
+                      job_dir,
+                      log_name="mothulity_array.slurm.log"):
+    """
+    Moves the SLURM output file of the job array task from the jobs
+    directories path to the job directory.
+
+    Parameters
+    -------
+    input_dir: str
+        Path to the jobs directories, with trailing slash.
+    slurm_id: int
+        SLURM ID of the job array.
+    task: int
+        Array task index of the job.
+    job_dir: str
+        Path to the job directory, with trailing slash.
+    log_name: str, default <mothulity_array.slurm.log>
+        Name of the file in the job directory.
+
+    Returns
+    -------
+    bool
+        False if there was no output file.
+    """
+    try:
+        os.replace("{}{}".format(input_dir, array_log_name(slurm_id, task)),
+                   "{}{}".format(job_dir, log_name))
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def parse_sbatch(sbatch_out,
+                 sbatch_success="Submitted batch job"):
+    """
+    Returns slurm ID from sbatch output.
+
+    Parameters
+    -------
+    sbatch_out: str
+        Output of the sbatch command.
+    sbatch_success: str, default <Submitted batch job>
+        Beginning of the line reporting successful submission.
+
+    Returns
+    -------
+    int or None
+        slurm ID or None if submission failed.
+    """
+    if sbatch_success in sbatch_out:
+        return int(sbatch_out.split(" ")[-1])
+
+
+def queue_submit(job_id,
+                 machine,
+                 hpc_path,
+                 sbatch_success="Submitted batch job"):
+    """
+    Retrieves required data from models by Job ID, renders mothulity command,
+    copies files to computing cluster and sends the mothulity command. Adds
+    JobStatus.slurm_id after slurm.
+
+    Parameters
+    -------
+    job_id: str
+        Job ID by which rest of data are retrieved.
+
+    Returns
+    -------
+    bool
+        <True> if SLURM status equals <R>.
+    """
     sbatch_out = ssh_cmd(
-        cmd=moth_cmd,
+        cmd=render_queue_cmd(job_id=job_id, hpc_path=hpc_path),
         machine=machine,
         )
     print(sbatch_out)
-    if sbatch_success in sbatch_out:
+    slurm_id = parse_sbatch(sbatch_out, sbatch_success)
+    if slurm_id is not None:
         add_slurm_id(job_id=job_id,
-                     slurm_id=int(sbatch_out.split(" ")[-1]))
+                     slurm_id=slurm_id)
         return True
     else:
         return False
 
 
+RemovalReport = collections.namedtuple("RemovalReport", ["files", "bytes", "errors"])
+
+
+def remove_files(paths,
+                 safety=True,
+                 max_workers=8):
+    """
+    Remove the files, spreading the unlinks over a thread pool, so the
+    round trips of the network filesystems, like sshfs, overlap.
+
+    Parameters
+    -------
+    paths: list of str
+        Paths of the files to remove.
+    safety: bool, default True
+        Actual removal takes place only if the safety parameter is set to
+        <False>. Otherwise the files and bytes which would be freed are just
+        counted.
+    max_workers: int, default <8>
+        Maximum number of concurrent unlinks.
+
+    Returns
+    -------
+    RemovalReport
+        namedtuple of number of files and bytes freed and list of the paths
+        which could not be removed.
+    """
+    def remove(path):
+        size = os.lstat(path).st_size
+        if not safety:
+            os.unlink(path)
+        return size
+    files = 0
+    freed = 0
+    errors = []
+    if not paths:
+        return RemovalReport(files, freed, errors)
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(paths))) as executor:
+        for path, future in zip(paths, [executor.submit(remove, i) for i in paths]):
+            try:
+                freed += future.result()
+                files += 1
+            except OSError:
+                errors.append(path)
+    return RemovalReport(files, freed, errors)
+
+
 def remove_except(directory,
                   pattern,
                   safety=True):
@@ -418,25 +1368,36 @@ def remove_except(directory,
     -------
     directory: str
         Directory path from which the unwanted files will be removed.
-    pattern: str
-        Files ending with this will NOT be removed from the directory.
-        If <None> or <False> - everything will be removed.
+    pattern: str or tuple of str
+        Files matching this, or any of these patterns, will NOT be removed
+        from the directory. If <None> or <False> - everything will be
+        removed.
+    safety: bool, default True
+        Actual removal takes place only if the safety parameter is set to
+        <False>. Otherwise the files to remove are just listed.
+
+    Returns
+    -------
+    str or bool
+        Files to remove, one per line, if safety is on. Empty str if the
+        files were removed. False if any of them could not be removed.
     """
-    cmd = {True: 'ls', False: 'rm'}
     if not directory.endswith('/'):
         directory = directory + '/'
     files = glob('{}*'.format(directory))
     if not pattern:
         files_to_remove = files
     else:
-        files_to_remove = [i for i in files if not fnmatch(i, pattern)]
-    try:
-        return sp.check_output(
-            '{} {}'.format(cmd[safety], ' '.join(files_to_remove)),
-            shell=True,
-            ).decode('utf-8')
-    except Exception as e:
+        if isinstance(pattern, str):
+            pattern = (pattern,)
+        files_to_remove = [i for i in files if not any(fnmatch(i, j) for j in pattern)]
+    if safety:
+        return "".join(["{}\n".format(i) for i in sorted(files_to_remove)])
+    report = remove_files(files_to_remove, safety=False)
+    print("Removed {} files, {} bytes from {}".format(report.files, report.bytes, directory))
+    if report.errors:
         return False
+    return ""
 
 
 def remove_dir(
@@ -444,7 +1405,8 @@ def remove_dir(
     safety=True,
 ):
     """
-    Remove or list directory depending on safety switch.
+    Remove or list directory depending on safety switch. The files are
+    removed in parallel with remove_files, then the emptied directories.
 
     Parameters
     -------
@@ -452,17 +1414,182 @@ def remove_dir(
         Directory path from which the unwanted files will be removed.
     safety: bool, default True
         Actual removal takes place only if the safety parameter is set to
-        <False>. Otherwise it is just
+        <False>. Otherwise it is just listed.
+
+    Returns
+    -------
+    list or bool
+        [directory] if safety is on, empty list if the directory was removed
+        or False if it does not exist or could not be removed.
     """
-    cmd = {True: 'ls', False: 'rm'}
-    option = {True: '-d', False: '-r'}
+    if not os.path.isdir(directory):
+        return False
+    if safety:
+        return [directory]
+    files = []
+    dirs = []
+    for root, dirnames, filenames in os.walk(directory, topdown=False):
+        files.extend([os.path.join(root, i) for i in filenames])
+        for i in dirnames:
+            path = os.path.join(root, i)
+            if os.path.islink(path):
+                files.append(path)
+            else:
+                dirs.append(path)
+    dirs.append(directory)
+    report = remove_files(files, safety=False)
+    print("Removed {} files, {} bytes from {}".format(report.files, report.bytes, directory))
+    if report.errors:
+        return False
     try:
-        return sp.check_output(
-            '{} {} {}'.format(cmd[safety], option[safety], directory),
-            shell=True
-        ).decode('utf-8').split()
-    except Exception as e:
+        for i in dirs:
+            os.rmdir(i)
+    except OSError:
         return False
+    return []
+
+
+Transition = collections.namedtuple("Transition", ["job_id", "new_status", "retry"])
+
+
+def start_job(job,
+              submission_data,
+              status_model=models.JobStatus,
+              submission_model=models.SubmissionData):
+    """
+    Records the options of the job and makes it pending in one transaction.
+    The status of a new job is inserted. A job which is still pending gets
+    the new options, checked with a compare-and-set on its status, and a job
+    already submitted is left untouched.
+
+    Parameters
+    -------
+    job: models.JobID
+        Job to start.
+    submission_data: dict
+        SubmissionData fields of the job.
+    status_model: django.models.Model, default JobStatus
+        Django model to use.
+    submission_model: django.models.Model, default SubmissionData
+        Django model to use.
+
+    Returns
+    -------
+    bool
+        True if the job is pending with the options, False if it was already
+        submitted.
+    """
+    with transaction.atomic():
+        created = status_model.objects.get_or_create(
+            job_id=job,
+            defaults={"job_status": "pending"},
+        )[1]
+        if not created and not update_status(job.job_id, "pending", old_status="pending",
+                                             status_model=status_model):
+            return False
+        submission_model.objects.update_or_create(job_id=job, defaults=submission_data)
+    return True
+
+
+def update_status(job_id,
+                  new_status,
+                  old_status=None,
+                  status_model=models.JobStatus,
+                  **fields):
+    """
+    Changes status of the job in the JobStatus model with a single UPDATE
+    query.
+
+    Parameters
+    -------
+    job_id: str
+        Job ID of job which status should be changed.
+    new_status: str
+        Content of new status.
+    old_status: str, default <None>
+        The status is changed only if the job still has this one. Any status
+        is changed if None.
+    status_model: django.models.Model, default JobStatus
+        Django model to use.
+    fields: dict
+        Other JobStatus fields to set in the same query, eg. slurm_id.
+
+    Returns
+    -------
+    bool
+        True if the status was changed.
+    """
+    jobs = status_model.objects.filter(job_id__job_id=job_id)
+    if old_status is not None:
+        jobs = jobs.filter(job_status=old_status)
+    return jobs.update(job_status=new_status, **fields) > 0
+
+
+def apply_transitions(transitions,
+                      old_status,
+                      status_model=models.JobStatus):
+    """
+    Applies many status transitions in one transaction. Jobs which still
+    have the old status are locked with one query first, then transitions
+    with the same new status and retry number are applied with one UPDATE
+    query.
+
+    Parameters
+    -------
+    transitions: list of Transition
+        Job ID, new status and new retry number or None if the retry number
+        does not change.
+    old_status: str
+        Only jobs which still have this status are changed.
+    status_model: django.models.Model, default JobStatus
+        Django model to use.
+
+    Returns
+    -------
+    list of Transition
+        Transitions which were applied.
+    """
+    if not transitions:
+        return []
+    with transaction.atomic():
+        matched = {str(i) for i in status_model.objects.select_for_update(of=("self",)).filter(
+            job_id__job_id__in=[str(i.job_id) for i in transitions],
+            job_status=old_status,
+        ).values_list("job_id__job_id", flat=True)}
+        applied = [i for i in transitions if str(i.job_id) in matched]
+        groups = collections.defaultdict(list)
+        for i in applied:
+            groups[(i.new_status, i.retry)].append(str(i.job_id))
+        for (new_status, retry), ids in groups.items():
+            fields = {"job_status": new_status}
+            if retry is not None:
+                fields["retry"] = retry
+            status_model.objects.filter(
+                job_id__job_id__in=ids,
+                job_status=old_status,
+            ).update(**fields)
+    return applied
+
+
+def get_jobs_with_status(status="submitted",
+                         status_model=models.JobStatus):
+    """
+    Returns JobStatus of jobs with given status together with their JobID in
+    one query.
+
+    Parameters
+    -------
+    status: str, default <submitted>
+        Status of job in JobStatus model.
+    status_model: django.models.Model, default JobStatus
+        Django model to use.
+
+    Returns
+    -------
+    list of JobStatus
+    """
+    return list(status_model.objects.filter(job_status=status).
+                select_related("job_id"))
 
 
 def change_status(job_id,
@@ -480,9 +1607,7 @@ def change_status(job_id,
     status_model: django.models.Model, default JobStatus
         Django model to use.
     """
-    job = models.JobID.objects.get(job_id=job_id)
-    job.jobstatus.job_status = new_status
-    job.jobstatus.save()
+    update_status(job_id, new_status, status_model=status_model)
 
 
 def add_slurm_id(job_id,
@@ -500,9 +1625,10 @@ def add_slurm_id(job_id,
     status_model: django.models.Model, default JobStatus
         Django model to use.
     """
-    job = models.JobID.objects.get(job_id=job_id)
-    job.jobstatus.slurm_id = slurm_id
-    job.jobstatus.save()
+    status_model.objects.filter(job_id__job_id=job_id).update(
+        slurm_id=slurm_id,
+        slurm_submission_time=django.utils.timezone.now(),
+    )
 
 
 def add_retry(job_id,
@@ -520,14 +1646,13 @@ def add_retry(job_id,
     status_model: django.models.Model, default JobStatus
         Django model to use.
     """
-    job = models.JobID.objects.get(job_id=job_id)
-    job.jobstatus.retry = retry
-    job.jobstatus.save()
+    status_model.objects.filter(job_id__job_id=job_id).update(retry=retry)
 
 
 def isrunning(job_id,
               machine,
-              status_model=models.JobStatus,):
+              status_model=models.JobStatus,
+              snapshot=None):
     """
     Check if job is actually running on the computing cluster.
 
@@ -537,14 +1662,19 @@ def isrunning(job_id,
         Job ID of job which status should be changed.
     status_model: django.models.Model, default JobStatus
         Django model to use.
+    snapshot: ClusterSnapshot, default <None>
+        Snapshot of the cluster taken in the current scheduler tick. squeue is
+        called via ssh only if it is not passed.
 
     Returns
     -------
     bool
         True is submitted ID has <R> state in squeue output.
     """
-    slurm_id = get_slurm_id(job_id)
-    if parse_squeue(ssh_cmd(cmd="squeue", machine=machine), slurm_id, "ST") == "R":
+    slurm_id = models.JobID.objects.get(job_id=job_id).jobstatus.slurm_key()
+    if snapshot is None:
+        snapshot = ssh_cmd(cmd=ClusterSnapshot.squeue_cmd, machine=machine)
+    if parse_squeue(snapshot, slurm_id, "ST") == "R":
         return True
     else:
         return False
@@ -566,14 +1696,8 @@ def isdone(directory,
     bool
         True if file exists or False if it does not.
     """
-    try:
-        sp.check_output(
-            "ls {}{}".format(directory, filename),
-            shell=True
-            ).decode('utf-8')
-        return True
-    except Exception as e:
-        return False
+    with metrics.REGISTRY.timer("mothulity_isdone_seconds"):
+        return bool(glob("{}{}".format(directory, filename)))
 
 
 def isstale(
@@ -593,7 +1717,8 @@ def isstale(
 def get_dirs_without_entries(
     input_dir,
     dir2id={'_': '-'},
-    job_model=models.SubmissionData
+    job_model=models.SubmissionData,
+    ids=None,
     ):
     """
     Return list of directories which does not posses the JobID.
@@ -604,6 +1729,8 @@ def get_dirs_without_entries(
         Input path.
     status_model: django.models.Model, default JobID
         Django model to use.
+    ids: list of str, default <None>
+        Job IDs retrieved beforehand. The job_model is queried if not passed.
 
     Returns
     -------
@@ -612,11 +1739,146 @@ def get_dirs_without_entries(
     """
     dir_char, job_id_char = tuple(dir2id.items())[0]
     input_dir_abs = os.path.abspath(input_dir)
-    ids = [i.job_id.job_id for i in job_model.objects.all()]
-    files_no_job_id = [i for i in os.listdir(input_dir_abs) if i.replace(dir_char, job_id_char) not in ids]
-    dirs_no_job_id = [
-        i
-        for i in ['{}/{}/'.format(input_dir_abs, ii) for ii in files_no_job_id]
-        if os.path.isdir(i)
-        ]
-    return dirs_no_job_id
+    if ids is None:
+        ids = job_model.objects.values_list("job_id__job_id", flat=True)
+    ids = set(ids)
+    return ['{}/{}/'.format(input_dir_abs, i.name)
+            for i in sorted(os.scandir(input_dir_abs), key=lambda i: i.name)
+            if i.name.replace(dir_char, job_id_char) not in ids and i.is_dir()]
+
+
+class OrphanSweeper:
+    """
+    Finds directories without JobID in the upload path a bounded batch at a
+    time. Directories are visited in name order and the sweeper remembers the
+    last one, so consecutive calls of next_batch walk the whole path and
+    start over. Only the JobIDs of the batch are fetched from the database.
+
+    Parameters
+    -------
+    input_dir: path
+        Input path.
+    batch_size: int, default <500>
+        Maximum number of directories checked in one batch.
+    dir2id: dict, default <{'_': '-'}>
+        Character in the directory name replaced in the JobID.
+    job_model: django.models.Model, default SubmissionData
+        Django model to use.
+    """
+    def __init__(self,
+                 input_dir,
+                 batch_size=500,
+                 dir2id={'_': '-'},
+                 job_model=models.SubmissionData):
+        self.input_dir = os.path.abspath(input_dir)
+        self.batch_size = batch_size
+        self.dir_char, self.job_id_char = tuple(dir2id.items())[0]
+        self.job_model = job_model
+        self.cursor = ""
+
+    def scan(self):
+        """
+        Return names of the next batch of directories and move the cursor
+        past them. Does not touch the database.
+        """
+        names = sorted([i.name for i in os.scandir(self.input_dir)
+                        if i.name > self.cursor and i.is_dir()])
+        if len(names) > self.batch_size:
+            names = names[:self.batch_size]
+            self.cursor = names[-1]
+        else:
+            self.cursor = ""
+        return names
+
+    def without_entries(self,
+                        names):
+        """
+        Return absolute paths of the directories which do not posses the
+        JobID.
+        """
+        ids = {i.replace(self.dir_char, self.job_id_char): i for i in names}
+        ids_found = set(self.job_model.objects.filter(
+            job_id__job_id__in=list(ids)).values_list("job_id__job_id", flat=True))
+        return ['{}/{}/'.format(self.input_dir, v)
+                for k, v in ids.items() if k not in ids_found]
+
+    def next_batch(self):
+        """
+        Return absolute paths of the directories without JobID from the next
+        batch.
+        """
+        return self.without_entries(self.scan())
+
+
+SiteSettings = collections.namedtuple(
+    "SiteSettings",
+    ["site", "path_settings", "web_server_settings", "hpc_settings"],
+)
+
+_site_settings_cache = {}
+
+
+def get_site_domain():
+    """
+    Return domain the settings are bound to - the first one from
+    settings.ALLOWED_HOSTS other than localhost.
+    """
+    return [i for i in settings.ALLOWED_HOSTS if i != 'localhost'][0]
+
+
+def get_site_settings(domain=None,
+                      site_model=models.Site):
+    """
+    Return the site with its path, Web-Server and HPC settings, loaded with
+    one query and cached in the process. The cache is cleared when any of
+    them is saved or deleted in the process and expires after
+    settings.MOTHULITY_SETTINGS_CACHE_TIME seconds (default 60), so the
+    changes made in other processes, eg. in the Admin Panel, are picked up
+    too.
+
+    Parameters
+    -------
+    domain: str, default <None>
+        Domain of the site. get_site_domain is used if not passed.
+    site_model: django.models.Model, default Site
+        Django model to use.
+
+    Returns
+    -------
+    SiteSettings
+        namedtuple of site, path_settings, web_server_settings and
+        hpc_settings.
+    """
+    domain = domain or get_site_domain()
+    cached = _site_settings_cache.get(domain)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+    site = site_model.objects.select_related(
+        "pathsettings",
+        "webserversettings",
+        "hpcsettings",
+    ).get(domain=domain)
+    site_settings = SiteSettings(site=site,
+                                 path_settings=site.pathsettings,
+                                 web_server_settings=site.webserversettings,
+                                 hpc_settings=site.hpcsettings)
+    _site_settings_cache[domain] = (
+        time.monotonic() + getattr(settings, "MOTHULITY_SETTINGS_CACHE_TIME", 60),
+        site_settings,
+    )
+    return site_settings
+
+
+@receiver(post_save, sender=models.Site)
+@receiver(post_delete, sender=models.Site)
+@receiver(post_save, sender=models.PathSettings)
+@receiver(post_delete, sender=models.PathSettings)
+@receiver(post_save, sender=models.WebServerSettings)
+@receiver(post_delete, sender=models.WebServerSettings)
+@receiver(post_save, sender=models.HPCSettings)
+@receiver(post_delete, sender=models.HPCSettings)
+def clear_site_settings(**kwargs):
+    """
+    Clear the get_site_settings cache.
+    """
+    _site_settings_cache.clear()
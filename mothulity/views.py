@@ -1,26 +1,45 @@
 # -*- coding: utf-8 -*-
 
-from django.conf import settings
+from django.http import Http404, HttpResponse, HttpResponseForbidden, HttpResponseNotAllowed, JsonResponse
 from django.shortcuts import render, get_object_or_404
+from django.urls import reverse
+from django.conf import settings
 from django.contrib.sites.shortcuts import get_current_site
+from django.utils.crypto import constant_time_compare
 from django.utils import timezone
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from django.views.decorators.http import require_POST
 from mothulity.forms import FileFieldForm, OptionsForm, ResendResultsEMailForm
 from mothulity.models import *
+from mothulity.uploadhandlers import FastqUploadHandler
 from mothulity.utils import isdone
+from . import fastq
+from . import intake
+from . import metrics
+from . import storage
+from . import uploadhandlers
 from . import utils
+from fnmatch import fnmatch
+import hashlib
+import os
+import secrets
 import uuid
-import subprocess as sp
 
 upload_errors = {
     'uneven': 'Sorry, it seems you uploaded an uneven number of files...',
     'mothulity_fc': 'Sorry, it seems there is something wrong with your file names...',
-    'format': 'Sorry, it seems you uploaded something else than FASTQ file...'
+    'format': 'Sorry, it seems you uploaded something else than FASTQ file...',
+    'intake': 'Sorry, something went wrong while checking your files...',
 }
 
+
+@csrf_exempt
 def index(request):
     """
-    Evaluates file upload form, uploaded files, total number of reads, creates
-    Job ID and renders appropriate template.
+    Sets up the upload of the files straight to the new job directory before
+    the request body is read, passes the request to the upload view and
+    removes the directory if the upload was not passed on to the intake
+    workers.
 
     Parameters
     -------
@@ -31,67 +50,86 @@ def index(request):
     django.template
         Template rendered to HTML.
     """
-    site = Site.objects.get(domain=[i for i in settings.ALLOWED_HOSTS if i != 'localhost'][0])
-    path_settings = site.pathsettings
-    web_server_settings = site.webserversettings
-    hpc_settings = site.hpcsettings
+    if request.method != "POST":
+        return upload(request)
+    job_storage = storage.get_storage(utils.get_site_settings().path_settings)
+    job_id = uuid.uuid4()
+    job_dir = storage.job_dir(job_id)
+    job_storage.create_dir(job_dir)
+    request.upload_handlers = [FastqUploadHandler(request,
+                                                  storage=job_storage,
+                                                  job_dir=job_dir)]
+    try:
+        response = upload(request, job_id=job_id)
+    finally:
+        if IntakeStatus.objects.filter(job_id=job_id).exists():
+            job_storage.close_dir(job_dir)
+        else:
+            job_storage.remove_dir(job_dir)
+    return response
+
+
+@csrf_protect
+def upload(request,
+           job_id=None):
+    """
+    Evaluates file upload form and uploaded files and renders appropriate
+    template. The files are written, validated and counted by
+    uploadhandlers.FastqUploadHandler while they arrive. The check of their
+    names on the HPC and creation of the Job ID are left to the intake
+    workers, so the page returns once the files are stored and polls
+    intake_status.
+
+    Parameters
+    -------
+    request: HTTP.request
+    job_id: uuid.UUID, default <None>
+        Job ID of the directory the files are written to.
+
+    Return
+    ------
+    django.template
+        Template rendered to HTML.
+    """
+    site, path_settings, web_server_settings, hpc_settings = utils.get_site_settings()
     request.session.set_expiry(web_server_settings.files_upload_expiry_time)
     if request.method == "POST":
+        upload_handler = request.upload_handlers[0]
         form = FileFieldForm(request.POST,
                              request.FILES)
+        if getattr(upload_handler, "errors", None):
+            print("Upload {} rejected: {}".format(job_id, "; ".join(upload_handler.errors)))
+            return render(request,
+                          "mothulity/index.html.jj2",
+                          {"articles": Article.objects.all(),
+                           "form": FileFieldForm(),
+                           "upload_error": upload_errors['format']})
         if form.is_valid():
-            job_id = uuid.uuid4()
-            upld_dir = "{}{}/".format(path_settings.upload_path,
-                                      str(job_id).replace("-", "_"))
-            hpc_dir = "{}{}/".format(
-                path_settings.hpc_path,
-                str(job_id).replace("-", "_"),
-            )
-            sp.check_output("mkdir {}".format(upld_dir), shell=True).decode('utf-8')
             upld_files = request.FILES.getlist("file_field")
             if len(upld_files) % 2 != 0:
-                sp.check_output("rm -r {}".format(upld_dir), shell=True).decode('utf-8')
-                form = FileFieldForm()
                 return render(request,
                               "mothulity/index.html.jj2",
                               {"articles": Article.objects.all(),
-                               "form": form,
+                               "form": FileFieldForm(),
                                "upload_error": upload_errors['uneven']})
-            for upfile in upld_files:
-                utils.write_file(upfile,
-                                 upld_dir)
-                utils.chmod_file("{}{}".format(upld_dir,
-                                               upfile),
-                                 mod=666)
-                if utils.sniff_file("{}{}".format(upld_dir,
-                                                  upfile),
-                                    "fastq") is not True:
-                    sp.check_output("rm -r {}".format(upld_dir), shell=True).decode('utf-8')
-                    form = FileFieldForm()
-                    return render(request,
-                                  "mothulity/index.html.jj2",
-                                  {"articles": Article.objects.all(),
-                                   "form": form,
-                                   "upload_error": upload_errors['format']})
-            try:
-                utils.ssh_cmd(cmd='srun mothulity_fc {}'.format(hpc_dir), machine=hpc_settings.hpc_name)
-            except:
-                form = FileFieldForm()
+            intake_status = intake.submit(job_id,
+                                          reads=[i.reads for i in upld_files],
+                                          remove_rejected=True)
+            if intake_status.intake_status == "rejected":
                 return render(request,
                               "mothulity/index.html.jj2",
                               {"articles": Article.objects.all(),
-                               "form": form,
-                               "upload_error": upload_errors['mothulity_fc']})
-            seqs_count = utils.count_seqs("{}*fastq".format(upld_dir))
-            job = JobID(job_id=job_id)
-            job.save()
-            seqsstats = SeqsStats(job_id=job, seqs_count=seqs_count)
-            seqsstats.save()
-            form = OptionsForm()
+                               "form": FileFieldForm(),
+                               "upload_error": upload_errors[intake_status.error]})
+            if intake_status.intake_status == "ready":
+                return render(request,
+                              "mothulity/options.html.jj2",
+                              {"articles": Article.objects.all(),
+                               "form": OptionsForm(),
+                               "job": job_id})
             return render(request,
-                          "mothulity/options.html.jj2",
+                          "mothulity/intake.html.jj2",
                           {"articles": Article.objects.all(),
-                           "form": form,
                            "job": job_id})
     else:
         form = FileFieldForm()
@@ -101,11 +139,219 @@ def index(request):
                    "form": form})
 
 
+def client_ip(request):
+    """
+    Return address of the client. Behind a reverse proxy it is read from the
+    header named with settings.MOTHULITY_CLIENT_IP_HEADER, eg
+    <HTTP_X_REAL_IP>.
+    """
+    header = getattr(settings, "MOTHULITY_CLIENT_IP_HEADER", None)
+    return (request.META.get(header) if header else None) or request.META.get("REMOTE_ADDR") or None
+
+
+def token_hash(token):
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def chunked_upload_dir(request,
+                       job,
+                       job_storage):
+    """
+    Return name of the job directory of the chunked upload, None if it does
+    not exist, the upload was already finished or the request does not
+    carry its Upload-Token.
+    """
+    job_dir = storage.job_dir(uuid.UUID(job))
+    session = UploadSession.objects.filter(job_id=job).first()
+    if (session is None or
+            not constant_time_compare(token_hash(request.META.get("HTTP_UPLOAD_TOKEN", "")),
+                                      session.token_hash) or
+            not os.path.isdir(job_storage.path(job_dir)) or
+            JobID.objects.filter(job_id=job).exists() or
+            IntakeStatus.objects.filter(job_id=job).exclude(intake_status="rejected").exists()):
+        return None
+    return job_dir
+
+
+def offset_response(offset,
+                    status=200,
+                    **kwargs):
+    response = JsonResponse(dict(offset=offset, **kwargs), status=status)
+    response["Upload-Offset"] = offset
+    return response
+
+
+@csrf_exempt
+@require_POST
+def upload_start(request):
+    """
+    Starts the resumable upload. Creates the Job ID and its directory the
+    files are then sent to in chunks, with upload_file, and finished with
+    upload_finish. The Job ID is not saved until the upload is finished, so
+    uploads left idle longer than files_upload_expiry_time are swept by the
+    scheduler. Every client may start settings.MOTHULITY_UPLOAD_STARTS_PER_HOUR
+    uploads an hour (default 30).
+
+    Parameters
+    -------
+    request: HTTP.request
+
+    Return
+    ------
+    django.http.JsonResponse
+        Job ID, the token to send in the Upload-Token header of the other
+        upload requests and the URL finishing the upload. Status 429 if the
+        client started too many uploads.
+    """
+    ip = client_ip(request)
+    started = UploadSession.objects.filter(client_ip=ip,
+                                           started__gt=timezone.now() - timezone.timedelta(hours=1))
+    if started.count() >= getattr(settings, "MOTHULITY_UPLOAD_STARTS_PER_HOUR", 30):
+        return JsonResponse({"error": "Too many uploads started. Try again later."}, status=429)
+    job_id = uuid.uuid4()
+    token = secrets.token_urlsafe(32)
+    storage.get_storage(utils.get_site_settings().path_settings).create_dir(storage.job_dir(job_id))
+    UploadSession.objects.create(job_id=str(job_id), token_hash=token_hash(token), client_ip=ip)
+    return JsonResponse({"job": str(job_id),
+                         "token": token,
+                         "finish": reverse("mothulity:upload_finish", args=[job_id])},
+                        status=201)
+
+
+@csrf_exempt
+def upload_file(request,
+                job,
+                filename):
+    """
+    Resumable upload of the file in chunks, with tus-style headers. HEAD or
+    GET returns the number of bytes already received in the Upload-Offset
+    header. PATCH appends the body at the Upload-Offset, which has to be the
+    current size of the file, optionally checked against the Upload-Checksum
+    header, eg <sha1 Kq5sNclPz7QV2+lfQIuc6R7oRu0=>. A failed chunk is
+    discarded, so it can be sent again from the returned offset. All the
+    files of the upload together are limited to
+    settings.MOTHULITY_UPLOAD_MAX_BYTES (default 10 GiB). Every request has
+    to carry the Upload-Token returned by upload_start.
+
+    Parameters
+    -------
+    request: HTTP.request
+    job: str
+        Job ID returned by upload_start.
+    filename: str
+        Name of the FASTQ file, plain or compressed.
+
+    Return
+    ------
+    django.http.JsonResponse
+        Offset of the file. Status 409 if the chunk does not start at the
+        offset, 413 if it exceeds the size limit, 460 if it does not match
+        the checksum.
+    """
+    job_storage = storage.get_storage(utils.get_site_settings().path_settings)
+    job_dir = chunked_upload_dir(request, job, job_storage)
+    if job_dir is None:
+        raise Http404("No upload in progress for {}".format(job))
+    if not any(fnmatch(filename, i) for i in fastq.PATTERNS):
+        return JsonResponse({"error": upload_errors['format']}, status=400)
+    path = job_storage.partial_path(job_dir, filename)
+    if request.method in ("HEAD", "GET"):
+        return offset_response(uploadhandlers.upload_offset(path))
+    if request.method != "PATCH":
+        return HttpResponseNotAllowed(["HEAD", "GET", "PATCH"])
+    uploaded = sum(uploadhandlers.upload_offset(job_storage.current_path(job_dir, i))
+                   for i in job_storage.partial_files(job_dir) if i != filename)
+    try:
+        offset = int(request.META["HTTP_UPLOAD_OFFSET"])
+        length = request.META.get("CONTENT_LENGTH")
+        offset = uploadhandlers.append_chunk(
+            path,
+            offset,
+            request,
+            length=int(length) if length else None,
+            checksum=request.META.get("HTTP_UPLOAD_CHECKSUM"),
+            max_size=uploadhandlers.upload_max_bytes() - uploaded,
+        )
+    except uploadhandlers.UploadConflict as e:
+        return offset_response(e.offset, status=409, error=str(e))
+    except uploadhandlers.UploadTooLarge as e:
+        return offset_response(uploadhandlers.upload_offset(path), status=413, error=str(e))
+    except uploadhandlers.ChecksumMismatch as e:
+        response = offset_response(uploadhandlers.upload_offset(path), status=460, error=str(e))
+        response.reason_phrase = "Checksum Mismatch"
+        return response
+    except (KeyError, ValueError) as e:
+        return JsonResponse({"error": "Invalid Upload-Offset or Upload-Checksum: {!r}".format(e)},
+                            status=400)
+    os.utime(job_storage.path(job_dir))
+    UploadSession.objects.filter(job_id=job).update(updated=timezone.now())
+    return offset_response(offset)
+
+
+@csrf_exempt
+@require_POST
+def upload_finish(request,
+                  job):
+    """
+    Finishes the resumable upload the same way as the upload form, passing
+    it to the intake workers, which validate and count the files, check them
+    on the HPC and create the Job ID. A file which is not FASTQ is removed,
+    so it can be uploaded again and the upload finished once more.
+
+    Parameters
+    -------
+    request: HTTP.request
+    job: str
+        Job ID returned by upload_start.
+
+    Return
+    ------
+    django.http.JsonResponse
+        Intake status of the upload, see intake_status. Status 202.
+    """
+    job_storage = storage.get_storage(utils.get_site_settings().path_settings)
+    if chunked_upload_dir(request, job, job_storage) is None:
+        raise Http404("No upload in progress for {}".format(job))
+    IntakeStatus.objects.filter(job_id=job, intake_status="rejected").delete()
+    return JsonResponse(intake_json(intake.submit(job)), status=202)
+
+
+def intake_json(intake_status):
+    return {"job": intake_status.job_id,
+            "status": intake_status.intake_status,
+            "error": upload_errors.get(intake_status.error),
+            "reads": intake_status.seqs_count,
+            "options": (reverse("mothulity:submit", args=[intake_status.job_id])
+                        if intake_status.intake_status == "ready" else None)}
+
+
+def intake_status(request,
+                  job):
+    """
+    Returns the intake status of the upload, polled until the options form
+    can be shown.
+
+    Parameters
+    -------
+    request: HTTP.request
+    job: str
+        Job ID of the upload.
+
+    Return
+    ------
+    django.http.JsonResponse
+        Status - <queued>, <checking>, <ready> or <rejected>, the error
+        message, number of reads and the URL of the options form once ready.
+    """
+    return JsonResponse(intake_json(get_object_or_404(IntakeStatus, job_id=job)))
+
+
 def submit(request,
            job):
     """
     Evaluates options form retrieves Job ID and its properties, renders
-    appropriate template.
+    appropriate template. GET renders the options form of the Job ID, eg
+    after the resumable upload is finished.
 
     Parameters
     -------
@@ -123,14 +369,11 @@ def submit(request,
         if form.is_valid():
             form_data = form.cleaned_data
             job = get_object_or_404(JobID, job_id=job)
-            submissiondata = SubmissionData(job_id=job, **form_data)
-            submissiondata.save()
-            jobstatus = JobStatus(job_id=job, job_status="pending")
-            jobstatus.save()
+            utils.start_job(job, form_data)
             return render(request,
                           "mothulity/submit.html.jj2",
                           {"articles": Article.objects.all(),
-                           "submissiondata": job.submissiondata,
+                           "submissiondata": SubmissionData.objects.get(job_id=job),
                            "notify_email": request.POST["notify_email"],
                            "job_id": job.job_id})
         else:
@@ -139,17 +382,21 @@ def submit(request,
                           {"articles": Article.objects.all(),
                            "form": form,
                            "job": job})
+    job = get_object_or_404(JobID, job_id=job)
+    return render(request,
+                  "mothulity/options.html.jj2",
+                  {"articles": Article.objects.all(),
+                   "form": OptionsForm(),
+                   "job": job.job_id})
 
 
 def status(request,
            job):
-    job = get_object_or_404(JobID, job_id=job)
-    site = Site.objects.get(
-        domain=[i for i in settings.ALLOWED_HOSTS if i != 'localhost'][0]
-        )
-    path_settings = site.pathsettings
-    web_server_settings = site.webserversettings
-    hpc_settings = site.hpcsettings
+    job = get_object_or_404(
+        JobID.objects.select_related("submissiondata", "jobstatus"),
+        job_id=job,
+    )
+    site, path_settings, web_server_settings, hpc_settings = utils.get_site_settings()
     hpc_dir = "{}{}/".format(
         path_settings.hpc_path,
         str(job.job_id).replace("-", "_"),
@@ -180,6 +427,36 @@ def status(request,
                    })
 
 
+def metrics_allowed(request):
+    """
+    Returns True if the request may read the metrics - it is sent by a staff
+    user or carries settings.MOTHULITY_METRICS_TOKEN as the bearer token.
+    """
+    if request.user.is_active and request.user.is_staff:
+        return True
+    token = getattr(settings, "MOTHULITY_METRICS_TOKEN", None)
+    if not token:
+        return False
+    return constant_time_compare(request.META.get("HTTP_AUTHORIZATION", ""),
+                                 "Bearer {}".format(token))
+
+
+def prometheus_metrics(request):
+    """
+    Returns the scheduler metrics dumped by its last tick and the current
+    number of jobs per status in the Prometheus text format. Only staff users
+    and scrapers with the metrics token are allowed, see metrics_allowed.
+    """
+    if not metrics_allowed(request):
+        return HttpResponseForbidden()
+    registry = metrics.load()
+    registry.clear_gauges("mothulity_queue_depth")
+    for job_status, jobs in utils.get_queue_depth().items():
+        registry.set_gauge("mothulity_queue_depth", jobs, status=job_status)
+    return HttpResponse(registry.render(),
+                        content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 def wiki(request,
          title):
     """
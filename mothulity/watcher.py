@@ -0,0 +1,375 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+from fnmatch import fnmatch
+from mothulity import models, utils
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+EVENT_HEADER = struct.Struct("iIII")
+
+REMOTE_FILESYSTEMS = ("fuse", "nfs", "cifs", "smb", "9p")
+
+
+def supports_inotify(path):
+    """
+    Return True if inotify reports the changes made in the path. Changes made
+    on the other side of network filesystems, like sshfs mounted from the
+    HPC, are not reported.
+
+    Parameters
+    -------
+    path: str
+        Path to check.
+
+    Returns
+    -------
+    bool
+    """
+    path = os.path.realpath(path)
+    fstype = None
+    mount_point = ""
+    try:
+        with open("/proc/self/mounts") as fin:
+            for line in fin:
+                cols = line.split()
+                if len(cols) < 3:
+                    continue
+                point = cols[1].replace("\\040", " ")
+                if (path == point or path.startswith(point.rstrip("/") + "/")) and len(point) >= len(mount_point):
+                    mount_point, fstype = point, cols[2]
+    except OSError:
+        return False
+    if fstype is None:
+        return False
+    return not fstype.startswith(REMOTE_FILESYSTEMS)
+
+
+class InotifyWatcher:
+    """
+    Reports files written or moved into the job directories of the upload
+    path with Linux inotify. Files are reported once they are closed after
+    writing, so a half-written file is never picked up.
+
+    Parameters
+    -------
+    path: str
+        Upload path with the job directories.
+    """
+    file_mask = IN_CLOSE_WRITE | IN_MOVED_TO
+    dir_mask = IN_CREATE | IN_MOVED_TO
+
+    def __init__(self,
+                 path):
+        self.path = path
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                                use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = {}
+        self.root = self.add_watch(path, self.dir_mask)
+        self.pending = []
+        for entry in os.scandir(path):
+            if entry.is_dir():
+                self.watch_job_dir(entry.path)
+
+    def add_watch(self,
+                  directory,
+                  mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed", directory)
+        self.dirs[wd] = directory
+        return wd
+
+    def watch_job_dir(self,
+                      directory):
+        """
+        Watch the job directory and report the files which were already
+        there, so the ones written before the watch was added are not missed.
+        """
+        try:
+            self.add_watch(directory, self.file_mask)
+            self.pending.extend([(directory, i.name) for i in os.scandir(directory)
+                                 if i.is_file()])
+        except OSError as e:
+            print("Could not watch {}: {!r}".format(directory, e))
+
+    def events(self,
+               timeout=None):
+        """
+        Return list of (job directory, file name) written since the last
+        call, waiting at most timeout seconds for the first one.
+        """
+        if self.pending:
+            events, self.pending = self.pending, []
+            return events
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, 65536)
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, pos)
+            pos += EVENT_HEADER.size
+            name = os.fsdecode(data[pos:pos + length].rstrip(b"\0"))
+            pos += length
+            if mask & IN_Q_OVERFLOW:
+                print("inotify queue overflow. The scheduler tick will pick up the missed results.")
+                continue
+            if wd not in self.dirs:
+                continue
+            directory = os.path.join(self.dirs[wd], name)
+            if wd == self.root:
+                if mask & IN_ISDIR:
+                    self.watch_job_dir(directory)
+            elif not mask & IN_ISDIR:
+                self.pending.append((self.dirs[wd], name))
+        events, self.pending = self.pending, []
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """
+    Reports files in the job directories of the upload path by scanning them
+    every interval. A file is reported once its size and modification time
+    did not change between two scans, so a half-written file is not picked up.
+    Used where inotify does not see the changes, eg. on the sshfs mount, where
+    every listing is a round trip to the HPC - so only the directories
+    returned by dirs are scanned.
+
+    Parameters
+    -------
+    path: str
+        Upload path with the job directories.
+    interval: float, default <5>
+        Seconds between the scans.
+    patterns: tuple of str, default <("*",)>
+        Only files matching one of the patterns are tracked.
+    dirs: callable, default <None>
+        Returns names of the job directories to scan, called before every
+        scan. All the directories of the path are scanned if None.
+    """
+    def __init__(self,
+                 path,
+                 interval=5,
+                 patterns=("*",),
+                 dirs=None):
+        self.path = path
+        self.interval = interval
+        self.patterns = patterns
+        self.dirs = dirs
+        self.seen = {}
+        self.reported = set()
+        self.last_scan = None
+
+    def job_dirs(self):
+        """
+        Return paths of the job directories to scan.
+        """
+        if self.dirs is not None:
+            return [os.path.join(self.path, i) for i in self.dirs()]
+        return [i.path for i in os.scandir(self.path) if i.is_dir()]
+
+    def scan(self):
+        files = {}
+        for job_dir in self.job_dirs():
+            try:
+                for entry in os.scandir(job_dir):
+                    if any(fnmatch(entry.name, i) for i in self.patterns) and entry.is_file():
+                        stat = entry.stat()
+                        files[(job_dir, entry.name)] = (stat.st_size, stat.st_mtime)
+            except OSError:
+                continue
+        return files
+
+    def events(self,
+               timeout=None):
+        """
+        Return list of (job directory, file name) completed since the last
+        call. Waits for the next scan, but not longer than timeout seconds.
+        """
+        if self.last_scan is not None:
+            wait = self.last_scan + self.interval - time.monotonic()
+            if timeout is not None and wait > timeout:
+                time.sleep(max(timeout, 0))
+                return []
+            time.sleep(max(wait, 0))
+        self.last_scan = time.monotonic()
+        files = self.scan()
+        events = [k for k, v in files.items()
+                  if self.seen.get(k) == v and k not in self.reported]
+        self.reported = self.reported.intersection(files).union(events)
+        self.seen = files
+        return events
+
+    def close(self):
+        pass
+
+
+def get_watcher(path,
+                backend="auto",
+                interval=5,
+                patterns=("*",),
+                dirs=None):
+    """
+    Return InotifyWatcher or PollingWatcher of the path.
+
+    Parameters
+    -------
+    path: str
+        Upload path with the job directories.
+    backend: str, default <auto>
+        <inotify>, <poll> or <auto> - inotify if it sees the changes made in
+        the path, polling otherwise.
+    interval: float, default <5>
+        Seconds between the scans of the polling watcher.
+    patterns: tuple of str, default <("*",)>
+        Files tracked by the polling watcher.
+    dirs: callable, default <None>
+        Job directories scanned by the polling watcher, see PollingWatcher.
+    """
+    if backend == "auto":
+        backend = "inotify" if supports_inotify(path) else "poll"
+    if backend == "inotify":
+        try:
+            return InotifyWatcher(path)
+        except (OSError, AttributeError) as e:
+            print("inotify is not available, polling instead: {!r}".format(e))
+    return PollingWatcher(path, interval=interval, patterns=patterns, dirs=dirs)
+
+
+class ResultsHandler:
+    """
+    Applies the done and closed transitions as soon as the results appear in
+    the job directory, instead of waiting for the scheduler tick. The results
+    file (<*shared>) marks the submitted job as done once sacct reports it
+    COMPLETED. The zipped analysis (<*zip>) closes the done job. The
+    transitions are conditional, so the scheduler tick and other workers can
+    safely handle the same jobs. Events are handled in batches - the jobs are
+    fetched with one query and checked with one sacct call.
+
+    Parameters
+    -------
+    hpc_settings: models.HPCSettings
+        HPC settings of the site.
+    """
+    artifacts = ("*shared", "*zip")
+    watched_statuses = ("submitted", "done")
+
+    def __init__(self,
+                 hpc_settings):
+        self.hpc_settings = hpc_settings
+
+    def job_dirs(self):
+        """
+        Return names of the directories of the jobs waiting for the results,
+        the only ones the polling watcher has to scan.
+        """
+        return [str(i).replace("-", "_") for i in models.JobStatus.objects.filter(
+            job_status__in=self.watched_statuses).values_list("job_id__job_id", flat=True)]
+
+    def completed(self,
+                  job_statuses):
+        """
+        Return SLURM IDs of the jobs which sacct reports COMPLETED, asking
+        about all of them in one sacct call.
+        """
+        slurm_ids = [i.slurm_id for i in job_statuses if i.slurm_id is not None]
+        if not slurm_ids:
+            return set()
+        snapshot = utils.ClusterSnapshot(sacct_str=utils.ssh_cmd(
+            utils.render_sacct_cmd(slurm_ids),
+            machine=self.hpc_settings.hpc_name))
+        return {i.slurm_key() for i in job_statuses
+                if snapshot.accounting(i.slurm_key()) == "COMPLETED"}
+
+    def __call__(self,
+                 events):
+        """
+        Handle list of (job directory, file name) reported by the watcher.
+        """
+        directories = {}
+        for directory, filename in events:
+            if any(fnmatch(filename, i) for i in self.artifacts):
+                job_id = os.path.basename(directory.rstrip("/")).replace("_", "-")
+                directories.setdefault(job_id, (directory, set()))[1].add(filename)
+        if not directories:
+            return
+        jobs = {i.job_id.job_id: i for i in models.JobStatus.objects.filter(
+            job_id__job_id__in=list(directories),
+            job_status__in=self.watched_statuses).select_related("job_id")}
+        with_results = [v for k, v in jobs.items()
+                        if v.job_status == "submitted" and
+                        any(fnmatch(i, "*shared") for i in directories[k][1])]
+        completed = self.completed(with_results)
+        for job_id, job_status in jobs.items():
+            directory, filenames = directories[job_id]
+            if job_status.job_status == "submitted" and job_status.slurm_key() in completed:
+                if utils.update_status(job_id, "done", old_status="submitted"):
+                    print("JobID {} results are present. Changing its status to <done>".format(job_id))
+                    job_status.job_status = "done"
+            if job_status.job_status == "done" and any(fnmatch(i, "*zip") for i in filenames):
+                utils.remove_except(directory, "*zip", safety=False)
+                if utils.update_status(job_id, "closed", old_status="done"):
+                    print("JobID {} analysis is zipped. Changing its status to <closed>".format(job_id))
+
+
+def watch(watcher,
+          handler,
+          stop,
+          timeout=1):
+    """
+    Pass the watcher events to the handler until the stop event is set.
+    """
+    try:
+        while not stop.is_set():
+            events = watcher.events(timeout=timeout)
+            if not events:
+                continue
+            try:
+                handler(events)
+            except Exception as e:
+                print("Could not handle {}: {!r}".format(events, e))
+    finally:
+        watcher.close()
+
+
+def start(path,
+          hpc_settings,
+          backend="auto",
+          interval=5):
+    """
+    Start watching the upload path in a daemon thread.
+
+    Returns
+    -------
+    threading.Event
+        Event stopping the watcher when set.
+    """
+    stop = threading.Event()
+    handler = ResultsHandler(hpc_settings)
+    watcher = get_watcher(path,
+                          backend=backend,
+                          interval=interval,
+                          patterns=ResultsHandler.artifacts,
+                          dirs=handler.job_dirs)
+    print("Watching {} with {}".format(path, type(watcher).__name__))
+    threading.Thread(target=watch,
+                     args=(watcher, handler, stop),
+                     daemon=True).start()
+    return stop
@@ -1,100 +1,102 @@
 #! /usr/bin/env python
 
 
+import argparse
 import os
 import sys
 import schedule
 
 import django
-from django.conf import settings
 
-sys.path.append(os.path.abspath(sys.argv[1]))
+parser = argparse.ArgumentParser(description="django-mothulity job scheduler.")
+parser.add_argument("project_path",
+                    help="Path to the django project.")
+parser.add_argument("--watch",
+                    nargs="?",
+                    const="auto",
+                    choices=["auto", "inotify", "poll"],
+                    help="Pick up the results as soon as they appear in the upload path. inotify is used if it sees the changes in the upload path, polling otherwise.")
+parser.add_argument("--watch-interval",
+                    type=float,
+                    default=5,
+                    help="Seconds between the upload path scans when polling. Default 5.")
+parser.add_argument("--simulate",
+                    action="store_true",
+                    help="Instead of scheduling, replay synthetic submissions against a simulated cluster for every queue policy and print throughput, turnaround and node utilization. Every policy runs in a fresh test database.")
+parser.add_argument("--simulate-jobs",
+                    type=int,
+                    default=500,
+                    help="Number of the simulated submissions. Default 500.")
+parser.add_argument("--simulate-hours",
+                    type=float,
+                    default=24,
+                    help="Hours the simulated submissions arrive over. Default 24.")
+args = parser.parse_args()
+
+sys.path.append(os.path.abspath(args.project_path))
 os.environ.setdefault(
     "DJANGO_SETTINGS_MODULE",
     "{}.settings".format(
-        [i for i in os.path.abspath(sys.argv[1]).split('/') if len(i) > 0][-1]
+        [i for i in os.path.abspath(args.project_path).split('/') if len(i) > 0][-1]
         ),
     )
 django.setup()
 
 from mothulity import utils
 from mothulity import models
-
-site = models.Site.objects.get(
-    domain=[i for i in settings.ALLOWED_HOSTS if i != 'localhost'][0]
-    )
-hpc_settings = site.hpcsettings
-
+from mothulity import scheduler
+from mothulity import simulator
+from mothulity import watcher
 
 def job():
     """
     Retrieve pending jobs and submit them properly to the computing cluster.
+    The settings are re-read, so changes made in the Admin Panel, including
+    the scheduler interval, apply without restarting the scheduler.
     """
-    site = models.Site.objects.get(
-        domain=[i for i in settings.ALLOWED_HOSTS if i != 'localhost'][0]
-        )
-    hpc_settings = site.hpcsettings
-    path_settings = site.pathsettings
-    web_server_settings = site.webserversettings
-    for i in utils.get_pending_ids():
-        print("\nJobID {} Status: pending\n".format(i))
-        idle_ns = utils.parse_sinfo(utils.ssh_cmd(cmd="sinfo", machine=hpc_settings.hpc_name), "long", "idle")
-        idle_phis = utils.parse_sinfo(utils.ssh_cmd(cmd="sinfo", machine=hpc_settings.hpc_name), "accel", "idle")
-        print("Number of free ns - {}. Number of free phis  - {}".format(
-            idle_ns,
-            idle_phis,
-        ))
-        if idle_phis > hpc_settings.free_PHIs_minimum_number:
-            if utils.queue_submit(job_id=i, machine=hpc_settings.hpc_name, hpc_path=path_settings.hpc_path) is True:
-                utils.change_status(i)
-                print("JobID {} submitted".format(i))
-        else:
-            print("Only {} phi nodes free. {} phi must stay free".format(idle_phis,
-                                                                         hpc_settings.free_PHIs_minimum_number))
-        if idle_ns > hpc_settings.free_Ns_minimum_number:
-            if utils.queue_submit(job_id=i, machine=hpc_settings.hpc_name, hpc_path=path_settings.hpc_path) is True:
-                utils.change_status(i)
-                print("JobID {} submitted".format(i))
-        else:
-            print("Only {} n nodes free. {} n nodes must stay free".format(idle_ns,
-                                                                           hpc_settings.free_Ns_minimum_number))
-    for i in utils.get_ids_with_status("submitted"):
-        print("\nJobID {} Status: submitted. Retries: {}\n".format(i,
-                                                                   utils.get_retry(i)))
-        job_sshfs_dir = "{}{}/".format(path_settings.upload_path, str(i).replace("-", "_"))
-        if utils.isrunning(job_id=i, machine=hpc_settings.hpc_name) is False and utils.isdone(job_sshfs_dir, '*shared') is False and utils.get_retry(i) >= hpc_settings.retry_maximum_number:
-            print("JobID above retry limit. Changing its status to <dead>")
-            utils.change_status(i, "dead")
-            break
-        if utils.isrunning(job_id=i, machine=hpc_settings.hpc_name) is False and utils.isdone(job_sshfs_dir, '*shared') is False and utils.get_retry(i) < hpc_settings.retry_maximum_number:
-            print("JobID {} is NOT done and is NOT runnning. Will be resubmitted".format(i))
-            utils.remove_except(job_sshfs_dir, 'fastq', safety=False)
-            utils.change_status(i, "pending")
-            utils.add_retry(i, utils.get_retry(i) + 1)
-            break
-        if utils.isrunning(job_id=i, machine=hpc_settings.hpc_name) is False and utils.isdone(job_sshfs_dir, filename="*shared") is True:
-            print("JobID {} is done".format(i))
-            utils.change_status(i, "done")
-            break
-    for i in utils.get_ids_with_status("done"):
-        print("\nJobID {} Status: done.\n".format(i))
-        job_sshfs_dir = "{}{}/".format(path_settings.upload_path, str(i).replace("-", "_"))
-        if utils.isdone(job_sshfs_dir, filename='*zip'):
-            utils.remove_except(job_sshfs_dir, '*zip', safety=False)
-            utils.change_status(i, 'closed')
-    for i in utils.get_dirs_without_entries(path_settings.upload_path):
-        if utils.isstale(i, web_server_settings.files_upload_expiry_time):
-            print("{} is old and has no JobID. Removing it".format(i))
-            utils.remove_dir(i, safety=False)
+    site, path_settings, web_server_settings, hpc_settings = utils.get_site_settings()
+    scheduler.Scheduler(
+        hpc_settings=hpc_settings,
+        path_settings=path_settings,
+        web_server_settings=web_server_settings,
+    ).run()
+    if hpc_settings.scheduler_interval != schedule.jobs[0].interval:
+        print("\nScheduler interval changed to {} seconds\n".format(hpc_settings.scheduler_interval))
+        schedule.clear()
+        schedule.every(hpc_settings.scheduler_interval).seconds.do(job)
 
 
+site, path_settings, web_server_settings, hpc_settings = utils.get_site_settings()
 schedule.every(hpc_settings.scheduler_interval).seconds.do(job)
 
 
 def main():
-    while True:
-        schedule.run_pending()
+    """
+    Run the job at the scheduler interval. Between the runs sleep until the
+    next one is due, but run it earlier if new pending jobs arrive. Many
+    copies may run at once - the leadership is released on exit, so another
+    copy takes over monitoring without waiting for the lease to expire.
+    """
+    if args.watch:
+        watcher.start(path_settings.upload_path,
+                      hpc_settings,
+                      backend=args.watch,
+                      interval=args.watch_interval)
+    try:
+        while True:
+            schedule.run_pending()
+            fingerprint = utils.get_pending_fingerprint()
+            if utils.wait_for_work(schedule.idle_seconds(), fingerprint):
+                print("\nNew pending jobs. Running before the interval.\n")
+                schedule.run_all()
+    finally:
+        utils.release_lease("scheduler", scheduler.worker_name())
 
 
 if __name__ == '__main__':
-    main()
+    if args.simulate:
+        simulator.main(utils.get_site_settings(),
+                       jobs=args.simulate_jobs,
+                       hours=args.simulate_hours)
+    else:
+        main()
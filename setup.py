@@ -7,7 +7,7 @@ setup(
     name='django-mothulity',
     version=VERSION,
     author=AUTHOR,
-    packages=['mothulity'],
+    packages=['mothulity', 'mothulity.management', 'mothulity.management.commands'],
     include_package_data=True,
     install_requires=open('requirements.txt').readlines(),
     scripts=['sched.py'],